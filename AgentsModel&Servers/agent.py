@@ -4,9 +4,23 @@ from mesa import Agent
 from queue import PriorityQueue
 import networkx as nx
 import matplotlib.pyplot as plt
-import random
+import logging
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
+# Pasos que un coche espera detras de otro antes de recalcular su ruta
+PATIENCE = 3
+# Aristas por delante del coche que se revisan para detectar congestion nueva
+ROUTE_LOOKAHEAD = 5
+# Aumento de peso en la ventana de revision que obliga a recalcular la ruta
+REROUTE_THRESHOLD = 4
+
+# Valores de CityModel.signal_state
+NO_SIGNAL = -1
+RED = 0
+GREEN = 1
+
 
 class Car(Agent):
     """
@@ -16,58 +30,62 @@ class Car(Agent):
         direction: Randomly chosen direction chosen from one of eight directions
     """
 
-    def __init__(self, unique_id, model, graph, moving=False):
+    def __init__(self, unique_id, model, graph, moving=False, origin=None):
         """
         Creates a new random agent.
         Args:
             unique_id: The agent's ID
             model: Model reference for the agent
+            origin: Cell where the car will be placed, used to choose a destination it can reach
         """
         super().__init__(unique_id, model)
-        self.destination = self.choose_random_destination()
+        self.destination = self.choose_random_destination(origin)
         self.moving = moving
         self.graph = graph
         self.path_calculated = False
         self.path = None
+        self.route = None
+        self.route_index = 0
+        self.route_weights = []
+        # route_index and step of the last check of the weights ahead (see route_needs_update)
+        self.checked_index = -1
+        self.checked_step = -1
+        self.waiting = 0
 
-        print("Destination:", self.destination.pos)
+        if self.destination is not None:
+            logger.debug("Destination: %s", self.destination.pos)
 
-    def choose_random_destination(self):
+    def choose_random_destination(self, origin=None):
         """
         Randomly choose a destination from the available destination agents.
+        If the origin is a spawn point, the destination is chosen among the ones reachable from it.
         """
-        destination_agents = [
-            agent
-            for agent in self.model.schedule.agents
-            if isinstance(agent, Destination)
-        ]
+        if origin in self.model.reachable_destinations:
+            destination_agents = self.model.reachable_destinations[origin]
+        else:
+            destination_agents = self.model.destination_list
         if destination_agents:
-            return random.choice(destination_agents)
+            return self.random.choice(destination_agents)
         else:
             return None
 
     def move_to_destination(self):
         if self.destination is not None:
-            if self.trafficlightstate() and self.avoid_car_collision():
-                current_position = self.pos
-                destination_position = self.destination.pos
-
-                try:
-                    path = nx.astar_path(
-                        self.graph, current_position, destination_position
-                    )
-                except nx.NetworkXNoPath:
-                    print("No path found")
-                    return
-                if path:
-                    new_position = path[1]
-                    self.model.grid.move_agent(self, new_position)
-
-                    if new_position == destination_position:
-                        self.model.schedule.remove(self)
-                        self.model.grid.remove_agent(self)
-                        self.model.cars.pop(self.unique_id)
-                        self.model.agents_arrived += 1
+            if not self.trafficlightstate():
+                return
+            if not self.avoid_car_collision():
+                self.waiting += 1
+                return
+
+            new_position = self.get_next_position()
+            if new_position != self.pos:
+                self.waiting = 0
+                self.route_index += 1
+                self.model.move_car(self, new_position)
+
+                if new_position == self.destination.pos:
+                    self.model.remove_car(self)
+                    self.model.agents_arrived += 1
         else:
             self.moving = False
 
@@ -79,31 +97,27 @@ class Car(Agent):
                 destination_position = self.destination.pos
 
                 if not self.path_calculated:
-                    try:
-                        self.path = nx.astar_path(
-                            self.graph, current_position, destination_position
-                        )
-                        self.path_calculated = True
-                    except nx.NetworkXNoPath:
-                        print("No path found")
+                    self.path = self.model.find_path(
+                        current_position, destination_position
+                    )
+                    if self.path is None:
+                        logger.warning("No path found")
                         self.path_calculated = False
                         return
+                    self.path_calculated = True
                 if self.avoid_car_collision2() and self.recalculate_path():
-                    try:
-                        self.path = nx.astar_path(
-                            self.graph, current_position, destination_position
-                        )
-                    except nx.NetworkXNoPath:
-                        print("No path found")
+                    self.path = self.model.find_path(
+                        current_position, destination_position
+                    )
+                    if self.path is None:
+                        logger.warning("No path found")
                         return
                 if self.path:
                     new_position = self.path[1]
-                    self.model.grid.move_agent(self, new_position)
+                    self.model.move_car(self, new_position)
 
                     if new_position == destination_position:
-                        self.model.schedule.remove(self)
-                        self.model.grid.remove_agent(self)
-                        self.model.cars.pop(self.unique_id)
+                        self.model.remove_car(self)
                         self.model.agents_arrived += 1
         else:
             self.moving = False
@@ -125,11 +139,7 @@ class Car(Agent):
         neighbor = (x + direction_of_movement[0], y + direction_of_movement[1])
 
         # Verificar si hay un coche en la dirección de movimiento
-        neighbor_agent = self.model.grid.get_cell_list_contents([neighbor])
-        for agent in neighbor_agent:
-            if isinstance(agent, Car):
-                return False
-        return True
+        return not self.model.occupancy[neighbor]
 
     def avoid_car_collision2(self):
         """
@@ -148,15 +158,13 @@ class Car(Agent):
         neighbor = (x + direction_of_movement[0], y + direction_of_movement[1])
 
         # Verificar si hay un coche en la dirección de movimiento
-        neighbor_agent = self.model.grid.get_cell_list_contents([neighbor])
-        for agent in neighbor_agent:
-            if isinstance(agent, Car):
-                self.recalculate_path()
-                return False
+        if self.model.occupancy[neighbor]:
+            self.recalculate_path()
+            return False
         return True
 
     def recalculate_path(self):
-        recaltulate = random.randint(1, 10)
+        recaltulate = self.random.randint(1, 10)
         if recaltulate == 1:
             return False
         elif recaltulate == 2:
@@ -195,32 +203,87 @@ class Car(Agent):
         # Obtener el vecino en la dirección de movimiento
         neighbor = (x + direction_of_movement[0], y + direction_of_movement[1])
 
-        # Verificar si hay un semáforo en la dirección de movimiento
-        neighbor_agent = self.model.grid.get_cell_list_contents([neighbor])
-        for agent in neighbor_agent:
-            if isinstance(agent, Traffic_Light):
-                if agent.state == False:
-                    return False
-                else:
-                    return True
-        return True
+        # Verificar si hay un semáforo en rojo en la dirección de movimiento
+        return self.model.signal_state[neighbor] != RED
+
+    def plan_route(self):
+        """
+        Computes the route from the current position to the destination and resets the route cursor.
+        The weights of the route are stored so that new congestion ahead of the car can be detected.
+        """
+        self.route = self.model.find_path(self.pos, self.destination.pos)
+        if self.route is None:
+            logger.warning("No path found")
+            self.route = []
+
+        self.route_index = 0
+        self.route_weights = [
+            self.model.edge_weight(u, v) for u, v in zip(self.route, self.route[1:])
+        ]
+        self.checked_index = 0
+        self.checked_step = self.model.step_counter
+        self.waiting = 0
+
+    def route_needs_update(self):
+        """
+        Determines if the cached route is no longer valid: the car was blocked for too long, it is not
+        where the route expects it to be, or the weights of the next edges increased more than the threshold.
+        The weights are only read again when the car advanced, it skipped a step, or one of the next edges
+        changed since the previous check (model.changed_edges holds the changes of the previous step and
+        model.step_changed_edges the ones of this step); otherwise the previous check, which passed, holds.
+        """
+        if self.route is None:
+            return True
+        if not self.route:
+            return False
+        if self.waiting >= PATIENCE:
+            return True
+        if (
+            self.route_index >= len(self.route)
+            or self.route[self.route_index] != self.pos
+        ):
+            return True
+
+        end = min(self.route_index + ROUTE_LOOKAHEAD, len(self.route) - 1)
+        step = self.model.step_counter
+        changed = self.model.changed_edges
+        changing = self.model.step_changed_edges
+        if (
+            self.checked_index == self.route_index
+            and self.checked_step == step - 1
+            and not any(
+                edge in changed or edge in changing
+                for edge in zip(
+                    self.route[self.route_index : end],
+                    self.route[self.route_index + 1 : end + 1],
+                )
+            )
+        ):
+            self.checked_step = step
+            return False
+        self.checked_index = self.route_index
+        self.checked_step = step
+
+        increase = 0
+        for i in range(self.route_index, end):
+            weight = self.model.edge_weight(self.route[i], self.route[i + 1])
+            increase += weight - self.route_weights[i]
+        return increase > REROUTE_THRESHOLD
 
     def get_next_position(self):
         """
         Get the next position the car is planning to move to.
         """
-        current_position = self.pos
-        destination_position = self.destination.pos
-
-        try:
-            path = nx.astar_path(self.graph, current_position, destination_position)
-            if len(path) > 1:
-                return path[1]
-            else:
-                return current_position
-        except nx.NetworkXNoPath:
-            print("No path found")
-            return current_position
+        if self.model.next_hop_routing:
+            return self.model.next_hop(self.pos, self.destination.pos)
+
+        if self.route_needs_update():
+            self.plan_route()
+
+        if self.route_index + 1 < len(self.route):
+            return self.route[self.route_index + 1]
+        else:
+            return self.pos
 
     def move(self):
         """
@@ -251,14 +314,37 @@ class Traffic_Light(Agent):
             timeToChange: After how many step should the traffic light change color 
         """
         self.direction = direction
+        self.controller = None
+        self.index = None
         self.state = state
         self.timeToChange = timeToChange
 
+    @property
+    def state(self):
+        """
+        Whether the traffic light is green. Once the light is attached to the TrafficLightController of
+        the model, the state is read from (and written to) the arrays of the controller.
+        """
+        if self.controller is None:
+            return self._state
+        return self.controller.light_state(self.index)
+
+    @state.setter
+    def state(self, state):
+        if self.controller is None:
+            self._state = state
+        else:
+            self.controller.set_light_state(self.index, state)
+
     def step(self):
         """
         To change the state (green or red) of the traffic light in case you consider the time to change of each traffic light.
+        Lights attached to a controller are changed by the controller instead.
         """
-        if self.model.schedule.steps % self.timeToChange == 0:
+        if (
+            self.controller is None
+            and self.model.schedule.steps % self.timeToChange == 0
+        ):
             self.state = not self.state
 
 
@@ -0,0 +1,275 @@
+#Script que corre el modelo sin servidor web y reparte barridos de parámetros entre varios procesos
+
+import argparse
+import csv
+import glob
+import itertools
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from model import BASE_DIR, CityModel
+from profiling import StepProfiler
+
+# Columns of the results table
+COLUMNS = [
+    "map",
+    "seed",
+    "light_periods",
+    "spawn_interval",
+    "engine",
+    "steps",
+    "arrivals",
+    "throughput",
+    "cars",
+    "seconds",
+    "steps_per_second",
+    "error",
+]
+
+
+def run(
+    map_path=None,
+    steps=100,
+    seed=None,
+    light_periods=None,
+    spawn_interval=1,
+    engine="agents",
+    graph_backend="networkx",
+    profile=False,
+):
+    """
+    Runs one model for a number of steps without a web server and returns a row of the results table.
+    With profile=True the row also has the summary of the profiler of the model in "profile".
+    Args:
+        map_path: Map file of the model
+        steps: Steps to run
+        seed: Seed of the model
+        light_periods: Steps between changes for each traffic light character
+        spawn_interval: Steps between the creation of new cars
+        engine, graph_backend, profile: Passed to CityModel
+    """
+    row = {
+        "map": os.path.basename(map_path or "2023_base.txt"),
+        "seed": seed,
+        "light_periods": format_light_periods(light_periods),
+        "spawn_interval": spawn_interval,
+        "engine": engine,
+        "steps": steps,
+        "arrivals": None,
+        "throughput": None,
+        "cars": None,
+        "seconds": None,
+        "steps_per_second": None,
+        "error": "",
+        "profile": None,
+    }
+    start = time.perf_counter()
+    try:
+        model = CityModel(
+            map_path,
+            graph_backend=graph_backend,
+            engine=engine,
+            light_periods=light_periods,
+            spawn_interval=spawn_interval,
+            telemetry=False,
+            profile=profile,
+            seed=seed,
+        )
+        for _ in range(steps):
+            model.step()
+    except Exception as error:
+        row["error"] = f"{type(error).__name__}: {error}"
+        return row
+
+    seconds = time.perf_counter() - start
+    row.update(
+        arrivals=model.agents_arrived,
+        throughput=model.agents_arrived / steps if steps else 0.0,
+        cars=model.car_count(),
+        seconds=seconds,
+        steps_per_second=steps / seconds if seconds else 0.0,
+        profile=model.profiler.summary() if profile else None,
+    )
+    return row
+
+
+def _run_config(config):
+    return run(**config)
+
+
+def sweep(
+    maps,
+    seeds,
+    light_periods=(None,),
+    spawn_intervals=(1,),
+    steps=100,
+    engine="agents",
+    graph_backend="networkx",
+    profile=False,
+):
+    """
+    Configurations for every combination of map, seed, light periods and spawn interval.
+    """
+    return [
+        {
+            "map_path": map_path,
+            "steps": steps,
+            "seed": seed,
+            "light_periods": periods,
+            "spawn_interval": spawn_interval,
+            "engine": engine,
+            "graph_backend": graph_backend,
+            "profile": profile,
+        }
+        for map_path, periods, spawn_interval, seed in itertools.product(
+            maps, light_periods, spawn_intervals, seeds
+        )
+    ]
+
+
+def run_batch(configs, processes=None, progress=None):
+    """
+    Runs the configurations in a pool of processes and returns their rows in the same order.
+    Args:
+        configs: Keyword arguments of run for each model
+        processes: Number of processes (by default one per CPU). With 1 the models run in this process
+        progress: Function called with (done, total, row) every time a model finishes
+    """
+    rows = [None] * len(configs)
+    if processes == 1:
+        for i, config in enumerate(configs):
+            rows[i] = run(**config)
+            if progress:
+                progress(i + 1, len(configs), rows[i])
+        return rows
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {
+            executor.submit(_run_config, config): i for i, config in enumerate(configs)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            rows[futures[future]] = future.result()
+            if progress:
+                progress(done, len(configs), rows[futures[future]])
+    return rows
+
+
+def format_light_periods(light_periods):
+    """Text of a light periods dictionary, like "S=15,s=7" (empty for the periods of the map dictionary)."""
+    if not light_periods:
+        return ""
+    return ",".join(f"{char}={period}" for char, period in light_periods.items())
+
+
+def parse_light_periods(text):
+    """Inverse of format_light_periods. "default" means the periods of the map dictionary."""
+    if text in ("", "default"):
+        return None
+    periods = {}
+    for item in text.split(","):
+        char, period = item.split("=")
+        periods[char] = int(period)
+    return periods
+
+
+def map_files(names):
+    """
+    Map files for the names given in the command line. "all" means every map in city_files.
+    """
+    if names == ["all"]:
+        return sorted(glob.glob(os.path.join(BASE_DIR, "city_files", "*.txt")))
+    return names
+
+
+def format_table(rows):
+    """Results as a text table with one row per model."""
+    cells = [COLUMNS]
+    for row in rows:
+        line = []
+        for column in COLUMNS:
+            value = row[column]
+            if isinstance(value, float):
+                value = f"{value:.3f}"
+            line.append("" if value is None else str(value))
+        cells.append(line)
+    widths = [max(len(line[i]) for line in cells) for i in range(len(COLUMNS))]
+    return "\n".join(
+        "  ".join(value.ljust(width) for value, width in zip(line, widths)).rstrip()
+        for line in cells
+    )
+
+
+def write_csv(rows, path):
+    with open(path, "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Runs CityModel without a web server for every combination of the given parameters"
+    )
+    parser.add_argument(
+        "--maps", nargs="+", default=["2023_base.txt"], help='Map files, or "all"'
+    )
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0])
+    parser.add_argument(
+        "--light-periods",
+        nargs="+",
+        default=["default"],
+        help='Periods of the traffic lights, like "S=15,s=7", or "default"',
+    )
+    parser.add_argument("--spawn-intervals", type=int, nargs="+", default=[1])
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--engine", choices=["agents", "vectorized"], default="agents")
+    parser.add_argument(
+        "--graph-backend", choices=["networkx", "csr"], default="networkx"
+    )
+    parser.add_argument(
+        "--processes", type=int, default=None, help="Default: one per CPU"
+    )
+    parser.add_argument("--output", help="CSV file where the results are written")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Measure the phases of the step and print their summary for all the runs",
+    )
+    parser.add_argument(
+        "--log-level", default="WARNING", help="Level of the log of the models"
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper())
+
+    configs = sweep(
+        map_files(args.maps),
+        args.seeds,
+        [parse_light_periods(text) for text in args.light_periods],
+        args.spawn_intervals,
+        args.steps,
+        args.engine,
+        args.graph_backend,
+        args.profile,
+    )
+
+    def progress(done, total, row):
+        print(f"[{done}/{total}] {row['map']} seed={row['seed']}", file=sys.stderr)
+
+    rows = run_batch(configs, args.processes, progress)
+    print(format_table(rows))
+    if args.profile:
+        profiler = StepProfiler()
+        for row in rows:
+            if row["profile"] is not None:
+                profiler.merge(row["profile"])
+        print()
+        print(profiler.format_summary())
+    if args.output:
+        write_csv(rows, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#Script que mide cuántos coches por segundo mueve el motor vectorizado en mapas sintéticos grandes
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from map_generator import generate_grid
+from model import ROUTE_REFRESH, CityModel
+
+
+def _load_model(lines):
+    """Vectorized CityModel of the given map lines."""
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as map_file:
+        map_file.writelines(lines)
+    try:
+        return CityModel(map_file.name, engine="vectorized", telemetry=False)
+    finally:
+        os.remove(map_file.name)
+
+
+def benchmark(cars, steps, blocks, destinations, seed=0, route_refresh=ROUTE_REFRESH):
+    """
+    Runs steps steps with the given number of cars and returns the timings. The step time includes
+    the rebuilds of the next-hop tables, once every route_refresh steps.
+    """
+    start = time.perf_counter()
+    model = _load_model(generate_grid(blocks, destinations=destinations, seed=seed))
+    load_time = time.perf_counter() - start
+    model.set_parameters(route_refresh=route_refresh)
+
+    fleet = model.fleet
+    graph = model.graph
+    # Tables of the empty map, only to choose destinations the cars can reach. The fleet builds its
+    # own tables in the steps, once every route_refresh steps, so the step time includes them
+    start = time.perf_counter()
+    tables = [
+        graph.next_hop_table(int(cell)) for cell in fleet.destination_cells.tolist()
+    ]
+    table_time = time.perf_counter() - start
+
+    # Random free road cells, each with a destination that can be reached from it
+    rng = np.random.default_rng(seed)
+    free = graph.is_node.copy()
+    free[fleet.destination_cells] = False
+    free[model.occupancy.T.ravel() > 0] = False
+    xs, ys = model.traffic_light_controller.positions.T
+    free[graph.node((xs, ys))] = False
+    cells = rng.permutation(np.flatnonzero(free))
+    if cells.size < cars:
+        raise ValueError(f"The map only has {cells.size} free cells for {cars} cars")
+    cells = cells[:cars]
+    destinations = rng.integers(len(model.destination_list), size=cars)
+    for _ in range(10):
+        hops = np.array(
+            [tables[d][cell] for cell, d in zip(cells.tolist(), destinations.tolist())]
+        )
+        unreachable = hops < 0
+        if not unreachable.any():
+            break
+        destinations[unreachable] = rng.integers(
+            len(model.destination_list), size=int(unreachable.sum())
+        )
+    reachable = hops >= 0
+    fleet.add_cars(cells[reachable], destinations[reachable])
+
+    start = time.perf_counter()
+    moved = 0
+    for _ in range(steps):
+        before = fleet.cells.copy()
+        ids = fleet.ids.copy()
+        model.step()
+        # Cars that are still in the fleet and changed cell, plus the ones that arrived.
+        # The cars created by the spawner are at the end of the arrays.
+        kept = np.isin(ids, fleet.ids)
+        after = fleet.cells[: kept.sum()]
+        moved += int((before[kept] != after).sum() + (~kept).sum())
+    step_time = time.perf_counter() - start
+
+    return {
+        "cars": int(reachable.sum()),
+        "map": f"{model.width}x{model.height}",
+        "load": load_time,
+        "tables": table_time,
+        "step": step_time / steps,
+        "cars_per_second": int(reachable.sum()) * steps / step_time,
+        "moves_per_step": moved / steps,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Steps per second of the vectorized car engine on synthetic grid maps"
+    )
+    parser.add_argument("--cars", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--destinations", type=int, default=16)
+    parser.add_argument(
+        "--route-refresh",
+        type=int,
+        default=ROUTE_REFRESH,
+        help="Minimum steps between rebuilds of the next-hop tables",
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'cars':>8} {'map':>10} {'load s':>8} {'tables s':>9} {'step ms':>9} "
+        f"{'cars/s':>12} {'moves/step':>11}"
+    )
+    for cars in args.cars:
+        # About one car for every three road cells, with blocks of 6 cells (a third of the cells are roads)
+        blocks = max(8, int(np.ceil(np.sqrt(cars * 9) / 6)))
+        result = benchmark(
+            cars,
+            args.steps,
+            blocks,
+            args.destinations,
+            route_refresh=args.route_refresh,
+        )
+        print(
+            f"{result['cars']:>8} {result['map']:>10} {result['load']:>8.2f} "
+            f"{result['tables']:>9.2f} {result['step'] * 1000:>9.2f} "
+            f"{result['cars_per_second']:>12.0f} {result['moves_per_step']:>11.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+#Script con las pruebas de rendimiento del modelo: construcción del grafo, cálculo de rutas y tiempo por paso
+
+import argparse
+import datetime
+import gc
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from agent import Car
+from map_cache import compile_map
+from map_generator import generate_grid
+from model import BASE_DIR, DICTIONARY_PATH, CityModel
+
+# Configurations of the model that are measured: engine and graph backend
+CONFIGS = {
+    "agents": {"engine": "agents", "graph_backend": "networkx"},
+    "agents-csr": {"engine": "agents", "graph_backend": "csr"},
+    "vectorized": {"engine": "vectorized"},
+}
+
+
+def _timings(function, repeats):
+    """
+    Seconds taken by each of repeats calls of function. Like timeit, the garbage collector is off
+    while a call is measured, so its pauses don't land on a random sample.
+    """
+    samples = []
+    for _ in range(repeats):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            function()
+            samples.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return samples
+
+
+def _result(name, metric, unit, samples, scale, **details):
+    """Row of the results, where the value is the median of the samples (converted with scale)."""
+    samples = [sample * scale for sample in samples]
+    return {
+        "name": f"{name}/{metric}",
+        "metric": metric,
+        "unit": unit,
+        "value": statistics.median(samples),
+        "samples": samples,
+        **details,
+    }
+
+
+def populate(model, cars, rng):
+    """
+    Adds cars at random free road cells, each with a destination it can reach.
+    Returns the number of cars added, which can be less than cars on a small map.
+    """
+    destinations = model.destination_list
+    tables = [model.build_next_hop_table(d.pos) for d in destinations]
+    reach = np.array(tables) >= 0
+
+    free = (model.cell_kinds != 0).T.ravel()
+    free &= model.occupancy.T.ravel() == 0
+    free &= model.signal_state.T.ravel() < 0
+    free &= model.destination_ids.T.ravel() < 0
+    free &= reach.any(axis=0)
+    cells = rng.permutation(np.flatnonzero(free))[:cars]
+    # Random destination among the reachable ones of each cell
+    choices = [rng.choice(np.flatnonzero(reach[:, cell])) for cell in cells.tolist()]
+
+    if model.fleet is not None:
+        model.fleet.add_cars(cells, choices)
+        return len(cells)
+
+    for cell, choice in zip(cells.tolist(), choices):
+        position = (cell % model.width, cell // model.width)
+        car = Car(model.num_agents + 1, model, model.graph)
+        car.destination = destinations[choice]
+        model.num_agents += 1
+        model.place_car(car, position)
+    return len(cells)
+
+
+def bench_init(name, map_path, config, repeats):
+    """
+    Time of CityModel.__init__ compiling the map, of __init__ with the compiled map in the cache, of
+    compile_map on its own (parsing the map, building the edges, the graph and the destination index)
+    and of create_graph from the compiled map. With the "csr" backend create_graph only copies the
+    compiled arrays.
+    """
+    init = _timings(
+        lambda: CityModel(map_path, telemetry=False, map_cache=False, **config),
+        repeats,
+    )
+    with open(DICTIONARY_PATH) as dictionary_file:
+        dictionary = json.load(dictionary_file)
+    with open(map_path) as map_file:
+        lines = map_file.readlines()
+    compiled = _timings(lambda: compile_map(lines, dictionary), repeats)
+
+    models = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+
+        def cached_init():
+            models.append(
+                CityModel(map_path, telemetry=False, map_cache=cache_dir, **config)
+            )
+
+        # The first model fills the cache
+        cached_init()
+        cached = _timings(cached_init, repeats)
+        graph = _timings(models[-1].create_graph, repeats)
+    return [
+        _result(name, "init", "ms", init, 1000),
+        _result(name, "init_cached", "ms", cached, 1000),
+        _result(name, "compile_map", "ms", compiled, 1000),
+        _result(name, "create_graph_compiled", "ms", graph, 1000),
+    ]
+
+
+def bench_model(name, map_path, config, cars, steps, warmup, seed):
+    """
+    Routing latency and steady-state step time of a model with a number of cars.
+    Returns None if the map doesn't have room for the cars.
+    """
+    rng = np.random.default_rng(seed)
+    model = CityModel(map_path, telemetry=False, seed=seed, **config)
+    added = populate(model, cars, rng)
+    if added < cars:
+        return None
+    name = f"{name}/cars={cars}"
+
+    for _ in range(warmup):
+        model.step()
+    rows = [_result(name, "step", "ms", _timings(model.step, steps), 1000, cars=cars)]
+
+    if model.fleet is None:
+        # Time per call between steps. The tables rebuilt when the weights change count in the step time
+        samples = []
+        for _ in range(steps):
+            model.step()
+            agents = [agent for agent in model.cars.values() if isinstance(agent, Car)]
+            samples.append(
+                _timings(lambda: [agent.get_next_position() for agent in agents], 1)[0]
+                / max(len(agents), 1)
+            )
+        rows.append(_result(name, "get_next_position", "us", samples, 1e6, cars=cars))
+
+        pairs = [
+            (agent.pos, agent.destination.pos)
+            for agent in agents[: min(len(agents), 20)]
+        ]
+        searches = _timings(lambda: [model.find_path(*pair) for pair in pairs], steps)
+        rows.append(
+            _result(
+                name,
+                "find_path",
+                "ms",
+                [seconds / max(len(pairs), 1) for seconds in searches],
+                1000,
+                cars=cars,
+            )
+        )
+    return rows
+
+
+def map_set(synthetic, directory):
+    """
+    (name, path) of every map in city_files and of a synthetic grid map for each size in synthetic,
+    written to directory.
+    """
+    maps = [
+        (os.path.basename(path), path)
+        for path in sorted(glob.glob(os.path.join(BASE_DIR, "city_files", "*.txt")))
+    ]
+    for blocks in synthetic:
+        path = os.path.join(directory, f"grid_{blocks}.txt")
+        with open(path, "w") as map_file:
+            map_file.writelines(generate_grid(blocks))
+        maps.append((f"grid_{blocks}", path))
+    return maps
+
+
+def run_suite(
+    configs, cars, synthetic, steps, warmup, repeats, seed=0, log=None, skip=None
+):
+    """
+    Runs the benchmarks of every map, configuration and car count. Returns the rows of the results and
+    the names of the benchmarks skipped because the map doesn't have room for the cars.
+    log is called with the name of each map and configuration when its benchmarks finish, and skip with
+    the name of each skipped benchmark.
+    """
+    rows = []
+    skipped = []
+    with tempfile.TemporaryDirectory() as directory:
+        for map_name, map_path in map_set(synthetic, directory):
+            for config_name in configs:
+                name = f"{map_name}/{config_name}"
+                config = CONFIGS[config_name]
+                rows.extend(bench_init(name, map_path, config, repeats))
+                for count in cars:
+                    model_rows = bench_model(
+                        name, map_path, config, count, steps, warmup, seed
+                    )
+                    if model_rows is None:
+                        skipped.append(f"{name}/cars={count}")
+                        if skip:
+                            skip(skipped[-1])
+                    else:
+                        rows.extend(model_rows)
+                if log:
+                    log(name)
+    return rows, skipped
+
+
+def compare(baseline, current, threshold):
+    """
+    Compares two results files. A benchmark regresses when its median is more than threshold
+    (a fraction) slower than in the baseline. Returns the lines of the report, the regressions and
+    the benchmarks of the baseline that are missing from the current results, which the report
+    marks as skipped when the current run skipped them for lack of room.
+    """
+    base = {row["name"]: row for row in baseline["results"]}
+    names = {row["name"] for row in current["results"]}
+    skipped = set(current.get("skipped", ()))
+    lines = []
+    regressions = []
+    missing = []
+    for row in current["results"]:
+        if row["name"] not in base:
+            continue
+        before = base[row["name"]]["value"]
+        after = row["value"]
+        change = (after - before) / before if before else 0.0
+        if change > threshold:
+            status = "REGRESSION"
+            regressions.append(row["name"])
+        elif change < -threshold:
+            status = "faster"
+        else:
+            status = ""
+        lines.append(
+            f"{row['name']:<60} {before:>10.3f} {after:>10.3f} {row['unit']:<3} "
+            f"{change:>+7.1%} {status}"
+        )
+    for row in baseline["results"]:
+        if row["name"] in names:
+            continue
+        missing.append(row["name"])
+        status = "skipped" if row["name"].rsplit("/", 1)[0] in skipped else "MISSING"
+        lines.append(
+            f"{row['name']:<60} {row['value']:>10.3f} {'-':>10} {row['unit']:<3} "
+            f"{'':>7} {status}"
+        )
+    return lines, regressions, missing
+
+
+def _environment():
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of CityModel. Run them with 'run' and compare two results files with 'compare'"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run")
+    run.add_argument(
+        "--configs", nargs="+", choices=list(CONFIGS), default=list(CONFIGS)
+    )
+    run.add_argument("--cars", type=int, nargs="+", default=[50, 200, 1000])
+    run.add_argument(
+        "--synthetic",
+        type=int,
+        nargs="+",
+        default=[20, 40],
+        help="Sizes in blocks of the synthetic grid maps",
+    )
+    run.add_argument("--steps", type=int, default=10)
+    run.add_argument("--warmup", type=int, default=3)
+    run.add_argument("--repeats", type=int, default=5)
+    run.add_argument("--output", default="benchmark.json")
+    run.add_argument("--baseline", help="Results file to compare with after the run")
+    run.add_argument("--threshold", type=float, default=0.2)
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        rows, skipped = run_suite(
+            args.configs,
+            args.cars,
+            args.synthetic,
+            args.steps,
+            args.warmup,
+            args.repeats,
+            log=lambda name: print("done", name, file=sys.stderr),
+            skip=lambda name: print(
+                "skipped", name, "(not enough free road cells)", file=sys.stderr
+            ),
+        )
+        current = {"environment": _environment(), "results": rows, "skipped": skipped}
+        with open(args.output, "w") as output:
+            json.dump(current, output, indent=2)
+        for row in rows:
+            print(f"{row['name']:<60} {row['value']:>10.3f} {row['unit']}")
+        if skipped:
+            print(
+                f"{len(skipped)} benchmarks skipped because the map doesn't have room for the "
+                f"cars: {', '.join(skipped)}"
+            )
+        if not args.baseline:
+            return 0
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    else:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        with open(args.current) as current_file:
+            current = json.load(current_file)
+
+    lines, regressions, missing = compare(baseline, current, args.threshold)
+    print("\n".join(lines))
+    if missing:
+        print(
+            f"{len(missing)} benchmarks of the baseline missing from the current results"
+        )
+    if regressions:
+        print(f"{len(regressions)} regressions over {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
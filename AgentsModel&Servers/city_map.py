@@ -0,0 +1,246 @@
+#Script que lee el mapa de la ciudad como un arreglo de NumPy y calcula las conexiones del grafo de calles
+
+import numpy as np
+
+# Directions a road can have and the code used for them in the arrays (0 means no road)
+DIRECTIONS = [
+    None,
+    "Up",
+    "Down",
+    "Left",
+    "Right",
+    "Up-Right",
+    "Up-Left",
+    "Down-Right",
+    "Down-Left",
+]
+DIRECTION_CODES = {direction: code for code, direction in enumerate(DIRECTIONS)}
+
+# Offsets of the Moore neighbourhood and of the Von Neumann neighbourhood
+MOORE_OFFSETS = np.array(
+    [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+)
+VON_NEUMANN_OFFSETS = np.array([(-1, 0), (0, -1), (0, 1), (1, 0)])
+
+# Cell kinds
+EMPTY = 0
+ROAD = 1
+TRAFFIC_LIGHT = 2
+DESTINATION = 3
+OBSTACLE = 4
+
+
+def _allowed(direction, dx, dy):
+    """
+    Whether a road with the given direction lets a car move to the neighbour at offset (dx, dy).
+    """
+    return {
+        "Up": dy > 0,
+        "Down": dy < 0,
+        "Left": dx < 0,
+        "Right": dx > 0,
+        "Up-Right": dx > 0 or dy > 0,
+        "Up-Left": dx < 0 or dy > 0,
+        "Down-Right": dx > 0 or dy < 0,
+        "Down-Left": dx < 0 or dy < 0,
+    }.get(direction, False)
+
+
+def _traffic_light_rule(direction, sx, sy):
+    """
+    Edge between a traffic light and a neighbouring road with the given direction, where sx and sy are
+    the signs of the difference between the light and the road coordinates.
+    Returns 0 for no edge, 1 for light -> road and 2 for road -> light.
+    """
+    rules = [
+        ("Right", sx > 0, 2),
+        ("Right", sx < 0, 1),
+        ("Down-Left", sx > 0, 1),
+        ("Up-Right", sy > 0, 1),
+        ("Up-Right", sy < 0, 2),
+        ("Left", sx < 0, 2),
+        ("Left", sx > 0, 1),
+        ("Down", sy > 0, 1),
+        ("Down", sy < 0, 2),
+        ("Right", sy > 0, 1),
+        ("Down", sx > 0, 1),
+        ("Up", sy > 0, 2),
+        ("Up", sy < 0, 1),
+        ("Left", sy < 0, 1),
+        ("Up", sx < 0, 1),
+    ]
+    for rule_direction, condition, edge in rules:
+        if direction == rule_direction and condition:
+            return edge
+    return 0
+
+
+# Lookup tables indexed by direction code and offset (or by the signs of the offset)
+ALLOWED_MOORE = np.array(
+    [[_allowed(d, dx, dy) for dx, dy in MOORE_OFFSETS] for d in DIRECTIONS]
+)
+ALLOWED_VON_NEUMANN = np.array(
+    [[_allowed(d, dx, dy) for dx, dy in VON_NEUMANN_OFFSETS] for d in DIRECTIONS]
+)
+TRAFFIC_LIGHT_RULES = np.array(
+    [
+        [[_traffic_light_rule(d, sx, sy) for sy in (-1, 0, 1)] for sx in (-1, 0, 1)]
+        for d in DIRECTIONS
+    ],
+    dtype=np.int8,
+)
+
+
+def load_city_map(lines):
+    """
+    Reads the lines of a map file into a character array indexed as [x, y], with y = 0 at the bottom
+    of the file like in the grid of the model.
+    """
+    rows = [line.rstrip("\n") for line in lines]
+    width = len(lines[0]) - 1
+    height = len(rows)
+    chars = np.full((height, width), " ", dtype="<U1")
+    for r, row in enumerate(rows):
+        row = row[:width]
+        chars[r, : len(row)] = list(row)
+    return chars[::-1].T.copy()
+
+
+def classify_cells(city_map, dataDictionary):
+    """
+    Converts the character map into two arrays: the kind of each cell and the direction code of each road.
+    """
+    kinds = np.full(city_map.shape, EMPTY, dtype=np.int8)
+    directions = np.zeros(city_map.shape, dtype=np.int8)
+    for char, value in dataDictionary.items():
+        mask = city_map == char
+        if value in DIRECTION_CODES:
+            kinds[mask] = ROAD
+            directions[mask] = DIRECTION_CODES[value]
+        elif isinstance(value, int):
+            kinds[mask] = TRAFFIC_LIGHT
+        elif value == "Destination":
+            kinds[mask] = DESTINATION
+        elif value == "Obstacle":
+            kinds[mask] = OBSTACLE
+    return kinds, directions
+
+
+def _shift(array, dx, dy, fill):
+    """
+    Returns an array where position [x, y] holds array[x + dx, y + dy], or fill outside the map.
+    """
+    width, height = array.shape
+    shifted = np.full_like(array, fill)
+    shifted[max(0, -dx) : width - max(0, dx), max(0, -dy) : height - max(0, dy)] = (
+        array[max(0, dx) : width - max(0, -dx), max(0, dy) : height - max(0, -dy)]
+    )
+    return shifted
+
+
+def build_edges(kinds, directions):
+    """
+    Computes the edges of the road graph from the cell arrays.
+
+    Returns the source and target cells as flat indices (x * height + y), and the direction code of
+    the road the edge was created for (0 for the edges of traffic lights and destinations).
+    The edges are the same ones CityModel.create_graph used to add one neighbour at a time.
+    """
+    width, height = kinds.shape
+    nodes = kinds != EMPTY
+    nodes &= kinds != OBSTACLE
+    roads = kinds == ROAD
+    index = np.arange(width * height).reshape(width, height)
+
+    sources = []
+    targets = []
+    edge_directions = []
+
+    def add(mask, offset, direction_codes, reverse=False):
+        dx, dy = offset
+        source = index[mask]
+        target = _shift(index, dx, dy, -1)[mask]
+        if reverse:
+            source, target = target, source
+        sources.append(source)
+        targets.append(target)
+        edge_directions.append(direction_codes)
+
+    # Roads connect to the next road with the same direction, in any of the Moore cells the direction allows.
+    # If a road touches a road with another direction it also connects to any Von Neumann cell it allows.
+    mixed = np.zeros_like(roads)
+    node_neighbours = np.zeros_like(roads)
+    for k, (dx, dy) in enumerate(MOORE_OFFSETS):
+        neighbour_directions = _shift(directions, dx, dy, 0)
+        neighbour_roads = _shift(roads, dx, dy, False)
+        node_neighbours |= _shift(nodes, dx, dy, False)
+        same = roads & neighbour_roads & (neighbour_directions == directions)
+        mixed |= roads & neighbour_roads & (neighbour_directions != directions)
+        mask = same & ALLOWED_MOORE[directions, k]
+        add(mask, (dx, dy), directions[mask])
+
+    for k, (dx, dy) in enumerate(VON_NEUMANN_OFFSETS):
+        mask = mixed & _shift(nodes, dx, dy, False) & ALLOWED_VON_NEUMANN[directions, k]
+        add(mask, (dx, dy), directions[mask])
+
+    # Traffic lights connect with their Von Neumann roads depending on the direction of the road.
+    # Destinations can be entered from any Von Neumann node.
+    lights = (kinds == TRAFFIC_LIGHT) & node_neighbours
+    for dx, dy in VON_NEUMANN_OFFSETS:
+        neighbour_directions = _shift(directions, dx, dy, 0)
+        rule = TRAFFIC_LIGHT_RULES[neighbour_directions, 1 - dx, 1 - dy]
+        rule[~lights | ~_shift(roads, dx, dy, False)] = 0
+        for edge in (1, 2):
+            mask = rule == edge
+            add(mask, (dx, dy), np.zeros(mask.sum(), dtype=np.int8), reverse=edge == 2)
+
+        mask = (kinds == DESTINATION) & node_neighbours & _shift(nodes, dx, dy, False)
+        add(mask, (dx, dy), np.zeros(mask.sum(), dtype=np.int8), reverse=True)
+
+    # The cells were visited column by column, and a cell that is not a node reused the state of the
+    # last node visited. When that node is a traffic light, its rules were evaluated again with the
+    # coordinates of the empty cell, which can add a few more edges that the routes depend on.
+    flat_nodes = nodes.ravel()
+    last_node = np.maximum.accumulate(
+        np.where(flat_nodes, np.arange(flat_nodes.size), -1)
+    )
+    stale = ~flat_nodes & (last_node >= 0)
+    cells = np.flatnonzero(stale)
+    lights = last_node[cells]
+    keep = (kinds.ravel()[lights] == TRAFFIC_LIGHT) & node_neighbours.ravel()[lights]
+    cells, lights = cells[keep], lights[keep]
+    cell_x, cell_y = np.divmod(cells, height)
+    light_x, light_y = np.divmod(lights, height)
+    for dx, dy in VON_NEUMANN_OFFSETS:
+        road_x = light_x + dx
+        road_y = light_y + dy
+        inside = (road_x >= 0) & (road_x < width) & (road_y >= 0) & (road_y < height)
+        road_x, road_y = np.clip(road_x, 0, width - 1), np.clip(road_y, 0, height - 1)
+        inside &= roads[road_x, road_y]
+        rule = TRAFFIC_LIGHT_RULES[
+            directions[road_x, road_y],
+            np.sign(cell_x - road_x) + 1,
+            np.sign(cell_y - road_y) + 1,
+        ]
+        road = road_x * height + road_y
+        for edge in (1, 2):
+            mask = inside & (rule == edge)
+            source, target = lights[mask], road[mask]
+            if edge == 2:
+                source, target = target, source
+            sources.append(source)
+            targets.append(target)
+            edge_directions.append(np.zeros(mask.sum(), dtype=np.int8))
+
+    sources = np.concatenate(sources)
+    targets = np.concatenate(targets)
+    edge_directions = np.concatenate(edge_directions).astype(np.int8)
+
+    # Keep a single copy of each edge. An edge added for a road keeps the direction of that road.
+    keys = sources.astype(np.int64) * (width * height) + targets
+    order = np.lexsort((-edge_directions, keys))
+    keys = keys[order]
+    first = np.ones(keys.size, dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    order = order[first]
+    return sources[order], targets[order], edge_directions[order]
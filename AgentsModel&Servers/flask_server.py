@@ -1,82 +1,489 @@
 #Script que genera un backend para que la simulación pueda ser visualizada en Unity
 
 from agent import Car, Traffic_Light, Destination, Obstacle, Road
+from city_map import DESTINATION, DIRECTIONS, OBSTACLE, ROAD
+from frame_stream import FrameBuffer, SimulationClock
+from map_registry import MapRegistry
 from model import CityModel
-from flask import Flask, request, jsonify
+from session_workers import WorkerPool, WorkerSession
+from sessions import Session, SessionNotFound, SessionStore, SnapshotNotFound
+from flask import Flask, Response, request, jsonify
+import atexit
+import gzip
+import json
+import logging
+import os
+import uuid
+import wire_format
 
 app = Flask("Traffic Simulator")
 
+# Compiled maps, loaded when the server starts so /init only has to create the agents
+maps = MapRegistry()
+# Simulations of the clients. Each request names its session with "session" or the X-Session-Id
+# header; requests without one use the last session created without one, like the old single model
+sessions = SessionStore()
+# Number of worker processes that run the models of the sessions, to use several cores. With 0 (the
+# default) the models run in the server process
+SESSION_WORKERS = int(os.environ.get("SESSION_WORKERS", "0"))
+workers = WorkerPool(SESSION_WORKERS) if SESSION_WORKERS > 0 else None
+# Steps of changes kept for /getAgents?since=
+STATE_HISTORY = 64
+# Whether the models measure the time of each phase of the step for /metrics. Off by default, since
+# it slows down the step; PROFILE_MODELS=1 turns it on
+PROFILE_MODELS = os.environ.get("PROFILE_MODELS", "0") == "1"
+# Options of the models of the sessions
+MODEL_OPTIONS = {"state_history": STATE_HISTORY, "profile": PROFILE_MODELS}
+# Maximum number of sessions that /fork creates in one request
+MAX_FORKS = 16
+# Maximum number of steps that /step advances in one request
+MAX_STEPS = 1000
+# Answers smaller than this are not compressed, even if the client accepts gzip
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 5
+# Seconds between the comments /stream sends when there are no frames, so proxies keep the connection
+KEEPALIVE_SECONDS = 15
+# Frames that /startBuffer computes ahead by default, and the most it accepts
+BUFFER_FRAMES = 16
+MAX_BUFFER_FRAMES = 256
+# Seconds that /update waits for a frame of the buffer before giving up
+FRAME_TIMEOUT = 30
+
+def session_id():
+    return request.values.get('session') or request.headers.get('X-Session-Id')
+
+def current_session():
+    """Session of the request. Raises SessionNotFound, which is answered with a 404."""
+    return sessions.get(session_id())
+
+@app.errorhandler(SessionNotFound)
+@app.errorhandler(SnapshotNotFound)
+def session_not_found(error):
+    return jsonify({"message": str(error)}), 404
+
+def new_session(new_id, map_path, compiled_map, snapshot=None, seed=None):
+    """Session with a new model, in a worker process if there are workers. With a snapshot it is a fork."""
+    if workers is not None:
+        return WorkerSession(new_id, workers, map_path, compiled_map, MODEL_OPTIONS, snapshot, seed)
+    model = CityModel(map_path, compiled_map=compiled_map, **MODEL_OPTIONS)
+    if snapshot is not None:
+        model.restore(snapshot, seed)
+    return Session(new_id, model)
+
 @app.route('/init', methods=['GET','POST'])
 def init_model():
-    global cityModel, current_step, num_agents, width, height
-    
+    """
+    Creates the model of a session from the map "MapPath" and returns the id of the session. Without
+    a session id it replaces the default session, keeping its id. A session with an id lives until
+    /closeSession or until it expires, so clients that open several ones should close them when done.
+    """
     if request.method == 'POST':
         
-        map_path = request.form.get('MapPath')
+        # Only the maps of city_files can be opened, by the name of their file
+        try:
+            map_path = maps.known_path(request.form.get('MapPath'))
+            compiled_map = maps.get(map_path)
+        except FileNotFoundError as error:
+            return jsonify({"message": str(error)}), 404
+        except ValueError as error:
+            return jsonify({"message": f"The map can't be read: {error}"}), 400
         
-        current_step = 0
+        # Reusing the id of a session replaces its model and ends its streams
+        session = sessions.create(lambda new_id: new_session(new_id, map_path, compiled_map), session_id())
+
+        return jsonify({"message": "Model Initialized", "session": session.id})
         
-        cityModel = CityModel(map_path)
+@app.route('/closeSession', methods=['POST'])
+def close_session():
+    sessions.remove(current_session().id)
+    return jsonify({"message": "Session Closed"})
          
-        return jsonify({"message": "Model Initialized"})
+@app.route('/getSessions', methods=['GET'])
+def get_sessions():
+    if request.method == 'GET':
+        sessionData = [{"id": session.id, "map": session.map_path, "step": session.step_counter,
+                        "clock": session.clock is not None, "buffered": session.frames is not None,
+                        "subscribers": session.broadcaster.subscribers,
+                        "bytes": session.estimate_bytes()}
+                       for session in sessions.sessions()]
+        return jsonify({"data": sessionData, "default": sessions.default_id})
+
+@app.route('/getMaps', methods=['GET'])
+def get_maps():
+    if request.method == 'GET':
+        mapData = [{"name": name, "problems": maps.problems.get(name, [])}
+                   for name in maps.names()]
+        return jsonify({"data": mapData})
         
 @app.route('/getAgents', methods=['GET'])
 def get_cars():
-    global cityModel
+    session = current_session()
     
     if request.method == 'GET':
-        carData = [{"id": str(Agent.unique_id), "x": Agent.pos[0], "y": 0.101, "z":Agent.pos[1], "destination": Agent.destination.pos}
-                   for Agent in cityModel.cars.values()]
-        return jsonify({"data": carData})
+        since = request.args.get('since', type=int)
+        if since is not None:
+            changes = client_changes(session, since, request.args.get('run'))
+            return state_response([changes], lambda: changes_data(changes, session))
+        if wants_binary():
+            changes = client_changes(session)
+            return state_response([changes], None)
+        if session.frames is not None:
+            full = session.frames.current.full
+            car_states = (full.ids, full.x, full.y, full.dest_x, full.dest_y)
+        else:
+            with session.lock:
+                car_states = session.car_states()
+        ids, xs, ys, destination_xs, destination_ys = (array.tolist() for array in car_states)
+        carData = [{"id": str(car_id), "x": x, "y": 0.101, "z":y, "destination": [destination_x, destination_y]}
+                   for car_id, x, y, destination_x, destination_y in zip(ids, xs, ys, destination_xs, destination_ys)]
+        return compressed(jsonify({"data": carData}))
+
+def client_changes(session, since=None, run=None):
+    """
+    state_feed.Changes after the step since. With the frame buffer on, the model is ahead of the
+    client, so they come from the frame the client is at: its changes since the step before, or all of it.
+    """
+    frames = session.frames
+    if frames is None:
+        with session.lock:
+            return session.changes(since, run)
+    frame = frames.current
+    if since == frame.step - 1 and run in (None, frame.delta.run):
+        return frame.delta
+    return frame.full
+
+def wants_binary():
+    """Whether the client asked for wire_format in the Accept header (JSON is preferred on ties)."""
+    best = request.accept_mimetypes.best_match(['application/json', wire_format.CONTENT_TYPE])
+    return best == wire_format.CONTENT_TYPE
+
+def state_response(frames, data):
+    """
+    Answer with state_feed.Changes frames: packed with wire_format if the client asked for it, or the
+    JSON of data() otherwise. Both are compressed with gzip when the client accepts it.
+    """
+    if wants_binary():
+        response = Response(wire_format.pack_frames(frames, frames[-1].step),
+                            mimetype=wire_format.CONTENT_TYPE)
+    else:
+        response = jsonify(data())
+    return compressed(response)
+
+def compressed(response):
+    """Compresses a response with gzip if the client accepts it and it is big enough."""
+    response.vary.update(['Accept', 'Accept-Encoding'])
+    body = response.get_data()
+    if 'gzip' in request.accept_encodings and len(body) >= GZIP_MIN_SIZE:
+        response.set_data(gzip.compress(body, GZIP_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def changes_data(changes, session):
+    """
+    Changes of a state_feed.Changes for the client: the cars that moved or were created (with their
+    destination only when the client doesn't know it), the ids of the cars that arrived and the
+    traffic lights that changed. When "full" is true the client must drop the cars it has.
+    """
+    ids, xs, ys, destination_xs, destination_ys, send_destinations = (array.tolist() for array in (
+        changes.ids, changes.x, changes.y, changes.dest_x, changes.dest_y, changes.send_destination))
+    carData = [{"id": str(car_id), "x": x, "y": 0.101, "z":y} for car_id, x, y in zip(ids, xs, ys)]
+    for car, destination_x, destination_y, send_destination in zip(carData, destination_xs, destination_ys, send_destinations):
+        if send_destination:
+            car["destination"] = [destination_x, destination_y]
+    lightData = [{"id": session.light_ids[i], "state": state}
+                 for i, state in zip(changes.lights.tolist(), changes.light_states.tolist())]
+    return {"run": changes.run, "step": changes.step, "full": changes.full, "data": carData,
+            "removed": [str(car_id) for car_id in changes.removed.tolist()], "lights": lightData}
 
 @app.route('/getRoads', methods=['GET'])
 def get_roads():
-    global cityModel
+    cityModel = current_session().static
     
     if request.method == 'GET':
-        roadData = [{"id": str(road.unique_id), "x": road.pos[0], "y": 0, "z":road.pos[1], "direction": road.direction}
-                   for road in cityModel.road.values()]
+        roadData = [{"id": f"r_{cityModel.cell_id((x, y))}", "x": x, "y": 0, "z":y, "direction": DIRECTIONS[cityModel.road_directions[x, y]]}
+                   for x, y in cityModel.static_cells(ROAD)]
         return jsonify({"data": roadData})
         
 
 @app.route('/getTrafficLights', methods=['GET'])
 def get_traffic_lights():
-    global cityModel
+    session = current_session()
     
     if request.method == 'GET':
-        trafficLightPositions = [{"id": str(tls.unique_id), "x": tls.pos[0], "y": 0.7, "z":tls.pos[1], "state": tls.state}
-                   for tls in cityModel.traffic_lights1.values()]
+        if session.frames is not None:
+            states = session.frames.current.full.light_states.tolist()
+        else:
+            with session.lock:
+                states = session.light_states().tolist()
+        trafficLightPositions = [{"id": light_id, "x": x, "y": 0.7, "z":y, "state": state}
+                   for light_id, (x, y), state in zip(session.light_ids, session.light_positions, states)]
         return jsonify({"data": trafficLightPositions})
 
 @app.route('/getDestinations', methods=['GET'])
 def get_destinations():
-    global cityModel
+    cityModel = current_session().static
     
     if request.method == 'GET':
-        destinationPositions = [{"id": str(des.unique_id), "x": des.pos[0], "y": 0.01, "z":des.pos[1]}
-                   for des in cityModel.destination.values()]
+        destinationPositions = [{"id": f"d_{cityModel.cell_id((x, y))}", "x": x, "y": 0.01, "z":y}
+                   for x, y in cityModel.static_cells(DESTINATION)]
         return jsonify({"positions": destinationPositions})
         
 @app.route('/getObstacles', methods=['GET'])
 def get_obstacles():
-    global cityModel
+    cityModel = current_session().static
     
     if request.method == 'GET':
-        obstaclePositions = [{"id": str(obs.unique_id), "x": obs.pos[0], "y": 0.01, "z":obs.pos[1]}
-                   for obs in cityModel.buidings.values()]
+        obstaclePositions = [{"id": f"ob_{cityModel.cell_id((x, y))}", "x": x, "y": 0.01, "z":y}
+                   for x, y in cityModel.static_cells(OBSTACLE)]
         return jsonify({"positions": obstaclePositions})
 
 @app.route('/update', methods=['GET'])
 def updateModel():
-    global cityModel, current_step
+    session = current_session()
     
     if request.method == 'GET':
-        cityModel.step()
-        current_step += 1
+        # Read once: /stopBuffer can set session.frames to None at any time
+        frames = session.frames
+        if frames is not None:
+            # The frame was computed ahead: the answer doesn't wait for the model, and has the frame.
+            # The wait is outside the lock, which the buffer needs to compute the frame
+            frame = frames.next(FRAME_TIMEOUT)
+            if frame is None:
+                return jsonify({"message": "No frame ready"}), 503
+            with session.lock:
+                session.current_step += 1
+            if session.broadcaster.subscribers:
+                session.broadcaster.publish(frame.step, sse_event(frame.delta, session))
+            return jsonify({"message": "Model Updated", **changes_data(frame.delta, session)})
+        with session.lock:
+            session.step()
+            session.current_step += 1
+            publish_frame(session)
         return jsonify({"message": "Model Updated"})
 
+@app.route('/step', methods=['GET', 'POST'])
+def step_model():
+    """
+    Advances the model "steps" steps and returns the new state of the cars and traffic lights, so
+    the client needs one request per tick instead of /update, /getAgents and /getTrafficLights.
+    The answer has a list of frames with the format of /getAgents?since= that the client applies in
+    order. The first one has the changes since the step "since" (a full snapshot without it), and
+    with frames=1 there is one more frame with the changes of each of the other steps, to interpolate.
+    """
+    session = current_session()
+
+    steps = request.values.get('steps', default=1, type=int)
+    since = request.values.get('since', type=int)
+    run = request.values.get('run')
+    intermediate = request.values.get('frames', default=0, type=int)
+    if not 1 <= steps <= MAX_STEPS:
+        return jsonify({"message": f"steps must be between 1 and {MAX_STEPS}"}), 400
+    
+    with session.lock, session.changing_model():
+        frames = session.advance(steps, since, run, bool(intermediate))
+        session.current_step += steps
+        publish_frame(session)
+    return state_response(frames, lambda: {"step": frames[-1].step,
+                                           "frames": [changes_data(changes, session) for changes in frames]})
+
+@app.route('/startClock', methods=['POST'])
+def start_clock():
+    """
+    Starts stepping the model in the background, "rate" steps per second (0 or nothing for as fast
+    as possible). Each step is pushed to the clients of /stream.
+    """
+    session = current_session()
+    
+    rate = request.values.get('rate', default=0, type=float)
+    if rate < 0:
+        return jsonify({"message": "rate can't be negative"}), 400
+    # The old clock and buffer are replaced with the lock held, so concurrent requests can't leave
+    # two threads stepping the model
+    with session.lock:
+        session.stop_clock(wait=False)
+        session.stop_buffer(wait=False)
+        clock = SimulationClock(session, session.lock, publish_frame, rate=rate or None)
+        clock.start()
+        session.clock = clock
+    return jsonify({"message": "Clock Started", "rate": rate})
+
+@app.route('/stopClock', methods=['POST'])
+def stop_clock():
+    current_session().stop_clock()
+    return jsonify({"message": "Clock Stopped"})
+
+@app.route('/startBuffer', methods=['POST'])
+def start_buffer():
+    """
+    Starts computing up to "frames" steps ahead in the background, so /update answers with a frame
+    that is ready instead of stepping the model. The answers of /update then have the frame, in the
+    format of /getAgents?since=, and /getAgents and /getTrafficLights return the frame the client is at.
+    """
+    session = current_session()
+    
+    capacity = request.values.get('frames', default=BUFFER_FRAMES, type=int)
+    if not 1 <= capacity <= MAX_BUFFER_FRAMES:
+        return jsonify({"message": f"frames must be between 1 and {MAX_BUFFER_FRAMES}"}), 400
+    # Like in /startClock, the clock and the old buffer are replaced with the lock held
+    with session.lock:
+        session.stop_clock(wait=False)
+        session.stop_buffer(wait=False)
+        frames = FrameBuffer(session, capacity)
+        frames.start()
+        session.frames = frames
+    return jsonify({"message": "Buffer Started", "frames": capacity, "step": frames.current.step})
+
+@app.route('/stopBuffer', methods=['POST'])
+def stop_buffer():
+    """Stops the frame buffer. The model goes back to the frame the client is at."""
+    current_session().stop_buffer()
+    return jsonify({"message": "Buffer Stopped"})
+
+@app.route('/setParameters', methods=['POST'])
+def set_parameters():
+    """
+    Changes "spawn_interval" and "light_periods" (a JSON object with the steps between changes of
+    each traffic light character, for example {"S": 10}) of the running model. With the frame buffer
+    on, the frames computed ahead are computed again with the new parameters.
+    """
+    session = current_session()
+    
+    spawn_interval = request.values.get('spawn_interval', type=int)
+    try:
+        light_periods = json.loads(request.values.get('light_periods', 'null'))
+    except ValueError:
+        return jsonify({"message": "light_periods must be a JSON object"}), 400
+    if light_periods is not None and not isinstance(light_periods, dict):
+        return jsonify({"message": "light_periods must be a JSON object"}), 400
+    try:
+        with session.lock, session.changing_model():
+            session.set_parameters(spawn_interval, light_periods)
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
+    return jsonify({"message": "Parameters Changed"})
+
+@app.route('/stream', methods=['GET'])
+def stream():
+    """
+    Server-Sent Events with the frames of the simulation clock, in the format of /getAgents?since=.
+    The first event has the changes since "since" and "run" (a full snapshot without them). A client
+    that reads slower than the clock steps gets the changes up to the newest step instead of every
+    frame it missed.
+    """
+    session = current_session()
+    since = request.args.get('since', type=int)
+    run = request.args.get('run')
+    frames = session.broadcaster
+    
+    def events():
+        with frames.subscription():
+            changes = client_changes(session, since, run)
+            yield sse_event(changes, session)
+            last = changes.step
+            while True:
+                step, frame = frames.wait(last, KEEPALIVE_SECONDS)
+                if frames.closed:
+                    return
+                if step is None or step <= last:
+                    yield ": keepalive\n\n"
+                    continue
+                if step != last + 1:
+                    # Frames were skipped: merge the changes since the last step the client saw
+                    changes = client_changes(session, last)
+                    step, frame = changes.step, sse_event(changes, session)
+                yield frame
+                last = step
+    
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def publish_frame(session):
+    """Sends the changes of the last step of a session to the clients of /stream, if there are any."""
+    frames = session.broadcaster
+    if frames.subscribers:
+        step = session.step_counter
+        frames.publish(step, sse_event(session.changes(step - 1), session))
+
+def sse_event(changes, session):
+    """Server-Sent Event with a frame of state_feed.Changes."""
+    data = json.dumps(changes_data(changes, session), separators=(',', ':'))
+    return f"id: {changes.step}\nevent: frame\ndata: {data}\n\n"
+
+@app.route('/snapshot', methods=['POST'])
+def snapshot():
+    """Saves the state of the model, to go back to it with /restore or to start other sessions from it with /fork."""
+    session = current_session()
+    
+    # With the frame buffer on, the snapshot is of the frame the client is at
+    with session.lock, session.changing_model():
+        snapshotData = session.snapshot()
+    return jsonify({"message": "Snapshot Saved", "snapshot": snapshotData})
+
+@app.route('/getSnapshots', methods=['GET'])
+def get_snapshots():
+    session = current_session()
+    
+    if request.method == 'GET':
+        with session.lock:
+            snapshotData = session.snapshot_list()
+        return jsonify({"data": snapshotData})
+
+@app.route('/restore', methods=['POST'])
+def restore():
+    """Puts the model back in the state of the snapshot "snapshot". The clients of /stream must connect again."""
+    session = current_session()
+    
+    snapshot_id = request.values.get('snapshot')
+    if not snapshot_id:
+        return jsonify({"message": "snapshot is required"}), 400
+    with session.lock, session.changing_model():
+        session.restore(snapshot_id)
+        step = session.step_counter
+    return jsonify({"message": "Snapshot Restored", "step": step})
+
+@app.route('/fork', methods=['POST'])
+def fork():
+    """
+    Creates "count" new sessions that continue from the snapshot "snapshot" of the session (or from a
+    snapshot saved now), independent of it and of each other. With "seed" each fork gets the seed
+    seed + i for its random numbers, so they don't repeat the same future.
+    """
+    session = current_session()
+    
+    snapshot_id = request.values.get('snapshot')
+    count = request.values.get('count', default=1, type=int)
+    seed = request.values.get('seed', type=int)
+    if not 1 <= count <= MAX_FORKS:
+        return jsonify({"message": f"count must be between 1 and {MAX_FORKS}"}), 400
+    with session.lock, session.changing_model():
+        if not snapshot_id:
+            snapshot_id = session.snapshot()["id"]
+        snapshot = session.export_snapshot(snapshot_id)
+    
+    compiled_map = maps.get(session.map_path)
+    forks = []
+    for i in range(count):
+        fork_seed = None if seed is None else seed + i
+        forks.append(sessions.create(lambda new_id: new_session(new_id, session.map_path, compiled_map, snapshot, fork_seed),
+                                     uuid.uuid4().hex))
+    return jsonify({"message": "Session Forked", "snapshot": snapshot_id, "sessions": [fork.id for fork in forks]})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if request.method == 'GET':
+        try:
+            session = current_session()
+        except SessionNotFound:
+            return Response("", mimetype="text/plain; version=0.0.4")
+        with session.lock:
+            text = session.metrics()
+        return Response(text, mimetype="text/plain; version=0.0.4")
+
 
 
 if __name__ == "__main__":
-    app.run(host="localhost", port=8585, debug=True)
-     
+    logging.basicConfig(level=logging.INFO)
+    maps.preload()
+    if workers is not None:
+        atexit.register(workers.stop)
+    app.run(host="localhost", port=8585, debug=True, threaded=True)
+     
\ No newline at end of file
@@ -0,0 +1,212 @@
+#Script con el motor vectorizado de coches: todos los coches se guardan en arreglos de NumPy y se mueven a la vez
+
+import numpy as np
+
+from agent import RED
+
+
+class CarFleet:
+    """
+    All the cars of a CityModel stored as arrays (struct of arrays) and moved in a single pass.
+    Attributes:
+        ids: Unique id of each car
+        cells: Cell of each car, numbered y * width + x like the nodes of RoadGraph
+        destinations: Index of the destination of each car in model.destination_list
+        waiting: Consecutive steps each car has not been able to move
+        tables: Next-hop table of each destination with cars, built with the congestion frozen by the
+            last refresh of the routes and dropped by CityModel.refresh_routes
+        max_rounds: Rounds of moves per step. In the first round cars only move to cells that were free
+            at the start of the step; each extra round lets cars move to cells vacated in the previous one
+    """
+
+    def __init__(self, model, max_rounds=2):
+        """
+        Creates an empty fleet.
+        Args:
+            model: CityModel with a RoadGraph (graph_backend="csr")
+            max_rounds: Rounds of moves per step
+        """
+        self.model = model
+        self.graph = model.graph
+        self.max_rounds = max_rounds
+
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.cells = np.zeros(0, dtype=np.int64)
+        self.destinations = np.zeros(0, dtype=np.int32)
+        self.waiting = np.zeros(0, dtype=np.int32)
+
+        self.destination_cells = np.array(
+            [self.graph.node(d.pos) for d in model.destination_list], dtype=np.int64
+        )
+        # Destinations each spawn point can reach, as indices of model.destination_list
+        self.spawn_destinations = {
+            corner: np.array(
+                [model.destination_ids[d.pos] for d in destinations], dtype=np.int32
+            )
+            for corner, destinations in model.reachable_destinations.items()
+        }
+
+        self.tables = {}
+
+    @property
+    def count(self):
+        return int(self.ids.size)
+
+    def add_cars(self, cells, destinations):
+        """
+        Adds cars to the fleet.
+        Args:
+            cells: Cell of each new car (y * width + x). The cells must be free
+            destinations: Index of the destination of each new car
+        """
+        cells = np.asarray(cells, dtype=np.int64)
+        first_id = self.model.num_agents + 1
+        self.model.num_agents += cells.size
+
+        self.ids = np.concatenate(
+            [self.ids, np.arange(first_id, first_id + cells.size, dtype=np.int64)]
+        )
+        self.cells = np.concatenate([self.cells, cells])
+        self.destinations = np.concatenate(
+            [self.destinations, np.asarray(destinations, dtype=np.int32)]
+        )
+        self.waiting = np.concatenate(
+            [self.waiting, np.zeros(cells.size, dtype=np.int32)]
+        )
+
+        width = self.model.width
+        np.add.at(self.model.occupancy, (cells % width, cells // width), 1)
+        self.update_weights(cells)
+
+    def spawn(self, corners):
+        """
+        Adds one car at each of the given spawn points, with a random destination it can reach.
+        """
+        cells = []
+        destinations = []
+        for corner in corners:
+            options = self.spawn_destinations[corner]
+            cells.append(self.graph.node(corner))
+            destinations.append(options[self.model.random.randrange(options.size)])
+        if cells:
+            self.add_cars(cells, destinations)
+
+    def update_weights(self, cells):
+        """
+        Updates the weights of the edges leaving the given cells: 5 if there is a car in the cell, 1 if not.
+        The edges that changed are added to model.step_changed_edges, which makes the model refresh the
+        routes, and with them the tables of the fleet.
+        """
+        cells = np.unique(cells)
+        width = self.model.width
+        occupied = self.model.occupancy[cells % width, cells // width] > 0
+        edges = self.graph.set_nodes_weight(cells, np.where(occupied, 5, 1))
+        if edges.size:
+            sources = self.graph.edge_sources[edges]
+            targets = self.graph.indices[edges]
+            self.model.step_changed_edges.update(
+                zip(
+                    zip((sources % width).tolist(), (sources // width).tolist()),
+                    zip((targets % width).tolist(), (targets // width).tolist()),
+                )
+            )
+
+    def refresh_tables(self):
+        """
+        Builds the missing tables of destinations that have cars heading to them. The model drops the
+        tables when it refreshes the routes, at most once every route_refresh steps.
+        """
+        destinations = self.model.destination_list
+        for destination in np.unique(self.destinations).tolist():
+            if destination not in self.tables:
+                self.tables[destination] = self.model.build_next_hop_table(
+                    destinations[destination].pos
+                )
+
+    def next_cells(self):
+        """Next cell of every car towards its destination (its own cell if there is no path)."""
+        next_cells = self.cells.copy()
+        order = np.argsort(self.destinations, kind="stable")
+        bounds = np.flatnonzero(np.diff(self.destinations[order])) + 1
+        for group in np.split(order, bounds):
+            if group.size:
+                hops = self.tables[int(self.destinations[group[0]])][self.cells[group]]
+                next_cells[group] = np.where(hops >= 0, hops, self.cells[group])
+        return next_cells
+
+    def step(self):
+        """
+        Moves every car that can move one cell towards its destination.
+
+        Cars stop before red lights and occupied cells. When several cars want the same cell, the car
+        that has waited longer moves, and ties go to the lowest id.
+        """
+        if self.ids.size == 0:
+            return
+        model = self.model
+        width = model.width
+
+        self.refresh_tables()
+        next_cells = self.next_cells()
+        next_x, next_y = next_cells % width, next_cells // width
+        pending = next_cells != self.cells
+        pending &= model.signal_state[next_x, next_y] != RED
+
+        previous_cells = self.cells.copy()
+        moved = np.zeros(self.ids.size, dtype=bool)
+        for _ in range(self.max_rounds):
+            candidates = pending & ~moved
+            candidates &= model.occupancy[next_x, next_y] == 0
+            claims = np.flatnonzero(candidates)
+            if claims.size == 0:
+                break
+
+            order = np.lexsort(
+                (self.ids[claims], -self.waiting[claims], next_cells[claims])
+            )
+            claims = claims[order]
+            targets = next_cells[claims]
+            first = np.ones(claims.size, dtype=bool)
+            first[1:] = targets[1:] != targets[:-1]
+            winners = claims[first]
+
+            old = self.cells[winners]
+            new = next_cells[winners]
+            model.occupancy[old % width, old // width] -= 1
+            model.occupancy[new % width, new // width] += 1
+            self.cells[winners] = new
+            moved[winners] = True
+
+        self.waiting[moved] = 0
+        self.waiting[~moved] += 1
+
+        changed = [previous_cells[moved], self.cells[moved]]
+
+        # Cars that reached their destination leave the fleet
+        arrived = self.cells == self.destination_cells[self.destinations]
+        if arrived.any():
+            cells = self.cells[arrived]
+            model.occupancy[cells % width, cells // width] -= 1
+            model.agents_arrived += int(arrived.sum())
+            changed.append(cells)
+            keep = ~arrived
+            self.ids = self.ids[keep]
+            self.cells = self.cells[keep]
+            self.destinations = self.destinations[keep]
+            self.waiting = self.waiting[keep]
+
+        self.update_weights(np.concatenate(changed))
+
+    def states(self):
+        """
+        Arrays with the id, position and destination position of every car.
+        """
+        width = self.model.width
+        destinations = self.destination_cells[self.destinations]
+        return (
+            self.ids,
+            self.cells % width,
+            self.cells // width,
+            destinations % width,
+            destinations // width,
+        )
@@ -0,0 +1,266 @@
+#Script con el reloj que avanza el modelo en segundo plano y reparte el último cuadro a los clientes conectados
+
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FrameBroadcaster:
+    """
+    Keeps only the newest frame and wakes up every subscriber waiting for it. A subscriber that is
+    slower than the clock skips the frames it missed instead of accumulating them.
+    Attributes:
+        step: Step of the newest frame (None before the first one)
+        frame: Newest frame, in the format chosen by whoever publishes it
+        closed: Whether the subscribers must stop (for example because a new model was created)
+        subscribers: Number of subscribers, so frames are only made when someone reads them
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.step = None
+        self.frame = None
+        self.closed = False
+        self.subscribers = 0
+
+    @contextlib.contextmanager
+    def subscription(self):
+        with self._condition:
+            self.subscribers += 1
+        try:
+            yield self
+        finally:
+            with self._condition:
+                self.subscribers -= 1
+
+    def publish(self, step, frame):
+        with self._condition:
+            self.step = step
+            self.frame = frame
+            self._condition.notify_all()
+
+    def wait(self, after, timeout=None):
+        """
+        Waits until there is a frame of a step after the step after, or until timeout seconds passed.
+        Returns the step and the frame, which is not newer than after on a timeout.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.closed or (self.step is not None and self.step > after),
+                timeout,
+            )
+            return self.step, self.frame
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class SimulationClock:
+    """
+    Background thread that steps a model by itself, so the simulation doesn't depend on how often
+    the clients ask for updates.
+    Attributes:
+        model: CityModel to step
+        lock: Lock held while the model is stepped, shared with whoever else reads or steps the model
+        on_step: Function called with the model after every step, while the lock is held
+        rate: Steps per second, or None to step as fast as possible
+    """
+
+    def __init__(self, model, lock, on_step, rate=None):
+        self.model = model
+        self.lock = lock
+        self.on_step = on_step
+        self.rate = rate
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="simulation-clock", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """
+        Stops the thread. With wait=False it only asks the thread to stop, so it can be called with the
+        lock held: the thread checks the request with the lock before each step, so it doesn't step the
+        model again.
+        """
+        self._stop.set()
+        if not wait:
+            return
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                with self.lock:
+                    if self._stop.is_set():
+                        return
+                    self.model.step()
+                    self.on_step(self.model)
+            except Exception:
+                logger.exception("The simulation clock stopped")
+                return
+            if not self.rate:
+                continue
+            # A clock that falls behind continues from now instead of running the missed steps in a burst
+            next_tick = max(next_tick + 1 / self.rate, time.monotonic())
+            self._stop.wait(next_tick - time.monotonic())
+
+
+class BufferedFrame:
+    """
+    Frame of a FrameBuffer.
+    Attributes:
+        step: Step of the model
+        delta: state_feed.Changes since the step before
+        full: state_feed.Changes with every car and light
+        snapshot: snapshots.Snapshot of the model, to compute the frames after this one again
+    """
+
+    def __init__(self, step, delta, full, snapshot):
+        self.step = step
+        self.delta = delta
+        self.full = full
+        self.snapshot = snapshot
+
+
+class FrameBuffer:
+    """
+    Frames of a session computed ahead by a background thread, so a client that plays the simulation
+    forward only moves a cursor (next) instead of waiting for the model to step. The model runs up to
+    capacity steps ahead of the client. Whoever changes the model must hold the lock of the session
+    and call rewind before and resync after (see Session.changing_model), so the frames computed
+    ahead are computed again from the frame the client has.
+    Attributes:
+        session: sessions.Session whose model is stepped
+        capacity: Maximum number of frames computed ahead
+        current: BufferedFrame the client is at
+        failed: Whether the thread stopped because stepping the model failed
+    """
+
+    def __init__(self, session, capacity):
+        self.session = session
+        self.capacity = capacity
+        self.failed = False
+        self._frames = collections.deque()
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        with session.lock:
+            self.current = self._capture()
+
+    @property
+    def ahead(self):
+        """Number of frames computed ahead of the client."""
+        return len(self._frames)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="frame-buffer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """
+        Stops the thread and puts the model back in the state of the current frame. The thread checks
+        the request with the lock of the session held before each step, so with wait=False this can be
+        called with the lock held. With wait=True it then waits for the thread, which may be waiting
+        for the lock. Only the first call rewinds the model.
+        """
+        with self._condition:
+            stopping = not self._stop.is_set()
+            self._stop.set()
+            self._condition.notify_all()
+        if stopping:
+            with self.session.lock:
+                self.rewind()
+        if not wait:
+            return
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def next(self, timeout=None):
+        """
+        Moves the cursor to the next frame and returns it, waiting for it if the thread is behind.
+        Returns None if there is no frame after timeout seconds or the thread stopped.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._frames or self.failed or self._stop.is_set(), timeout
+            )
+            if not self._frames:
+                return None
+            self.current = self._frames.popleft()
+            self._condition.notify_all()
+            return self.current
+
+    def rewind(self):
+        """
+        Drops the frames computed ahead and puts the model back in the state of the current frame.
+        Called with the lock of the session held.
+        """
+        with self._condition:
+            self._frames.clear()
+            self._condition.notify_all()
+        if self.session.step_counter != self.current.step:
+            self.session.rewind(self.current.snapshot)
+
+    def resync(self):
+        """
+        Makes the state of the model the current frame, after it was changed outside of the buffer.
+        Called with the lock of the session held.
+        """
+        with self._condition:
+            self._frames.clear()
+            self.current = self._capture()
+            self._condition.notify_all()
+
+    def _capture(self):
+        session = self.session
+        step = session.step_counter
+        return BufferedFrame(
+            step, session.changes(step - 1), session.changes(), session.checkpoint()
+        )
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._stop.is_set() or len(self._frames) < self.capacity
+                )
+            try:
+                # The frame is added with the lock of the session held, so a rewind can't come between
+                with self.session.lock:
+                    if self._stop.is_set():
+                        return
+                    self.session.step()
+                    frame = self._capture()
+                    with self._condition:
+                        self._frames.append(frame)
+                        self._condition.notify_all()
+            except Exception:
+                logger.exception("The frame buffer stopped")
+                with self._condition:
+                    self.failed = True
+                    self._condition.notify_all()
+                return
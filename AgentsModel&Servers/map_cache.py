@@ -0,0 +1,239 @@
+#Script que guarda en disco los mapas ya procesados (capas, grafo e índice de destinos) para no volver a calcularlos
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from city_map import (
+    DESTINATION,
+    EMPTY,
+    OBSTACLE,
+    build_edges,
+    classify_cells,
+    load_city_map,
+)
+from road_graph import RoadGraph
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Carpeta del caché. La variable de ambiente MAP_CACHE_DIR la cambia
+CACHE_DIR = os.environ.get("MAP_CACHE_DIR", os.path.join(BASE_DIR, ".map_cache"))
+# Cambiar cuando cambie lo que calcula compile_map, para que no se usen entradas viejas
+CACHE_VERSION = 1
+# Entradas que se conservan; las que se usaron hace más tiempo se borran
+MAX_ENTRIES = 32
+
+
+class CompiledMap:
+    """
+    Everything CityModel derives from a map file and the map dictionary before it places any agent.
+    Attributes:
+        width, height: Size of the map
+        city_map: Character of each cell, indexed [x, y]
+        kinds, directions: Static layers from city_map.classify_cells
+        edge_sources, edge_targets, edge_directions: Edges from city_map.build_edges
+        graph: Arrays of the RoadGraph of the map (see RoadGraph.arrays), stored with a "graph_" prefix
+        corners: The four corners of the map, in the order CityModel tries them as spawn points
+        corner_destinations: Whether each destination (in the order of static_cells) can be reached
+            from each corner, without counting a destination on the corner itself
+    """
+
+    def __init__(self, width, height, arrays):
+        self.width = width
+        self.height = height
+        self.city_map = arrays["city_map"]
+        self.kinds = arrays["kinds"]
+        self.directions = arrays["directions"]
+        self.edge_sources = arrays["edge_sources"]
+        self.edge_targets = arrays["edge_targets"]
+        self.edge_directions = arrays["edge_directions"]
+        self.corner_destinations = arrays["corner_destinations"]
+        self.graph = {name: arrays[f"graph_{name}"] for name in RoadGraph.ARRAYS}
+        self.corners = [
+            (0, 0),
+            (0, height - 1),
+            (width - 1, 0),
+            (width - 1, height - 1),
+        ]
+
+    def arrays(self):
+        return {
+            "city_map": self.city_map,
+            "kinds": self.kinds,
+            "directions": self.directions,
+            "edge_sources": self.edge_sources,
+            "edge_targets": self.edge_targets,
+            "edge_directions": self.edge_directions,
+            "corner_destinations": self.corner_destinations,
+            **{f"graph_{name}": array for name, array in self.graph.items()},
+        }
+
+    def road_graph(self):
+        """New RoadGraph of the map, with its own weights."""
+        return RoadGraph.from_arrays(self.width, self.height, self.graph)
+
+    def problems(self):
+        """
+        Reasons why the map can't be simulated well: no corner to create cars, no destinations, or
+        destinations that no corner reaches. Returns an empty list if there are none.
+        """
+        problems = []
+        spawn_points = [
+            corner
+            for corner in self.corners
+            if self.kinds[corner] not in (EMPTY, OBSTACLE)
+        ]
+        if not spawn_points:
+            problems.append("no corner of the map is a road")
+        if not self.corner_destinations.shape[1]:
+            problems.append("the map has no destinations")
+        unreachable = int(np.count_nonzero(~self.corner_destinations.any(axis=0)))
+        if spawn_points and unreachable:
+            problems.append(
+                f"{unreachable} destinations can't be reached from any corner"
+            )
+        return problems
+
+    def freeze(self):
+        """Makes the arrays read-only, so a map shared by several models can't be changed by one of them."""
+        for array in self.arrays().values():
+            array.flags.writeable = False
+        return self
+
+    def save(self, directory):
+        """Writes the map to a directory: one .npy file per array and a JSON file with the size."""
+        os.makedirs(directory, exist_ok=True)
+        for name, array in self.arrays().items():
+            np.save(os.path.join(directory, f"{name}.npy"), np.asarray(array))
+        with open(os.path.join(directory, "map.json"), "w") as info:
+            json.dump({"width": self.width, "height": self.height}, info)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """Reads a map written by save. The arrays are memory-mapped and read-only."""
+        with open(os.path.join(directory, "map.json")) as info:
+            size = json.load(info)
+        names = ["city_map", "kinds", "directions", "edge_sources", "edge_targets"]
+        names += ["edge_directions", "corner_destinations"]
+        names += [f"graph_{name}" for name in RoadGraph.ARRAYS]
+        arrays = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in names
+        }
+        return cls(size["width"], size["height"], arrays)
+
+
+def compile_map(lines, dataDictionary):
+    """
+    Parses the lines of a map file and builds its layers, edges, graph and destination index.
+    Raises ValueError if the map is empty or its rows have different lengths.
+    """
+    rows = [line.rstrip("\n") for line in lines]
+    if not rows or not rows[0]:
+        raise ValueError("The map is empty")
+    if any(len(row) != len(rows[0]) for row in rows):
+        raise ValueError("The rows of the map have different lengths")
+    width = len(rows[0])
+    height = len(rows)
+    city_map = load_city_map(lines)
+    kinds, directions = classify_cells(city_map, dataDictionary)
+    sources, targets, edge_directions = build_edges(kinds, directions)
+    graph = RoadGraph.from_city_edges(kinds, sources, targets, edge_directions)
+
+    destinations = np.argwhere(kinds == DESTINATION)
+    destination_nodes = destinations[:, 1] * width + destinations[:, 0]
+    corners = [(0, 0), (0, height - 1), (width - 1, 0), (width - 1, height - 1)]
+    corner_destinations = np.zeros((len(corners), len(destinations)), dtype=bool)
+    for i, corner in enumerate(corners):
+        if kinds[corner] in (EMPTY, OBSTACLE):
+            continue
+        reached = graph.reachable(graph.node(corner))
+        # A car can't arrive to the cell where it was created
+        reached[graph.node(corner)] = False
+        corner_destinations[i] = reached[destination_nodes]
+
+    arrays = {
+        "city_map": city_map,
+        "kinds": kinds,
+        "directions": directions,
+        "edge_sources": sources,
+        "edge_targets": targets,
+        "edge_directions": edge_directions,
+        "corner_destinations": corner_destinations,
+        **{f"graph_{name}": array for name, array in graph.arrays().items()},
+    }
+    return CompiledMap(width, height, arrays)
+
+
+def cache_key(*paths):
+    """Hash of the contents of the files (and of CACHE_VERSION)."""
+    digest = hashlib.sha256(f"version {CACHE_VERSION}".encode())
+    for path in paths:
+        with open(path, "rb") as source:
+            digest.update(hashlib.sha256(source.read()).digest())
+    return digest.hexdigest()
+
+
+def load_map(map_path, dictionary_path, dataDictionary, cache_dir=None):
+    """
+    Compiled map of a map file. It is read from the cache when the map file and the dictionary didn't
+    change, and compiled and stored in the cache otherwise.
+    Args:
+        map_path, dictionary_path: Files the compiled map depends on
+        dataDictionary: Contents of the dictionary, used to compile the map
+        cache_dir: Folder of the cache (CACHE_DIR by default). False compiles without the cache
+    """
+    if cache_dir is False:
+        with open(map_path) as map_file:
+            return compile_map(map_file.readlines(), dataDictionary)
+
+    cache_dir = cache_dir or CACHE_DIR
+    directory = os.path.join(cache_dir, cache_key(map_path, dictionary_path))
+    if os.path.isdir(directory):
+        try:
+            compiled = CompiledMap.load(directory)
+            os.utime(directory)
+            return compiled
+        except (OSError, ValueError, KeyError) as error:
+            logger.warning("Ignoring damaged map cache %s: %s", directory, error)
+            shutil.rmtree(directory, ignore_errors=True)
+
+    with open(map_path) as map_file:
+        compiled = compile_map(map_file.readlines(), dataDictionary)
+    try:
+        _store(compiled, cache_dir, directory)
+    except OSError as error:
+        logger.warning("Could not write the map cache: %s", error)
+    return compiled
+
+
+def _store(compiled, cache_dir, directory):
+    """Writes a compiled map to a temporary folder and renames it, so readers never see half an entry."""
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp-")
+    try:
+        compiled.save(temporary)
+        os.replace(temporary, directory)
+    except OSError:
+        # Another process stored the same entry first
+        shutil.rmtree(temporary, ignore_errors=True)
+        if not os.path.isdir(directory):
+            raise
+    _prune(cache_dir)
+
+
+def _prune(cache_dir):
+    entries = [
+        os.path.join(cache_dir, name)
+        for name in os.listdir(cache_dir)
+        if not name.startswith(".")
+    ]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for entry in entries[MAX_ENTRIES:]:
+        shutil.rmtree(entry, ignore_errors=True)
@@ -0,0 +1,209 @@
+#Script que genera mapas de ciudades de cualquier tamaño con el formato de mapDictionary.json y revisa que estén conectados
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from city_map import (
+    DESTINATION,
+    EMPTY,
+    OBSTACLE,
+    build_edges,
+    classify_cells,
+    load_city_map,
+)
+from road_graph import RoadGraph
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Intersection glyph for each pair of (horizontal, vertical) street directions
+INTERSECTIONS = {
+    (">", "^"): "%",
+    ("<", "^"): "$",
+    (">", "v"): "*",
+    ("<", "v"): "&",
+}
+
+
+def generate_grid(
+    blocks_x,
+    blocks_y=None,
+    block_size=6,
+    destinations=16,
+    light_spacing=2,
+    seed=0,
+):
+    """
+    Lines of a map with a grid of blocks_x x blocks_y city blocks separated by one-way streets.
+    The streets of the border form a ring and the other streets alternate directions. They meet at intersections with diagonal glyphs
+    (%, $, *, &), so a car can turn from any street into the crossing one. The map is checked with
+    check_connectivity before it is returned.
+    Args:
+        blocks_x, blocks_y: Number of blocks in each direction (blocks_y defaults to blocks_x)
+        block_size: Cells between two parallel streets, including one of the streets
+        destinations: Number of "D" cells, placed inside the blocks next to a street
+        light_spacing: A traffic light is put before every light_spacing-th intersection of each
+            street ("s" on horizontal streets, "S" on vertical ones). 0 means no lights
+        seed: Seed of the positions of the destinations
+    """
+    if blocks_y is None:
+        blocks_y = blocks_x
+    if block_size < 3:
+        raise ValueError("block_size must be at least 3")
+
+    rng = np.random.default_rng(seed)
+    width = blocks_x * block_size + 1
+    height = blocks_y * block_size + 1
+    rows = [["#"] * width for _ in range(height)]
+
+    # The streets on the border form a counter-clockwise ring, and the streets in between alternate
+    # directions. Every street starts and ends on the ring, so every cell can reach every other one.
+    # Rows of the file go from the top of the map.
+    horizontal = _street_directions(range(0, height, block_size), "<", ">")
+    vertical = _street_directions(range(0, width, block_size), "v", "^")
+    for r, direction in horizontal.items():
+        rows[r] = [direction] * width
+    for c, direction in vertical.items():
+        for r in range(height):
+            if r in horizontal:
+                rows[r][c] = INTERSECTIONS[(horizontal[r], direction)]
+            else:
+                rows[r][c] = direction
+
+    # Lights two cells before the intersections, so the cell just before each intersection is a road
+    if light_spacing:
+        for r, direction in horizontal.items():
+            step = 1 if direction == ">" else -1
+            for c in list(vertical)[1::light_spacing]:
+                if 0 <= c - 2 * step < width and rows[r][c - 2 * step] == direction:
+                    rows[r][c - 2 * step] = "s"
+        for c, direction in vertical.items():
+            step = -1 if direction == "^" else 1
+            for r in list(horizontal)[1::light_spacing]:
+                if 0 <= r - 2 * step < height and rows[r - 2 * step][c] == direction:
+                    rows[r - 2 * step][c] = "S"
+
+    # Destinations inside the blocks, next to a street
+    candidates = [
+        (r, c)
+        for r in range(1, height - 1)
+        for c in range(1, width - 1)
+        if rows[r][c] == "#"
+        and (
+            r - 1 in horizontal
+            or r + 1 in horizontal
+            or c - 1 in vertical
+            or c + 1 in vertical
+        )
+    ]
+    if destinations > len(candidates):
+        raise ValueError(f"The map only has room for {len(candidates)} destinations")
+    for i in rng.choice(len(candidates), size=destinations, replace=False).tolist():
+        r, c = candidates[i]
+        rows[r][c] = "D"
+
+    lines = ["".join(row) + "\n" for row in rows]
+    problems = check_connectivity(lines)
+    if problems:
+        raise ValueError(f"The generated map is not connected: {problems[:5]}")
+    return lines
+
+
+def _street_directions(positions, first, last):
+    """Direction of each street: alternating, starting with first, and the last street always last."""
+    directions = {
+        position: first if k % 2 == 0 else last for k, position in enumerate(positions)
+    }
+    directions[positions[-1]] = last
+    return directions
+
+
+def load_dictionary():
+    with open(os.path.join(BASE_DIR, "city_files", "mapDictionary.json")) as dictionary:
+        return json.load(dictionary)
+
+
+def check_connectivity(lines, dataDictionary=None, all_roads=False):
+    """
+    Checks that every destination of a map can be reached from every spawn point (the corners of the
+    map that are roads). With all_roads=True every road cell must reach every destination.
+    Returns a list of problems, empty if the map is connected.
+    """
+    if dataDictionary is None:
+        dataDictionary = load_dictionary()
+    city_map = load_city_map(lines)
+    kinds, directions = classify_cells(city_map, dataDictionary)
+    width, height = kinds.shape
+    graph = RoadGraph.from_city_edges(kinds, *build_edges(kinds, directions))
+
+    corners = [(0, 0), (0, height - 1), (width - 1, 0), (width - 1, height - 1)]
+    spawn_points = [
+        corner for corner in corners if kinds[corner] not in (EMPTY, OBSTACLE)
+    ]
+    problems = []
+    if not spawn_points:
+        problems.append("no corner of the map is a road")
+
+    destinations = [
+        tuple(position) for position in np.argwhere(kinds == DESTINATION).tolist()
+    ]
+    if not destinations:
+        problems.append("the map has no destinations")
+
+    destination_nodes = [graph.node(d) for d in destinations]
+    for corner in spawn_points:
+        reached = graph.reachable(graph.node(corner))
+        for destination, node in zip(destinations, destination_nodes):
+            if not reached[node]:
+                problems.append(
+                    f"destination {destination} can't be reached from {corner}"
+                )
+
+    if all_roads:
+        roads = graph.is_node.copy()
+        roads[destination_nodes] = False
+        for destination, node in zip(destinations, destination_nodes):
+            # Cells that can reach the destination
+            missing = np.flatnonzero(roads & ~graph.reachable(node, reverse=True))
+            if missing.size:
+                problems.append(
+                    f"destination {destination} can't be reached from {missing.size} cells, "
+                    f"like {graph.position(int(missing[0]))}"
+                )
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generates a city map with a grid of one-way streets"
+    )
+    parser.add_argument("blocks_x", type=int)
+    parser.add_argument("blocks_y", type=int, nargs="?")
+    parser.add_argument("--block-size", type=int, default=6)
+    parser.add_argument("--destinations", type=int, default=16)
+    parser.add_argument("--light-spacing", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "-o", "--output", help="Map file (by default the map is printed)"
+    )
+    args = parser.parse_args()
+
+    lines = generate_grid(
+        args.blocks_x,
+        args.blocks_y,
+        args.block_size,
+        args.destinations,
+        args.light_spacing,
+        args.seed,
+    )
+    if args.output:
+        with open(args.output, "w") as map_file:
+            map_file.writelines(lines)
+    else:
+        print("".join(lines), end="")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#Script que mantiene en memoria los mapas compilados para que crear un modelo de cualquier mapa conocido sea inmediato
+
+import glob
+import json
+import logging
+import os
+
+from map_cache import load_map
+from model import BASE_DIR, DEFAULT_MAP, DICTIONARY_PATH, resolve_map_path
+
+logger = logging.getLogger(__name__)
+
+
+class MapRegistry:
+    """
+    Compiled maps kept in memory by the path of their file, to pass them to CityModel(compiled_map=...).
+    A map is compiled again (or read from the cache on disk) when its file or the map dictionary change.
+    Attributes:
+        directory: Folder of the maps that clients can open (see known_path), city_files by default
+        cache_dir: Folder of the cache on disk, passed to map_cache.load_map
+        maps: (modification times, CompiledMap) of each map, by path
+        problems: Problems found by preload in each map, by name
+    """
+
+    def __init__(self, directory=None, cache_dir=None):
+        self.directory = directory or os.path.join(BASE_DIR, "city_files")
+        self.cache_dir = cache_dir
+        self.maps = {}
+        self.problems = {}
+
+    def known_path(self, map_path):
+        """
+        Path of the map of directory with the same file name as map_path (the default map for None),
+        so clients can only open those maps. Raises FileNotFoundError for any other name.
+        """
+        name = os.path.basename(map_path or DEFAULT_MAP)
+        path = os.path.join(self.directory, name)
+        if not name.endswith(".txt") or not os.path.isfile(path):
+            raise FileNotFoundError(f"Unknown map: {map_path}")
+        return path
+
+    def get(self, map_path):
+        """Compiled map of a map file (any path accepted by resolve_map_path)."""
+        path = os.path.abspath(resolve_map_path(map_path))
+        stamp = (os.stat(path).st_mtime_ns, os.stat(DICTIONARY_PATH).st_mtime_ns)
+        entry = self.maps.get(path)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+
+        with open(DICTIONARY_PATH) as dictionary:
+            dataDictionary = json.load(dictionary)
+        compiled = load_map(
+            path, DICTIONARY_PATH, dataDictionary, cache_dir=self.cache_dir
+        ).freeze()
+        self.maps[path] = (stamp, compiled)
+        return compiled
+
+    def preload(self, directory=None):
+        """
+        Compiles every map of a folder (directory by default) and checks it with CompiledMap.problems.
+        Maps that can't be read are left out. Returns the names of the maps that were loaded.
+        """
+        directory = directory or self.directory
+        loaded = []
+        for path in sorted(glob.glob(os.path.join(directory, "*.txt"))):
+            name = os.path.basename(path)
+            try:
+                problems = self.get(path).problems()
+            except (OSError, ValueError, IndexError) as error:
+                logger.warning("Map %s can't be loaded: %s", name, error)
+                self.problems[name] = [str(error)]
+                continue
+            loaded.append(name)
+            self.problems[name] = problems
+            for problem in problems:
+                logger.warning("Map %s: %s", name, problem)
+        logger.info("Loaded %d maps: %s", len(loaded), ", ".join(loaded))
+        return loaded
+
+    def names(self):
+        return sorted(os.path.basename(path) for path in self.maps)
@@ -5,8 +5,45 @@ from mesa.time import RandomActivation
 from mesa.space import MultiGrid
 from mesa.datacollection import DataCollector
 from agent import *
+from city_map import DESTINATION, DIRECTIONS, EMPTY, OBSTACLE, TRAFFIC_LIGHT
+from fleet import CarFleet
+from map_cache import load_map
+from profiling import StepProfiler
+from snapshots import Snapshot
+from state_feed import StateFeed
+from telemetry import get_sender
+from traffic_lights import TrafficLightController, stop_line_groups
 import json
-import requests
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Carpeta de este script, para encontrar city_files sin depender del directorio de trabajo
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MAP = os.path.join("city_files", "2023_base.txt")
+DICTIONARY_PATH = os.path.join(BASE_DIR, "city_files", "mapDictionary.json")
+# Pasos mínimos entre reconstrucciones de las tablas de siguiente salto cuando cambia la congestión
+ROUTE_REFRESH = 5
+
+
+def resolve_map_path(map_path):
+    """
+    Finds a map file. The path can be absolute, relative to the working directory, relative to this
+    folder (with or without a leading "/", as in the old model_params), or the name of a map in city_files.
+    """
+    if map_path is None:
+        map_path = DEFAULT_MAP
+    candidates = [
+        map_path,
+        os.path.join(BASE_DIR, map_path.lstrip("/")),
+        os.path.join(BASE_DIR, "city_files", os.path.basename(map_path)),
+    ]
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return candidate
+    raise FileNotFoundError(f"Map file not found: {map_path}")
 
 
 class CityModel(Model):
@@ -15,598 +52,584 @@ class CityModel(Model):
 
     Args:
         N: Number of agents in the simulation
+        map_path: Map file to load (see resolve_map_path). By default city_files/2023_base.txt
+        graph_backend: "networkx" to keep the road graph in a networkx DiGraph, or "csr" to use the
+            compact RoadGraph arrays
+        engine: "agents" to move each car as a mesa agent, or "vectorized" to move all the cars at once
+            with a CarFleet (always uses the "csr" graph backend)
+        light_periods: Steps between changes for each traffic light character, replacing the ones of
+            mapDictionary.json (for example {"S": 10, "s": 5})
+        spawn_interval: Steps between the creation of new cars at the corners
+        telemetry: Whether to send the number of arrived cars to the server of the class. The reports are
+            sent from a background thread (see telemetry.TelemetrySender)
+        telemetry_endpoint: URL for the reports. By default the TELEMETRY_URL environment variable or the
+            server of the class; TELEMETRY_URL=off disables the reports
+        map_cache: Whether to read and store the compiled map in the cache on disk (see map_cache), or
+            the folder of the cache to use
+        compiled_map: Compiled map of map_path that is already loaded (see map_registry.MapRegistry).
+            It is shared, not copied, so the model must not change its arrays
+        state_history: Steps of changes kept for clients that ask for the changes since the last step
+            they saw (see state_feed.StateFeed). 0 doesn't keep them
+        profile: Whether to measure the time of each phase of the step (see profiling.StepProfiler)
+        next_hop_routing: Whether the cars of the "agents" engine follow the next-hop tables of their
+            destinations. Otherwise each car plans and caches its own A* route (see Car.plan_route)
+        route_refresh: Minimum steps between rebuilds of the next-hop tables (see refresh_routes)
+        seed: Seed of the random number generator of the model (used by mesa.Model)
     """
 
-    def __init__(self, map_path):
+    def __init__(
+        self,
+        map_path=None,
+        graph_backend="networkx",
+        engine="agents",
+        light_periods=None,
+        spawn_interval=1,
+        telemetry=True,
+        telemetry_endpoint=None,
+        map_cache=True,
+        compiled_map=None,
+        state_history=0,
+        profile=False,
+        next_hop_routing=True,
+        route_refresh=ROUTE_REFRESH,
+        seed=None,
+    ):
         # Load the map dictionary. The dictionary maps the characters in the map file to the corresponding agent.
-        dataDictionary = json.load(open("city_files/mapDictionary.json"))
+        dataDictionary = json.load(open(DICTIONARY_PATH))
+        for char, period in (light_periods or {}).items():
+            if not isinstance(dataDictionary.get(char), int):
+                raise ValueError(
+                    f"{char!r} is not a traffic light of the map dictionary"
+                )
+            dataDictionary[char] = int(period)
+        self.spawn_interval = spawn_interval
+        self.profiler = StepProfiler(profile)
+        self.telemetry = (
+            get_sender(telemetry_endpoint, latest_only=True) if telemetry else None
+        )
         self.traffic_lights = []
 
         self.cars = {}
-        self.road = {}
         self.traffic_lights1 = {}
         self.destination = {}
-        self.buidings = {}
         self.agents_arrived = 0
         self.step_counter = 0
 
-        # Load the map file. The map file is a text file where each character represents an agent.
-        with open("city_files/2023_base.txt") as baseFile:
-            lines = baseFile.readlines()
-            self.width = len(lines[0]) - 1
-            self.height = len(lines)
-
-            self.grid = MultiGrid(self.width, self.height, torus=False)
-            self.schedule = RandomActivation(self)
-
-            corners = [
-                (0, 0),
-                (0, self.height - 1),
-                (self.width - 1, 0),
-                (self.width - 1, self.height - 1),
-            ]
-
-            # Goes through each character in the map file and creates the corresponding agent.
-            for r, row in enumerate(lines):
-                for c, col in enumerate(row):
-                    if col in ["v", "^", ">", "<", "$", "%", "&", "*"]:
-                        agent = Road(f"r_{r*self.width+c}", self, dataDictionary[col])
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                        self.schedule.add(agent)
-
-                    elif col in ["S", "s"]:
-                        agent = Traffic_Light(
-                            f"tl_{r*self.width+c}",
-                            self,
-                            False if col == "S" else True,
-                            int(dataDictionary[col]),
-                        )
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                        self.schedule.add(agent)
-                        self.traffic_lights.append(agent)
-
-                    elif col == "#":
-                        agent = Obstacle(f"ob_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                        self.schedule.add(agent)
-
-                    elif col == "D":
-                        agent = Destination(f"d_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                        self.schedule.add(agent)
-
-            self.create_graph()
-
-            for i, pos in enumerate(corners):
-                Agent = Car(i + 1000, self, self.graph)
-                self.schedule.add(Agent)
-                self.grid.place_agent(Agent, pos)
+        self.engine = engine
+        if engine == "vectorized":
+            graph_backend = "csr"
+        self.graph_backend = graph_backend
+        self.map_path = resolve_map_path(map_path)
+
+        # Next-hop tables per destination, built lazily with the congestion of the last refresh of the
+        # routes. The tables are dropped when the routes are refreshed
+        self.next_hop_routing = next_hop_routing
+        self.route_refresh = route_refresh
+        self.next_hop_tables = {}
+        self.weights_version = 0
+        self.last_route_refresh = 0
+
+        # Edges whose congestion weight changed in the previous step, as (cell, neighbour) pairs, for the
+        # routers to check; the ones changed so far in the current step; and whether any weight changed
+        # since the last refresh of the routes
+        self.changed_edges = set()
+        self.step_changed_edges = set()
+        self.routes_dirty = False
 
+        # Load the map file. The map file is a text file where each character represents an agent.
+        # The layers, the graph and the destination index of the map are compiled once and kept in a
+        # cache on disk (see map_cache), keyed by the contents of the map file and the dictionary.
+        if compiled_map is not None:
+            self.compiled = compiled_map
+        else:
+            if isinstance(map_cache, str):
+                cache_dir = map_cache
+            else:
+                cache_dir = None if map_cache else False
+            self.compiled = load_map(
+                self.map_path, DICTIONARY_PATH, dataDictionary, cache_dir=cache_dir
+            )
+        self.width = self.compiled.width
+        self.height = self.compiled.height
+        # Plain array over the memory map: reading single cells from a np.memmap is slower
+        self.city_map = np.asarray(self.compiled.city_map)
+
+        self.grid = MultiGrid(self.width, self.height, torus=False)
+        self.schedule = RandomActivation(self)
+
+        # Static layers of the map. Roads, obstacles and destinations never change, so they are
+        # kept in arrays instead of being agents in the grid and the schedule.
+        self.cell_kinds = self.compiled.kinds
+        self.road_directions = self.compiled.directions
+        self.destination_ids = np.full((self.width, self.height), -1, dtype=np.int32)
+
+        # Dynamic layers: number of cars in each cell and state of the traffic light in each cell
+        self.occupancy = np.zeros((self.width, self.height), dtype=np.int32)
+        self.signal_state = np.full((self.width, self.height), NO_SIGNAL, dtype=np.int8)
+
+        # Traffic lights are agents in the grid so they can be drawn, but they are not in the
+        # schedule: the controller changes all of them at once.
+        light_positions = self.static_cells(TRAFFIC_LIGHT)
+        light_chars = [self.city_map[x, y] for x, y in light_positions]
+        self.light_chars = light_chars
+        for (x, y), col in zip(light_positions, light_chars):
+            agent = Traffic_Light(
+                f"tl_{self.cell_id((x, y))}",
+                self,
+                False if col == "S" else True,
+                int(dataDictionary[col]),
+            )
+            self.grid.place_agent(agent, (x, y))
+            self.traffic_lights.append(agent)
+            self.traffic_lights1[agent.unique_id] = agent
+
+        self.traffic_light_controller = TrafficLightController(
+            light_positions,
+            [light.timeToChange for light in self.traffic_lights],
+            [light.state for light in self.traffic_lights],
+            groups=stop_line_groups(light_positions, light_chars),
+            signal_layer=self.signal_state,
+        )
+        for i, light in enumerate(self.traffic_lights):
+            light.controller = self.traffic_light_controller
+            light.index = i
+
+        # Destinations are kept as objects so cars can reference them, but they are not in the grid.
+        for x, y in self.static_cells(DESTINATION):
+            agent = Destination(f"d_{self.cell_id((x, y))}", self)
+            agent.pos = (x, y)
+            self.destination_ids[x, y] = len(self.destination)
+            self.destination[agent.unique_id] = agent
+
+        self.create_graph()
+        self.index_destinations()
+
+        if engine == "vectorized":
+            self.num_agents = 999
+            self.fleet = CarFleet(self)
+            self.fleet.spawn([tuple(pos) for pos in self.spawn_points.T.tolist()])
+        else:
+            self.fleet = None
+            for i, pos in enumerate(self.spawn_points.T.tolist()):
+                Agent = Car(i + 1000, self, self.graph, origin=tuple(pos))
+                self.place_car(Agent, tuple(pos))
             self.num_agents = 1004
+        self.refresh_routes()
 
-            for agents, (x, y) in self.grid.coord_iter():
-                for agent in agents:
-                    if isinstance(agent, Car):
-                        self.cars[agent.unique_id] = agent
-                        # print(cars[agent.unique_id].unique_id, cars[agent.unique_id].pos, cars[agent.unique_id].destination)
-                    elif isinstance(agent, Road):
-                        self.road[agent.unique_id] = agent
-                        # print(agent.unique_id, agent.pos, agent.direction)
-                    elif isinstance(agent, Traffic_Light):
-                        self.traffic_lights1[agent.unique_id] = agent
-                        # print(agent.unique_id, agent.pos, agent.state)
-                    elif isinstance(agent, Destination):
-                        self.destination[agent.unique_id] = agent
-                        # print(agent.unique_id, agent.pos)
-                    elif isinstance(agent, Obstacle):
-                        self.buidings[agent.unique_id] = agent
-                        # print(agent.unique_id, agent.pos)
-
+        self.state_feed = StateFeed(self, state_history) if state_history else None
+        # One collector per model: as a class attribute it was shared by every model of the process
+        self.dataCollector = DataCollector(
+            model_reporters={"Car Count": "car_count"}, agent_reporters={}
+        )
         self.running = True
 
     def create_graph(self):
         """
-        Create a graph from the grid with obstacles taken into account
+        Create a graph from the map with obstacles taken into account
         """
+        kinds = self.cell_kinds
+        if self.graph_backend == "csr":
+            self.graph = self.compiled.road_graph()
+            return
+
+        sources = self.compiled.edge_sources
+        targets = self.compiled.edge_targets
+        edge_directions = self.compiled.edge_directions
+
         G = nx.DiGraph()
-        for x in range(self.width):
-            for y in range(self.height):
-                cell_contents = self.grid.get_cell_list_contents((x, y))
-                if any(
-                    isinstance(agent, (Road, Traffic_Light, Destination))
-                    for agent in cell_contents
-                ):
-                    G.add_node((x, y))
+        nodes = np.flatnonzero((kinds != EMPTY) & (kinds != OBSTACLE))
+        G.add_nodes_from(
+            (int(node // self.height), int(node % self.height)) for node in nodes
+        )
 
         # Add edges to represent valid moves (considering obstacles)
-        for x in range(self.width):
-            for y in range(self.height):
-                cell_contents = self.grid.get_cell_list_contents((x, y))
-                if any(
-                    isinstance(agent, (Road, Traffic_Light, Destination))
-                    for agent in cell_contents
-                ):
-                    current_node = (x, y)
-                    neighbors = self.grid.get_neighborhood(
-                        current_node, moore=True, include_center=False
-                    )
-                    for neighbor in neighbors:
-                        neighbor_contents = self.grid.get_cell_list_contents(neighbor)
-                        if any(
-                            isinstance(agent, (Road, Traffic_Light, Destination))
-                            for agent in neighbor_contents
-                        ):
-                            current_agent = next(
-                                agent
-                                for agent in cell_contents
-                                if isinstance(agent, (Road, Traffic_Light, Destination))
-                            )
-                            if any(
-                                isinstance(agent, Road) for agent in neighbor_contents
-                            ) and isinstance(current_agent, Road):
-                                if isinstance(current_agent, Road):
-                                    direction = current_agent.direction
-                                    neighbor_agent = next(
-                                        agent
-                                        for agent in neighbor_contents
-                                        if isinstance(agent, Road)
-                                    )
-                                    if (
-                                        current_agent.direction
-                                        == neighbor_agent.direction
-                                    ):
-                                        # Connect the nodes only in the direction of the road
-                                        if direction == "Up" and y < neighbor[1]:
-                                            G.add_edge(
-                                                current_node,
-                                                neighbor,
-                                                weight=1,
-                                                direction=direction,
-                                            )
-                                        elif direction == "Down" and y > neighbor[1]:
-                                            G.add_edge(
-                                                current_node,
-                                                neighbor,
-                                                weight=1,
-                                                direction=direction,
-                                            )
-                                        elif direction == "Left" and x > neighbor[0]:
-                                            G.add_edge(
-                                                current_node,
-                                                neighbor,
-                                                weight=1,
-                                                direction=direction,
-                                            )
-                                        elif direction == "Right" and x < neighbor[0]:
-                                            G.add_edge(
-                                                current_node,
-                                                neighbor,
-                                                weight=1,
-                                                direction=direction,
-                                            )
-                                        elif (
-                                            direction == "Up-Right" and x < neighbor[0]
-                                        ):
-                                            G.add_edge(
-                                                current_node,
-                                                neighbor,
-                                                weight=1,
-                                                direction=direction,
-                                            )
-                                        elif (
-                                            direction == "Up-Right" and y < neighbor[1]
-                                        ):
-                                            G.add_edge(
-                                                current_node,
-                                                neighbor,
-                                                weight=1,
-                                                direction=direction,
-                                            )
-                                        elif direction == "Up-Left" and x > neighbor[0]:
-                                            G.add_edge(
-                                                current_node,
-                                                neighbor,
-                                                weight=1,
-                                                direction=direction,
-                                            )
-                                        elif direction == "Up-Left" and y < neighbor[1]:
-                                            G.add_edge(
-                                                current_node,
-                                                neighbor,
-                                                weight=1,
-                                                direction=direction,
-                                            )
-                                        elif (
-                                            direction == "Down-Right"
-                                            and x < neighbor[0]
-                                        ):
-                                            G.add_edge(
-                                                current_node,
-                                                neighbor,
-                                                weight=1,
-                                                direction=direction,
-                                            )
-                                        elif (
-                                            direction == "Down-Right"
-                                            and y > neighbor[1]
-                                        ):
-                                            G.add_edge(
-                                                current_node,
-                                                neighbor,
-                                                weight=1,
-                                                direction=direction,
-                                            )
-                                        elif (
-                                            direction == "Down-Left" and x > neighbor[0]
-                                        ):
-                                            G.add_edge(
-                                                current_node,
-                                                neighbor,
-                                                weight=1,
-                                                direction=direction,
-                                            )
-                                        elif (
-                                            direction == "Down-Left" and y > neighbor[1]
-                                        ):
-                                            G.add_edge(
-                                                current_node,
-                                                neighbor,
-                                                weight=1,
-                                                direction=direction,
-                                            )
-                                    elif (
-                                        current_agent.direction
-                                        != neighbor_agent.direction
-                                    ):
-                                        neighbors = self.grid.get_neighborhood(
-                                            current_node,
-                                            moore=False,
-                                            include_center=False,
-                                        )
-                                        for neighbor in neighbors:
-                                            neighbor_contents = (
-                                                self.grid.get_cell_list_contents(
-                                                    neighbor
-                                                )
-                                            )
-                                            if any(
-                                                isinstance(
-                                                    agent,
-                                                    (Road, Traffic_Light, Destination),
-                                                )
-                                                for agent in neighbor_contents
-                                            ):
-                                                if (
-                                                    direction == "Up"
-                                                    and y < neighbor[1]
-                                                ):
-                                                    G.add_edge(
-                                                        current_node,
-                                                        neighbor,
-                                                        weight=1,
-                                                        direction=direction,
-                                                    )
-                                                elif (
-                                                    direction == "Down"
-                                                    and y > neighbor[1]
-                                                ):
-                                                    G.add_edge(
-                                                        current_node,
-                                                        neighbor,
-                                                        weight=1,
-                                                        direction=direction,
-                                                    )
-                                                elif (
-                                                    direction == "Left"
-                                                    and x > neighbor[0]
-                                                ):
-                                                    G.add_edge(
-                                                        current_node,
-                                                        neighbor,
-                                                        weight=1,
-                                                        direction=direction,
-                                                    )
-                                                elif (
-                                                    direction == "Right"
-                                                    and x < neighbor[0]
-                                                ):
-                                                    G.add_edge(
-                                                        current_node,
-                                                        neighbor,
-                                                        weight=1,
-                                                        direction=direction,
-                                                    )
-                                                elif (
-                                                    direction == "Up-Right"
-                                                    and x < neighbor[0]
-                                                ):
-                                                    G.add_edge(
-                                                        current_node,
-                                                        neighbor,
-                                                        weight=1,
-                                                        direction=direction,
-                                                    )
-                                                elif (
-                                                    direction == "Up-Right"
-                                                    and y < neighbor[1]
-                                                ):
-                                                    G.add_edge(
-                                                        current_node,
-                                                        neighbor,
-                                                        weight=1,
-                                                        direction=direction,
-                                                    )
-                                                elif (
-                                                    direction == "Up-Left"
-                                                    and x > neighbor[0]
-                                                ):
-                                                    G.add_edge(
-                                                        current_node,
-                                                        neighbor,
-                                                        weight=1,
-                                                        direction=direction,
-                                                    )
-                                                elif (
-                                                    direction == "Up-Left"
-                                                    and y < neighbor[1]
-                                                ):
-                                                    G.add_edge(
-                                                        current_node,
-                                                        neighbor,
-                                                        weight=1,
-                                                        direction=direction,
-                                                    )
-                                                elif (
-                                                    direction == "Down-Right"
-                                                    and x < neighbor[0]
-                                                ):
-                                                    G.add_edge(
-                                                        current_node,
-                                                        neighbor,
-                                                        weight=1,
-                                                        direction=direction,
-                                                    )
-                                                elif (
-                                                    direction == "Down-Right"
-                                                    and y > neighbor[1]
-                                                ):
-                                                    G.add_edge(
-                                                        current_node,
-                                                        neighbor,
-                                                        weight=1,
-                                                        direction=direction,
-                                                    )
-                                                elif (
-                                                    direction == "Down-Left"
-                                                    and x > neighbor[0]
-                                                ):
-                                                    G.add_edge(
-                                                        current_node,
-                                                        neighbor,
-                                                        weight=1,
-                                                        direction=direction,
-                                                    )
-                                                elif (
-                                                    direction == "Down-Left"
-                                                    and y > neighbor[1]
-                                                ):
-                                                    G.add_edge(
-                                                        current_node,
-                                                        neighbor,
-                                                        weight=1,
-                                                        direction=direction,
-                                                    )
-
-                        neighbors = self.grid.get_neighborhood(
-                            current_node, moore=False, include_center=False
-                        )
-
-                for neighbor in neighbors:
-                    neighbor_contents = self.grid.get_cell_list_contents(neighbor)
-
-                    if any(
-                        isinstance(agent, (Road, Traffic_Light, Destination))
-                        for agent in neighbor_contents
-                    ):
-                        if isinstance(current_agent, Traffic_Light):
-                            road_neighbor = next(
-                                (
-                                    agent
-                                    for agent in neighbor_contents
-                                    if isinstance(agent, Road)
-                                ),
-                                None,
-                            )
-
-                            if (
-                                road_neighbor
-                                and road_neighbor.direction == "Right"
-                                and x > neighbor[0]
-                            ):
-                                G.add_edge(neighbor, current_node, weight=1)
-                            elif (
-                                road_neighbor
-                                and road_neighbor.direction == "Right"
-                                and x < neighbor[0]
-                            ):
-                                G.add_edge(current_node, neighbor, weight=1)
-                            elif (
-                                road_neighbor
-                                and road_neighbor.direction == "Down-Left"
-                                and x > neighbor[0]
-                            ):
-                                G.add_edge(current_node, neighbor, weight=1)
-                            elif (
-                                road_neighbor
-                                and road_neighbor.direction == "Up-Right"
-                                and y > neighbor[1]
-                            ):
-                                G.add_edge(current_node, neighbor, weight=1)
-                            elif (
-                                road_neighbor
-                                and road_neighbor.direction == "Up-Right"
-                                and y < neighbor[1]
-                            ):
-                                G.add_edge(neighbor, current_node, weight=1)
-                            elif (
-                                road_neighbor
-                                and road_neighbor.direction == "Left"
-                                and x < neighbor[0]
-                            ):
-                                G.add_edge(neighbor, current_node, weight=1)
-                            elif (
-                                road_neighbor
-                                and road_neighbor.direction == "Left"
-                                and x > neighbor[0]
-                            ):
-                                G.add_edge(current_node, neighbor, weight=1)
-                            elif (
-                                road_neighbor
-                                and road_neighbor.direction == "Down"
-                                and y > neighbor[1]
-                            ):
-                                G.add_edge(current_node, neighbor, weight=1)
-                            elif (
-                                road_neighbor
-                                and road_neighbor.direction == "Down"
-                                and y < neighbor[1]
-                            ):
-                                G.add_edge(neighbor, current_node, weight=1)
-                            elif (
-                                road_neighbor
-                                and road_neighbor.direction == "Right"
-                                and y > neighbor[1]
-                            ):
-                                G.add_edge(current_node, neighbor, weight=1)
-                            elif (
-                                road_neighbor
-                                and road_neighbor.direction == "Down"
-                                and x > neighbor[0]
-                            ):
-                                G.add_edge(current_node, neighbor, weight=1)
-                            elif (
-                                road_neighbor
-                                and road_neighbor.direction == "Up"
-                                and y > neighbor[1]
-                            ):
-                                G.add_edge(neighbor, current_node, weight=1)
-                            elif (
-                                road_neighbor
-                                and road_neighbor.direction == "Up"
-                                and y < neighbor[1]
-                            ):
-                                G.add_edge(current_node, neighbor, weight=1)
-                            elif (
-                                road_neighbor
-                                and road_neighbor.direction == "Left"
-                                and y < neighbor[1]
-                            ):
-                                G.add_edge(current_node, neighbor, weight=1)
-                            elif (
-                                road_neighbor
-                                and road_neighbor.direction == "Up"
-                                and x < neighbor[0]
-                            ):
-                                G.add_edge(current_node, neighbor, weight=1)
-
-                            # Deactiviate moore to connect destination
-
-                            neighbors = self.grid.get_neighborhood(
-                                current_node, moore=False, include_center=False
-                            )
-
-                    for neighbor in neighbors:
-                        neighbor_contents = self.grid.get_cell_list_contents(neighbor)
-                        if any(
-                            isinstance(agent, (Road, Traffic_Light, Destination))
-                            for agent in neighbor_contents
-                        ):
-                            if isinstance(current_agent, Destination):
-                                G.add_edge(neighbor, current_node, weight=1)
+        edges = []
+        for source, target, direction in zip(
+            sources.tolist(), targets.tolist(), edge_directions.tolist()
+        ):
+            attributes = {"weight": 1}
+            if direction:
+                attributes["direction"] = DIRECTIONS[direction]
+            edges.append(
+                (
+                    (source // self.height, source % self.height),
+                    (target // self.height, target % self.height),
+                    attributes,
+                )
+            )
+        G.add_edges_from(edges)
 
         # pos = {node: (node[0], node[1]) for node in G.nodes()}
         # nx.draw(G, pos, with_labels=False, font_weight="bold")
         # plt.show()
         self.graph = G
 
+    def reachable_cells(self, position):
+        """Boolean layer of the cells that can be reached from position."""
+        if self.cell_kinds[position] in (EMPTY, OBSTACLE):
+            return np.zeros((self.width, self.height), dtype=bool)
+
+        if self.graph_backend == "csr":
+            reached = self.graph.reachable(self.graph.node(position))
+            return reached.reshape(self.height, self.width).T
+
+        reached = np.zeros((self.width, self.height), dtype=bool)
+        reached[position] = True
+        for x, y in nx.descendants(self.graph, position):
+            reached[x, y] = True
+        return reached
+
+    def index_destinations(self):
+        """
+        Builds the index of the destinations that can be reached from each spawn point, so a new car
+        chooses a destination it can reach in O(1). Corners that can't reach any destination are not
+        used as spawn points. The reachability of each corner comes from the compiled map.
+        """
+        self.destination_list = list(self.destination.values())
+        self.reachable_destinations = {}
+        spawn_points = []
+        for corner, reachable in zip(
+            self.compiled.corners, self.compiled.corner_destinations
+        ):
+            ids = np.flatnonzero(reachable)
+            if ids.size:
+                self.reachable_destinations[corner] = [
+                    self.destination_list[i] for i in ids.tolist()
+                ]
+                spawn_points.append(corner)
+        self.spawn_points = np.array(spawn_points, dtype=np.int64).reshape(-1, 2).T
+
+    def cell_id(self, position):
+        """
+        Number of a cell in the map file (row * width + column), used in the ids of the map elements.
+        """
+        x, y = position
+        return (self.height - y - 1) * self.width + x
+
+    def static_cells(self, kind):
+        """Positions of the cells of a kind in the static layers, column by column."""
+        return [
+            tuple(position)
+            for position in np.argwhere(self.cell_kinds == kind).tolist()
+        ]
+
     def car_count(self):
         """Counts the number of cars in the simulation."""
+        if self.fleet is not None:
+            return self.fleet.count
         count = 0
         for agent in self.cars.values():
             if isinstance(agent, Car):
                 count += 1
         return count
 
+    def car_states(self):
+        """
+        Arrays with the id, position and destination position of every car, for both engines.
+        Cars without a destination use their own position.
+        """
+        if self.fleet is not None:
+            return self.fleet.states()
+        cars = [agent for agent in self.cars.values() if isinstance(agent, Car)]
+        ids = [agent.unique_id for agent in cars]
+        positions = np.array([agent.pos for agent in cars], dtype=np.int64).reshape(
+            -1, 2
+        )
+        destinations = np.array(
+            [
+                agent.destination.pos if agent.destination is not None else agent.pos
+                for agent in cars
+            ],
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        return (
+            np.array(ids, dtype=np.int64),
+            positions[:, 0],
+            positions[:, 1],
+            destinations[:, 0],
+            destinations[:, 1],
+        )
+
     def update_graph_weights(self):
-        for node in self.graph.nodes():
-            cell_contents = self.grid.get_cell_list_contents([node])
-            if any(isinstance(agent, Car) for agent in cell_contents):
-                # If there's a Car in the node, update the weights of connected edges to 50
-                for neighbor in self.graph.neighbors(node):
-                    self.graph.edges[node, neighbor]["weight"] = 5
-            else:
-                # If there's no Car in the node, reset the edge weights to 1
-                for neighbor in self.graph.neighbors(node):
-                    self.graph.edges[node, neighbor]["weight"] = 1
-        # for edge in self.graph.edges():
-        #     print(f"Edge {edge}: Weight {self.graph.edges[edge]['weight']}")
+        """
+        Publishes the edges whose weight changed in the last step in changed_edges, and refreshes the
+        routes when some weight changed and route_refresh steps went by since the last refresh, so each
+        next-hop table is rebuilt at most once every route_refresh steps. The cost grows with the
+        number of changed edges, not with the size of the map.
+        """
+        self.changed_edges = self.step_changed_edges
+        self.step_changed_edges = set()
+        if self.changed_edges:
+            self.routes_dirty = True
+        if (
+            self.routes_dirty
+            and self.step_counter - self.last_route_refresh >= self.route_refresh
+        ):
+            self.refresh_routes()
+            self.routes_dirty = False
+            self.last_route_refresh = self.step_counter
+
+    def refresh_routes(self, occupied=None):
+        """
+        Freezes the congestion used by the next-hop tables and drops the tables, which are rebuilt
+        lazily with it. For the tables, the edges leaving an occupied cell weigh 5 and the rest weigh 1.
+        Args:
+            occupied: Boolean layer of the occupied cells. By default the current occupancy
+        """
+        if occupied is None:
+            occupied = self.occupancy > 0
+        self.route_occupied = occupied
+        if self.graph_backend == "csr":
+            self.route_weights = np.where(
+                occupied.T.ravel()[self.graph.edge_sources], 5, 1
+            ).astype(np.float32)
+        self.next_hop_tables = {}
+        if self.fleet is not None:
+            self.fleet.tables = {}
+        self.weights_version += 1
+
+    def update_cell_weights(self, position):
+        """
+        Updates the weights of the edges leaving a cell after a car entered or left it, adding the ones
+        that changed to step_changed_edges. The edges leaving a cell with a car weigh 5, the rest weigh 1.
+        """
+        weight = 5 if self.occupancy[position] else 1
+
+        if self.graph_backend == "csr":
+            node = self.graph.node(position)
+            if self.graph.set_node_weight(node, weight):
+                self.step_changed_edges.update(
+                    (position, self.graph.position(neighbor))
+                    for neighbor in self.graph.neighbors(node)
+                )
+            return
+
+        for neighbor in self.graph.neighbors(position):
+            edge = self.graph.edges[position, neighbor]
+            if edge["weight"] != weight:
+                edge["weight"] = weight
+                self.step_changed_edges.add((position, neighbor))
+
+    def place_car(self, car, position):
+        """Adds a new car to the grid and the schedule."""
+        self.grid.place_agent(car, position)
+        self.occupancy[position] += 1
+        self.schedule.add(car)
+        self.cars[car.unique_id] = car
+        self.update_cell_weights(position)
+
+    def set_occupancy(self, occupancy):
+        """Replaces the occupancy layer, updating the weights of the edges leaving the cells that changed."""
+        changed = np.argwhere(self.occupancy != occupancy).tolist()
+        self.occupancy[...] = occupancy
+        for x, y in changed:
+            self.update_cell_weights((x, y))
+
+    def move_car(self, car, position):
+        """Moves a car to a neighbouring cell."""
+        previous_position = car.pos
+        self.grid.move_agent(car, position)
+        self.occupancy[previous_position] -= 1
+        self.occupancy[position] += 1
+        self.update_cell_weights(previous_position)
+        self.update_cell_weights(position)
+
+    def remove_car(self, car):
+        """Removes a car that arrived to its destination."""
+        position = car.pos
+        self.schedule.remove(car)
+        self.grid.remove_agent(car)
+        self.occupancy[position] -= 1
+        self.cars.pop(car.unique_id)
+        self.update_cell_weights(position)
+
+    def build_next_hop_table(self, destination_position):
+        """
+        Builds the next-hop table of a destination from a shortest-path tree over the reversed graph,
+        with the congestion frozen by the last refresh of the routes (see refresh_routes).
+        The table is indexed by cell (y * width + x) and holds the index of the next cell on the way
+        to the destination, or -1 if the destination can't be reached from that cell.
+        """
+        if not self.profiler.enabled:
+            return self._next_hop_table(destination_position)
+        build_start = time.perf_counter()
+        table = self._next_hop_table(destination_position)
+        self.profiler.add_table(time.perf_counter() - build_start)
+        return table
+
+    def _next_hop_table(self, destination_position):
+        if self.graph_backend == "csr":
+            return self.graph.next_hop_table(
+                self.graph.node(destination_position), self.route_weights
+            )
+
+        occupied = self.route_occupied
+        table = np.full(self.width * self.height, -1, dtype=np.int32)
+        # In the reversed graph the edge (u, v) is the edge (v, u) of the map, which leaves v
+        predecessors, _ = nx.dijkstra_predecessor_and_distance(
+            self.graph.reverse(copy=False),
+            destination_position,
+            weight=lambda u, v, data: 5 if occupied[v] else 1,
+        )
+        for (x, y), previous in predecessors.items():
+            if previous:
+                next_x, next_y = previous[0]
+                table[y * self.width + x] = next_y * self.width + next_x
+        return table
+
+    def find_path(self, start, goal):
+        """
+        Returns the shortest path between two cells as a list of positions, or None if there is no path.
+        """
+        if not self.profiler.enabled:
+            return self._astar(start, goal)
+        search_start = time.perf_counter()
+        path = self._astar(start, goal)
+        self.profiler.add_astar(time.perf_counter() - search_start)
+        return path
+
+    def _astar(self, start, goal):
+        if self.graph_backend == "csr":
+            path = self.graph.astar(self.graph.node(start), self.graph.node(goal))
+            if path is None:
+                return None
+            return [self.graph.position(node) for node in path]
+
+        try:
+            return nx.astar_path(self.graph, start, goal)
+        except nx.NetworkXNoPath:
+            return None
+
+    def edge_weight(self, start, end):
+        """Returns the current weight of the edge between two neighbouring cells."""
+        if self.graph_backend == "csr":
+            return self.graph.edge_weight(self.graph.node(start), self.graph.node(end))
+        return self.graph.edges[start, end]["weight"]
+
+    def next_hop(self, position, destination_position):
+        """
+        Returns the next cell from position towards the destination, or position if there is no path.
+        The table of the destination is only rebuilt when the routes were refreshed since it was built.
+        """
+        version, table = self.next_hop_tables.get(destination_position, (None, None))
+        if version != self.weights_version:
+            table = self.build_next_hop_table(destination_position)
+            self.next_hop_tables[destination_position] = (self.weights_version, table)
 
-    dataCollector = DataCollector(
-        model_reporters={"Car Count": "car_count"}, agent_reporters={}
-    )
+        next_index = table[position[1] * self.width + position[0]]
+        if next_index < 0:
+            return position
+        return (int(next_index % self.width), int(next_index // self.width))
 
     def car_spawner(self):
-        if self.schedule.steps % 1 == 0:
-            corners = [
-                (0, 0),
-                (0, self.height - 1),
-                (self.width - 1, 0),
-                (self.width - 1, self.height - 1),
-            ]
+        if self.schedule.steps % self.spawn_interval == 0:
+            xs, ys = self.spawn_points
+            free = self.occupancy[xs, ys] == 0
+            corners = list(zip(xs[free].tolist(), ys[free].tolist()))
+            if self.fleet is not None:
+                self.fleet.spawn(corners)
+                return
             for corner in corners:
-                cell_contents = self.grid.get_cell_list_contents([corner])
-                if any(isinstance(agent, Car) for agent in cell_contents):
-                    bussy = True
-                else:
-                    bussy = False
-                if bussy == False:
-                    new_agent = Car(self.num_agents + 1, self, self.graph)
-                    self.num_agents += 1
-                    self.cars[new_agent.unique_id] = new_agent
-                    self.grid.place_agent(new_agent, corner)
-                    self.schedule.add(new_agent)
+                new_agent = Car(self.num_agents + 1, self, self.graph, origin=corner)
+                self.num_agents += 1
+                self.place_car(new_agent, corner)
 
     def step(self):
         """Advance the model by one step."""
 
-        if self.step_counter % 10 == 0:
-            self.send_post_request()
+        profiler = self.profiler
+
+        if self.telemetry is not None and self.step_counter % 10 == 0:
+            with profiler.phase("telemetry"):
+                self.send_post_request()
 
         self.step_counter += 1
 
-        self.update_graph_weights()
-        print(self.agents_arrived)
-        self.schedule.step()
-        self.dataCollector.collect(self)
-        self.car_spawner()
+        with profiler.phase("graph_weights"):
+            self.update_graph_weights()
+        logger.debug("Arrived cars: %d", self.agents_arrived)
+        with profiler.phase("traffic_lights"):
+            self.traffic_light_controller.step(self.schedule.steps)
+        if self.fleet is not None:
+            with profiler.phase("fleet"):
+                self.fleet.step()
+        with profiler.phase("schedule"):
+            if profiler.enabled:
+                profiler.step_schedule(self.schedule)
+            else:
+                self.schedule.step()
+        with profiler.phase("data_collector"):
+            self.dataCollector.collect(self)
+        with profiler.phase("car_spawner"):
+            self.car_spawner()
+        if self.state_feed is not None:
+            with profiler.phase("state_feed"):
+                self.state_feed.record()
+        if profiler.enabled:
+            profiler.steps += 1
+
+    def set_parameters(
+        self,
+        spawn_interval=None,
+        light_periods=None,
+        next_hop_routing=None,
+        route_refresh=None,
+    ):
+        """
+        Changes the parameters of a running model. The ones that are None are kept.
+        Args:
+            spawn_interval: Steps between the creation of new cars at the corners
+            light_periods: Steps between changes for each traffic light character, as in __init__
+            next_hop_routing: Whether the cars follow the next-hop tables or their own A* routes
+            route_refresh: Minimum steps between rebuilds of the next-hop tables
+        """
+        if spawn_interval is not None:
+            if int(spawn_interval) < 1:
+                raise ValueError("spawn_interval must be at least 1")
+            self.spawn_interval = int(spawn_interval)
+        if next_hop_routing is not None:
+            self.next_hop_routing = bool(next_hop_routing)
+        if route_refresh is not None:
+            if int(route_refresh) < 1:
+                raise ValueError("route_refresh must be at least 1")
+            self.route_refresh = int(route_refresh)
+        if light_periods:
+            periods = dict(light_periods)
+            for char, period in periods.items():
+                if char not in self.light_chars:
+                    raise ValueError(f"{char!r} is not a traffic light of the map")
+                if int(period) < 1:
+                    raise ValueError(
+                        "The periods of the traffic lights must be at least 1"
+                    )
+            controller = self.traffic_light_controller
+            current = controller.periods[controller.groups]
+            # The controller is stepped with schedule.steps, so a change can still happen this step
+            controller.set_periods(
+                [
+                    int(periods[char]) if char in periods else period
+                    for char, period in zip(self.light_chars, current.tolist())
+                ],
+                self.schedule.steps - 1,
+            )
+
+    def snapshot(self):
+        """Saves the dynamic state of the model (see snapshots.Snapshot)."""
+        return Snapshot(self)
+
+    def restore(self, snapshot, seed=None):
+        """
+        Puts the model in the state of a snapshot, taken from this model or from another one of the
+        same map and engine (see snapshots.Snapshot.restore).
+        """
+        snapshot.restore(self, seed)
 
     def send_post_request(self):
+        """Queues a report of the arrived cars. The request is made by the telemetry thread."""
         data = {
             "year": 2023,
             "classroom": 302,
             "name": "Equipo 8 - David y Jp",
             "num_cars": self.agents_arrived,
         }
-
-        url = "http://52.1.3.19:8585/api/"
-        endpoint = "validate_attempt"
-
-        headers = {"Content-Type": "application/json"}
-
-        response = requests.post(url + endpoint, data=json.dumps(data), headers=headers)
-
-        if response.status_code == 200:
-            print("Request successful. Status code:", response.status_code)
-            print("Response:", response.json())
-        else:
-            print("Request failed. Status code:", response.status_code)
+        self.telemetry.send(data, key=id(self))
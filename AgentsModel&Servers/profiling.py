@@ -0,0 +1,239 @@
+#Script que mide cuánto tarda cada fase del paso del modelo y la exporta en el formato de texto de Prometheus
+
+import contextlib
+import time
+
+# Context manager used when the profiler is off, so a phase costs one function call
+_NO_PHASE = contextlib.nullcontext()
+
+
+class StepProfiler:
+    """
+    Accumulates the wall time of the phases of CityModel.step.
+    Attributes:
+        enabled: Whether anything is measured. When it is off every method returns right away
+        phase_seconds, phase_calls: Total time and number of runs of each phase
+        agent_seconds, agent_steps: Total step time and number of steps of each type of agent
+        astar_calls, astar_seconds: Number of A* searches and their total time
+        table_builds, table_seconds: Number of next-hop tables built and their total time
+        steps: Steps measured
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.phase_seconds = {}
+        self.phase_calls = {}
+        self.agent_seconds = {}
+        self.agent_steps = {}
+        self.astar_calls = 0
+        self.astar_seconds = 0.0
+        self.table_builds = 0
+        self.table_seconds = 0.0
+        self.steps = 0
+
+    def phase(self, name):
+        """Context manager that adds the time of the block to a phase."""
+        if not self.enabled:
+            return _NO_PHASE
+        return self._phase(name)
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def add_phase(self, name, seconds):
+        self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + seconds
+        self.phase_calls[name] = self.phase_calls.get(name, 0) + 1
+
+    def add_agent(self, agent_type, seconds, count=1):
+        self.agent_seconds[agent_type] = (
+            self.agent_seconds.get(agent_type, 0.0) + seconds
+        )
+        self.agent_steps[agent_type] = self.agent_steps.get(agent_type, 0) + count
+
+    def add_astar(self, seconds):
+        self.astar_calls += 1
+        self.astar_seconds += seconds
+
+    def add_table(self, seconds):
+        self.table_builds += 1
+        self.table_seconds += seconds
+
+    def step_schedule(self, schedule):
+        """
+        Same as RandomActivation.step, timing the step of each agent by its type.
+        The agents are shuffled the same way, so the results of the model don't change.
+        """
+        agent_keys = schedule.get_agent_keys()
+        schedule.model.random.shuffle(agent_keys)
+        agents = schedule._agents
+        for agent_key in agent_keys:
+            if agent_key in agents:
+                agent = agents[agent_key]
+                start = time.perf_counter()
+                agent.step()
+                self.add_agent(type(agent).__name__, time.perf_counter() - start)
+        schedule.steps += 1
+        schedule.time += 1
+
+    def summary(self):
+        """Dictionary with the totals, that can be combined with merge."""
+        return {
+            "steps": self.steps,
+            "phase_seconds": dict(self.phase_seconds),
+            "phase_calls": dict(self.phase_calls),
+            "agent_seconds": dict(self.agent_seconds),
+            "agent_steps": dict(self.agent_steps),
+            "astar_calls": self.astar_calls,
+            "astar_seconds": self.astar_seconds,
+            "table_builds": self.table_builds,
+            "table_seconds": self.table_seconds,
+        }
+
+    def merge(self, summary):
+        """Adds the totals of a summary (for example from another process)."""
+        self.steps += summary["steps"]
+        for name, seconds in summary["phase_seconds"].items():
+            self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + seconds
+            self.phase_calls[name] = (
+                self.phase_calls.get(name, 0) + summary["phase_calls"][name]
+            )
+        for agent_type, seconds in summary["agent_seconds"].items():
+            self.add_agent(agent_type, seconds, summary["agent_steps"][agent_type])
+        self.astar_calls += summary["astar_calls"]
+        self.astar_seconds += summary["astar_seconds"]
+        self.table_builds += summary["table_builds"]
+        self.table_seconds += summary["table_seconds"]
+
+    def format_summary(self):
+        """Text table with the time of each phase, per step and as a share of the total."""
+        total = sum(self.phase_seconds.values()) or 1.0
+        steps = self.steps or 1
+        lines = [f"{'phase':<22} {'total s':>10} {'ms/step':>10} {'share':>7}"]
+        for name, seconds in sorted(
+            self.phase_seconds.items(), key=lambda item: -item[1]
+        ):
+            lines.append(
+                f"{name:<22} {seconds:>10.3f} {seconds * 1000 / steps:>10.3f} "
+                f"{seconds / total:>7.1%}"
+            )
+        for agent_type, seconds in sorted(self.agent_seconds.items()):
+            count = self.agent_steps[agent_type]
+            lines.append(
+                f"{agent_type + ' steps':<22} {seconds:>10.3f} "
+                f"{seconds * 1e6 / max(count, 1):>10.1f} us/agent ({count} steps)"
+            )
+        lines.append(
+            f"{'A* searches':<22} {self.astar_seconds:>10.3f} "
+            f"{self.astar_seconds * 1000 / max(self.astar_calls, 1):>10.3f} "
+            f"ms/search ({self.astar_calls} searches)"
+        )
+        lines.append(
+            f"{'next-hop tables':<22} {self.table_seconds:>10.3f} "
+            f"{self.table_seconds * 1000 / max(self.table_builds, 1):>10.3f} "
+            f"ms/table ({self.table_builds} tables)"
+        )
+        return "\n".join(lines)
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def prometheus_text(model):
+    """Metrics of a model in the Prometheus text exposition format."""
+    profiler = model.profiler
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{labels} {value}")
+
+    metric(
+        "traffic_steps_total",
+        "counter",
+        "Steps of the model.",
+        [("", model.step_counter)],
+    )
+    metric(
+        "traffic_cars", "gauge", "Cars in the simulation.", [("", model.car_count())]
+    )
+    metric(
+        "traffic_agents_arrived_total",
+        "counter",
+        "Cars that reached their destination.",
+        [("", model.agents_arrived)],
+    )
+    metric(
+        "traffic_profiling_enabled",
+        "gauge",
+        "Whether the step phases are being measured.",
+        [("", int(profiler.enabled))],
+    )
+    metric(
+        "traffic_step_phase_seconds_total",
+        "counter",
+        "Wall time spent in each phase of the step.",
+        [
+            (_labels(phase=name), s)
+            for name, s in sorted(profiler.phase_seconds.items())
+        ],
+    )
+    metric(
+        "traffic_step_phase_calls_total",
+        "counter",
+        "Times each phase of the step ran.",
+        [(_labels(phase=name), n) for name, n in sorted(profiler.phase_calls.items())],
+    )
+    metric(
+        "traffic_agent_step_seconds_total",
+        "counter",
+        "Wall time spent in the step of each type of agent.",
+        [
+            (_labels(agent_type=name), s)
+            for name, s in sorted(profiler.agent_seconds.items())
+        ],
+    )
+    metric(
+        "traffic_agent_steps_total",
+        "counter",
+        "Steps of each type of agent.",
+        [
+            (_labels(agent_type=name), n)
+            for name, n in sorted(profiler.agent_steps.items())
+        ],
+    )
+    metric(
+        "traffic_astar_calls_total",
+        "counter",
+        "A* route searches.",
+        [("", profiler.astar_calls)],
+    )
+    metric(
+        "traffic_astar_seconds_total",
+        "counter",
+        "Wall time spent in A* route searches.",
+        [("", profiler.astar_seconds)],
+    )
+    metric(
+        "traffic_next_hop_table_builds_total",
+        "counter",
+        "Next-hop tables built for the destinations.",
+        [("", profiler.table_builds)],
+    )
+    metric(
+        "traffic_next_hop_table_seconds_total",
+        "counter",
+        "Wall time spent building next-hop tables.",
+        [("", profiler.table_seconds)],
+    )
+    return "\n".join(lines) + "\n"
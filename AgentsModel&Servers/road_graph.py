@@ -0,0 +1,268 @@
+#Script que guarda el grafo de calles en arreglos compactos (CSR) y calcula rutas sobre ellos
+
+import heapq
+
+import numpy as np
+
+from city_map import EMPTY, OBSTACLE
+
+
+class RoadGraph:
+    """
+    Directed road graph stored in CSR arrays, as an alternative to a networkx DiGraph.
+    Attributes:
+        width, height: Size of the map
+        indptr: Outgoing edges of node n are indptr[n]:indptr[n + 1]
+        indices: Target node of each edge
+        weights: Weight of each edge
+        directions: Direction code of the road each edge was created for (see city_map.DIRECTIONS)
+        is_node: Whether each cell of the map is a node of the graph
+    Nodes are the cells of the map, numbered y * width + x.
+    """
+
+    def __init__(self, width, height, sources, targets, directions=None):
+        """
+        Creates the graph from arrays of edges.
+        Args:
+            width, height: Size of the map
+            sources, targets: Node of each end of the edges
+            directions: Direction code of each edge
+        """
+        self.width = width
+        self.height = height
+        size = width * height
+        sources = np.asarray(sources, dtype=np.int32)
+        targets = np.asarray(targets, dtype=np.int32)
+        if directions is None:
+            directions = np.zeros(sources.size, dtype=np.int8)
+
+        order = np.lexsort((targets, sources))
+        self.indices = targets[order]
+        self.directions = np.asarray(directions, dtype=np.int8)[order]
+        self.weights = np.ones(sources.size, dtype=np.float32)
+        self.indptr = np.zeros(size + 1, dtype=np.int32)
+        np.cumsum(np.bincount(sources, minlength=size), out=self.indptr[1:])
+        self.edge_sources = sources[order]
+
+        # Incoming edges of each node, pointing to the position of the edge in the arrays above
+        reverse = np.argsort(self.indices, kind="stable").astype(np.int32)
+        self.reverse_edges = reverse
+        self.reverse_sources = self.edge_sources[reverse]
+        self.reverse_indptr = np.zeros(size + 1, dtype=np.int32)
+        np.cumsum(
+            np.bincount(self.indices, minlength=size), out=self.reverse_indptr[1:]
+        )
+
+        self.is_node = np.zeros(size, dtype=bool)
+
+    @classmethod
+    def from_city_edges(cls, kinds, sources, targets, directions):
+        """
+        Creates the graph from the output of city_map.build_edges, where cells are numbered x * height + y.
+        """
+        width, height = kinds.shape
+        x, y = np.divmod(np.asarray(sources), height)
+        sources = y * width + x
+        x, y = np.divmod(np.asarray(targets), height)
+        targets = y * width + x
+        graph = cls(width, height, sources, targets, directions)
+        graph.is_node = ((kinds != EMPTY) & (kinds != OBSTACLE)).T.ravel()
+        return graph
+
+    # Arrays that define the graph, in the order used by arrays() and from_arrays()
+    ARRAYS = (
+        "indptr",
+        "indices",
+        "weights",
+        "directions",
+        "edge_sources",
+        "reverse_edges",
+        "reverse_sources",
+        "reverse_indptr",
+        "is_node",
+    )
+
+    def arrays(self):
+        """Dictionary with the arrays of the graph, to store it."""
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    @classmethod
+    def from_arrays(cls, width, height, arrays):
+        """
+        Creates the graph from the output of arrays() without sorting the edges again. The arrays can
+        be read-only (for example memory-mapped) except for the weights, which are copied.
+        """
+        graph = cls.__new__(cls)
+        graph.width = width
+        graph.height = height
+        for name in cls.ARRAYS:
+            setattr(graph, name, arrays[name])
+        graph.weights = np.array(arrays["weights"], dtype=np.float32)
+        return graph
+
+    def node(self, position):
+        """Node number of an (x, y) position."""
+        return position[1] * self.width + position[0]
+
+    def position(self, node):
+        """(x, y) position of a node number."""
+        return (node % self.width, node // self.width)
+
+    def number_of_nodes(self):
+        return int(self.is_node.sum())
+
+    def number_of_edges(self):
+        return int(self.indices.size)
+
+    def nbytes(self):
+        """Memory used by the arrays of the graph."""
+        return sum(array.nbytes for array in self.arrays().values())
+
+    def neighbors(self, node):
+        """Nodes reachable from node through one edge."""
+        return self.indices[self.indptr[node] : self.indptr[node + 1]].tolist()
+
+    def edge_weight(self, source, target):
+        """Weight of the edge source -> target."""
+        start = int(self.indptr[source])
+        targets = self.indices[start : self.indptr[source + 1]].tolist()
+        return float(self.weights[start + targets.index(target)])
+
+    def set_node_weight(self, node, weight):
+        """
+        Sets the weight of all the outgoing edges of a node. Returns whether any weight changed.
+        """
+        edges = self.weights[self.indptr[node] : self.indptr[node + 1]]
+        changed = bool((edges != weight).any())
+        edges[:] = weight
+        return changed
+
+    def set_nodes_weight(self, nodes, weights):
+        """
+        Sets the weight of the outgoing edges of several nodes at once. Returns the indices of the edges
+        whose weight changed.
+        Args:
+            nodes: Array of nodes
+            weights: Weight for the edges of each node
+        """
+        starts = self.indptr[nodes]
+        counts = self.indptr[np.asarray(nodes) + 1] - starts
+        total = int(counts.sum())
+        if total == 0:
+            return np.zeros(0, dtype=np.int64)
+        offsets = np.repeat(np.cumsum(counts) - counts, counts)
+        edges = np.arange(total) - offsets + np.repeat(starts, counts)
+        weights = np.repeat(np.asarray(weights, dtype=self.weights.dtype), counts)
+        changed = edges[self.weights[edges] != weights]
+        self.weights[edges] = weights
+        return changed
+
+    def astar(self, source, target):
+        """
+        Shortest path from source to target as a list of nodes, or None if there is no path.
+        The heuristic is the Chebyshev distance, since every move, diagonal or not, costs at least 1.
+        """
+        indptr = self.indptr
+        indices = self.indices
+        weights = self.weights
+        width = self.width
+        target_x, target_y = target % width, target // width
+
+        distance = {source: 0.0}
+        parent = {source: None}
+        done = set()
+        queue = [(0.0, 0.0, source)]
+        while queue:
+            _, cost, node = heapq.heappop(queue)
+            if node == target:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = parent[node]
+                return path[::-1]
+            if node in done:
+                continue
+            done.add(node)
+
+            start, end = indptr[node], indptr[node + 1]
+            for neighbor, weight in zip(
+                indices[start:end].tolist(), weights[start:end].tolist()
+            ):
+                new_cost = cost + weight
+                if new_cost < distance.get(neighbor, np.inf):
+                    distance[neighbor] = new_cost
+                    parent[neighbor] = node
+                    heuristic = max(
+                        abs(neighbor % width - target_x),
+                        abs(neighbor // width - target_y),
+                    )
+                    heapq.heappush(queue, (new_cost + heuristic, new_cost, neighbor))
+        return None
+
+    def reachable(self, source, reverse=False):
+        """
+        Boolean array of the nodes that can be reached from source.
+        With reverse=True the edges are followed backwards, giving the nodes that can reach source.
+        """
+        if reverse:
+            indptr = self.reverse_indptr.tolist()
+            indices = self.reverse_sources.tolist()
+        else:
+            indptr = self.indptr.tolist()
+            indices = self.indices.tolist()
+        reached = [False] * (self.width * self.height)
+        reached[source] = True
+        pending = [source]
+        while pending:
+            node = pending.pop()
+            for neighbor in indices[indptr[node] : indptr[node + 1]]:
+                if not reached[neighbor]:
+                    reached[neighbor] = True
+                    pending.append(neighbor)
+        return np.array(reached)
+
+    def dijkstra(self, source, reverse=False, weights=None):
+        """
+        Shortest distances from source to every node, and the parent of each node in the shortest-path
+        tree (-1 if the node can't be reached).
+        With reverse=True the edges are followed backwards, so the distances are to source and the
+        parent of each node is the next node on its way to source.
+        weights replaces the current weights of the edges, in the order of self.weights.
+        """
+        if weights is None:
+            weights = self.weights
+        # The search runs over plain lists, which are much faster to index one element at a time
+        if reverse:
+            indptr = self.reverse_indptr.tolist()
+            neighbors = self.reverse_sources.tolist()
+            weights = weights[self.reverse_edges].tolist()
+        else:
+            indptr = self.indptr.tolist()
+            neighbors = self.indices.tolist()
+            weights = weights.tolist()
+
+        size = self.width * self.height
+        distance = [np.inf] * size
+        parent = [-1] * size
+        distance[source] = 0.0
+        queue = [(0.0, source)]
+        while queue:
+            cost, node = heapq.heappop(queue)
+            if cost > distance[node]:
+                continue
+
+            for edge in range(indptr[node], indptr[node + 1]):
+                neighbor = neighbors[edge]
+                new_cost = cost + weights[edge]
+                if new_cost < distance[neighbor]:
+                    distance[neighbor] = new_cost
+                    parent[neighbor] = node
+                    heapq.heappush(queue, (new_cost, neighbor))
+        return np.array(distance), np.array(parent, dtype=np.int32)
+
+    def next_hop_table(self, destination, weights=None):
+        """
+        Next node on the shortest path to destination for every node (-1 if it can't be reached).
+        weights replaces the current weights of the edges, as in dijkstra.
+        """
+        return self.dijkstra(destination, reverse=True, weights=weights)[1]
@@ -1,8 +1,11 @@
 #Script para correr el modelo mediante una visualización de mesa 
 
+import argparse
 
 from agent import *
-from model import CityModel
+from city_map import DESTINATION, OBSTACLE, ROAD
+from map_registry import MapRegistry
+from model import DEFAULT_MAP, CityModel
 from mesa.visualization import CanvasGrid
 from mesa.visualization.modules import TextElement
 from mesa.visualization import ModularServer
@@ -22,25 +25,12 @@ def agent_portrayal(agent):
 
     portrayal = {"Shape": "rect", "Filled": "true", "Layer": 1, "w": 1, "h": 1}
 
-    if isinstance(agent, Road):
-        portrayal["Color"] = "grey"
-        portrayal["Layer"] = 0
-
-    if isinstance(agent, Destination):
-        portrayal["Color"] = "lightgreen"
-        portrayal["Layer"] = 0
-
     if isinstance(agent, Traffic_Light):
         portrayal["Color"] = "red" if not agent.state else "green"
         portrayal["Layer"] = 0
         portrayal["w"] = 0.8
         portrayal["h"] = 0.8
 
-    if isinstance(agent, Obstacle):
-        portrayal["Color"] = "cadetblue"
-        portrayal["Layer"] = 0
-        portrayal["w"] = 0.8
-        portrayal["h"] = 0.8
     if isinstance(agent, Car):
         portrayal["Color"] = "black"
         portrayal["Layer"] = 2
@@ -50,19 +40,60 @@ def agent_portrayal(agent):
     return portrayal
 
 
-width = 0
-height = 0
+# Portrayal of the cells of the static map layers, which are not agents
+static_portrayals = {
+    ROAD: {"Color": "grey", "w": 1, "h": 1},
+    DESTINATION: {"Color": "lightgreen", "w": 1, "h": 1},
+    OBSTACLE: {"Color": "cadetblue", "w": 0.8, "h": 0.8},
+}
 
-with open("city_files/2023_base.txt") as baseFile:
-    lines = baseFile.readlines()
-    width = len(lines[0]) - 1
-    height = len(lines)
 
-model_params = {"map_path": "/city_files/2023_base.txt"}
+class CityCanvasGrid(CanvasGrid):
+    """
+    Canvas grid that also draws the roads, destinations and obstacles from the static layers of the model.
+    """
 
-grid = CanvasGrid(agent_portrayal, width, height, 500, 500)
-car_count = CarCount()
-
-server = ModularServer(CityModel, [grid, car_count], "Traffic Base", model_params)
-server.port = 8522  # The default
-server.launch()
+    def render(self, model):
+        grid_state = super().render(model)
+        for kind, static_portrayal in static_portrayals.items():
+            for x, y in model.static_cells(kind):
+                portrayal = {
+                    "Shape": "rect",
+                    "Filled": "true",
+                    "Layer": 0,
+                    "x": x,
+                    "y": y,
+                }
+                portrayal.update(static_portrayal)
+                grid_state[0].append(portrayal)
+        return grid_state
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs the model in the mesa visualization"
+    )
+    parser.add_argument(
+        "--map",
+        default=DEFAULT_MAP,
+        help="Map file or name of a map in city_files (default %(default)s)",
+    )
+    parser.add_argument("--port", type=int, default=8522)
+    args = parser.parse_args()
+
+    # The size of the canvas comes from the compiled map, which the model then reuses
+    compiled_map = MapRegistry().get(args.map)
+    model_params = {"map_path": args.map, "compiled_map": compiled_map}
+
+    grid = CityCanvasGrid(
+        agent_portrayal, compiled_map.width, compiled_map.height, 500, 500
+    )
+    car_count = CarCount()
+
+    server = ModularServer(CityModel, [grid, car_count], "Traffic Base", model_params)
+    server.port = args.port
+    server.launch()
+
+
+if __name__ == "__main__":
+    main()
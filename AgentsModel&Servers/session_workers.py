@@ -0,0 +1,378 @@
+#Script que corre los modelos de las sesiones en procesos aparte, para que varias simulaciones usen varios núcleos
+
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import traceback
+import uuid
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from sessions import Session, SessionNotFound, SnapshotNotFound
+from state_feed import Changes
+
+logger = logging.getLogger(__name__)
+
+# Bytes of the first shared memory buffer of each worker. It grows when a reply doesn't fit
+BUFFER_BYTES = 1 << 20
+
+
+class _ArrayRef:
+    """Place of an array of a reply, which travels in the shared memory buffer instead of the pipe."""
+
+    def __init__(self, index):
+        self.index = index
+
+
+class _ChangesRef:
+    def __init__(self, attributes):
+        self.attributes = attributes
+
+
+def _export(value, arrays):
+    """Replaces the arrays in a reply by _ArrayRef, adding them to arrays."""
+    if isinstance(value, np.ndarray):
+        arrays.append(value)
+        return _ArrayRef(len(arrays) - 1)
+    if isinstance(value, Changes):
+        return _ChangesRef(
+            {name: _export(item, arrays) for name, item in vars(value).items()}
+        )
+    if isinstance(value, (list, tuple)):
+        return type(value)(_export(item, arrays) for item in value)
+    return value
+
+
+def _import(value, arrays):
+    """Inverse of _export."""
+    if isinstance(value, _ArrayRef):
+        return arrays[value.index]
+    if isinstance(value, _ChangesRef):
+        changes = Changes.__new__(Changes)
+        changes.__dict__.update(
+            {name: _import(item, arrays) for name, item in value.attributes.items()}
+        )
+        return changes
+    if isinstance(value, (list, tuple)):
+        return type(value)(_import(item, arrays) for item in value)
+    return value
+
+
+class _ReplyBuffer:
+    """Shared memory of a worker where it writes the arrays of its replies."""
+
+    def __init__(self):
+        self.memory = shared_memory.SharedMemory(create=True, size=BUFFER_BYTES)
+
+    def write(self, arrays):
+        """Copies the arrays to the buffer. Returns the name of the buffer and where each array is."""
+        layout = []
+        offset = 0
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            layout.append((array.dtype.str, array.shape, offset))
+            offset += -(-array.nbytes // 8) * 8
+        if offset > self.memory.size:
+            # The reader attaches to the new buffer by its name; the old one is gone once it lets it go
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = shared_memory.SharedMemory(create=True, size=2 * offset)
+        for array, (dtype, shape, start) in zip(arrays, layout):
+            view = np.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=start)
+            view[...] = array
+        return self.memory.name, layout
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+
+def _serve(connection):
+    """Main loop of a worker process: runs the commands of the pipe on its sessions."""
+    # Ctrl+C is handled by the server, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from map_registry import MapRegistry
+    from model import CityModel
+
+    maps = MapRegistry()
+    models = {}
+    buffer = _ReplyBuffer()
+    try:
+        while True:
+            try:
+                message = connection.recv()
+            except EOFError:
+                break
+            if message is None:
+                break
+            command, key, args, kwargs = message
+            try:
+                if command == "create":
+                    map_path, options, snapshot, seed = args
+                    model = CityModel(
+                        map_path, compiled_map=maps.get(map_path), **options
+                    )
+                    if snapshot is not None:
+                        model.restore(snapshot, seed)
+                    session = models[key] = Session(key, model)
+                    result = {
+                        "map_path": model.map_path,
+                        "light_ids": session.light_ids,
+                        "light_positions": session.light_positions,
+                    }
+                elif command == "close":
+                    result = models.pop(key, None) is not None
+                else:
+                    session = models[key]
+                    result = getattr(session, command)(*args, **kwargs)
+                arrays = []
+                reply = _export(result, arrays)
+                name, layout = buffer.write(arrays)
+                connection.send(
+                    (
+                        "ok",
+                        reply,
+                        models[key].step_counter if key in models else 0,
+                        name,
+                        layout,
+                    )
+                )
+            except (SnapshotNotFound, ValueError) as error:
+                # Errors of the request (a missing snapshot, a wrong parameter) are sent as they are,
+                # so the server answers them like the ones of a model of its own process
+                connection.send(("raise", error, 0, None, None))
+            except Exception:
+                connection.send(("error", traceback.format_exc(), 0, None, None))
+    finally:
+        buffer.close()
+
+
+class Worker:
+    """
+    Worker process and the end of its pipe. Calls are serialized with a lock, and the arrays of the
+    replies are copied out of the worker's shared memory before the lock is released.
+    """
+
+    def __init__(self, context):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(
+            target=_serve, args=(child,), name="session-worker", daemon=True
+        )
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self._memory = None
+
+    def call(self, command, key, *args, **kwargs):
+        """Runs a command in the worker. Returns the result and the step of the session."""
+        with self.lock:
+            try:
+                self.connection.send((command, key, args, kwargs))
+                status, reply, step, name, layout = self.connection.recv()
+            except (EOFError, OSError, BrokenPipeError) as error:
+                raise WorkerLost(f"The worker of model {key} stopped") from error
+            if status == "raise":
+                raise reply
+            if status == "error":
+                raise RuntimeError(f"Worker command {command} failed:\n{reply}")
+            arrays = []
+            if layout:
+                if self._memory is None or self._memory.name != name:
+                    if self._memory is not None:
+                        self._memory.close()
+                    self._memory = shared_memory.SharedMemory(name=name)
+                for dtype, shape, offset in layout:
+                    arrays.append(
+                        np.ndarray(
+                            shape, dtype=dtype, buffer=self._memory.buf, offset=offset
+                        ).copy()
+                    )
+        return _import(reply, arrays), step
+
+    @property
+    def alive(self):
+        return self.process.is_alive()
+
+    def stop(self):
+        with self.lock:
+            try:
+                self.connection.send(None)
+            except (OSError, BrokenPipeError):
+                pass
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.terminate()
+            if self._memory is not None:
+                self._memory.close()
+                self._memory = None
+            self.connection.close()
+
+
+class WorkerLost(SessionNotFound):
+    pass
+
+
+class WorkerPool:
+    """
+    Worker processes that host the models of the sessions. Each new session goes to the worker with
+    the fewest sessions, so the sessions are spread over the cores. Workers are started when they are
+    first needed, and a worker that died is replaced (its sessions are lost).
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+        # spawn, because forking a server that runs threads can copy held locks into the child
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = []
+        self._lock = threading.Lock()
+
+    def assign(self, key):
+        with self._lock:
+            for worker in [worker for worker in self.workers if not worker.alive]:
+                logger.warning(
+                    "Session worker %s stopped, %d sessions lost",
+                    worker.process.pid,
+                    len(worker.sessions),
+                )
+                self.workers.remove(worker)
+            if len(self.workers) < self.processes:
+                self.workers.append(Worker(self.context))
+            worker = min(self.workers, key=lambda worker: len(worker.sessions))
+            worker.sessions.add(key)
+            return worker
+
+    def release(self, worker, key):
+        with self._lock:
+            worker.sessions.discard(key)
+
+    def stop(self):
+        with self._lock:
+            for worker in self.workers:
+                worker.stop()
+            self.workers = []
+
+
+class StaticMap:
+    """Static layers of a compiled map, with the methods of CityModel that the web layer uses."""
+
+    def __init__(self, compiled):
+        self.width = compiled.width
+        self.height = compiled.height
+        self.cell_kinds = np.asarray(compiled.kinds)
+        self.road_directions = np.asarray(compiled.directions)
+
+    def cell_id(self, position):
+        x, y = position
+        return (self.height - y - 1) * self.width + x
+
+    def static_cells(self, kind):
+        return [
+            tuple(position)
+            for position in np.argwhere(self.cell_kinds == kind).tolist()
+        ]
+
+
+class WorkerSession(Session):
+    """
+    Session whose model lives in a worker process of a WorkerPool. It has the same methods as
+    Session; each one is a call to the worker, and the arrays come back through shared memory.
+    With a snapshot (see Session.export_snapshot) the model starts from it instead of from the
+    beginning, which forks another session that may live in another worker.
+    """
+
+    def __init__(
+        self,
+        session_id,
+        pool,
+        map_path,
+        compiled_map,
+        options,
+        snapshot=None,
+        seed=None,
+    ):
+        self.pool = pool
+        # The model has its own key in the worker, because a session that replaces another one with
+        # the same id is created before the old one is closed
+        self.key = uuid.uuid4().hex
+        self.worker = pool.assign(self.key)
+        try:
+            info, self._step = self.worker.call(
+                "create", self.key, map_path, options, snapshot, seed
+            )
+        except Exception:
+            pool.release(self.worker, self.key)
+            raise
+        self.model = None
+        self.static = StaticMap(compiled_map)
+        self._map_path = info["map_path"]
+        self.light_ids = info["light_ids"]
+        self.light_positions = info["light_positions"]
+        self._setup(session_id)
+
+    def _call(self, command, *args, **kwargs):
+        result, self._step = self.worker.call(command, self.key, *args, **kwargs)
+        return result
+
+    @property
+    def map_path(self):
+        return self._map_path
+
+    @property
+    def step_counter(self):
+        return self._step
+
+    def step(self):
+        self._call("step")
+
+    def advance(self, steps, since=None, run=None, intermediate=False):
+        return self._call("advance", steps, since, run, intermediate)
+
+    def changes(self, since=None, run=None):
+        return self._call("changes", since, run)
+
+    def car_states(self):
+        return self._call("car_states")
+
+    def light_states(self):
+        return self._call("light_states")
+
+    def metrics(self):
+        return self._call("metrics")
+
+    def snapshot(self):
+        return self._call("snapshot")
+
+    def snapshot_list(self):
+        return self._call("snapshot_list")
+
+    def export_snapshot(self, snapshot_id):
+        return self._call("export_snapshot", snapshot_id)
+
+    def restore(self, snapshot_id):
+        self._call("restore", snapshot_id)
+        self._end_streams()
+
+    def checkpoint(self):
+        return self._call("checkpoint")
+
+    def rewind(self, snapshot):
+        self._call("rewind", snapshot)
+
+    def set_parameters(self, spawn_interval=None, light_periods=None):
+        self._call("set_parameters", spawn_interval, light_periods)
+
+    def estimate_bytes(self):
+        with self.lock:
+            return self._call("estimate_bytes")
+
+    def close(self):
+        super().close()
+        try:
+            self._call("close")
+        except SessionNotFound:
+            pass
+        self.pool.release(self.worker, self.key)
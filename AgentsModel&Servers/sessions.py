@@ -0,0 +1,343 @@
+#Script que guarda las simulaciones de cada cliente del servidor, cada una con su modelo y su candado, y borra las que no se usan
+
+import collections
+import contextlib
+import logging
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from frame_stream import FrameBroadcaster
+from profiling import prometheus_text
+
+logger = logging.getLogger(__name__)
+
+# Seconds without requests after which a session is deleted
+SESSION_TTL = 30 * 60
+# Memory that all the sessions together can use (estimated with estimate_bytes)
+MAX_SESSION_BYTES = 2 * 1024**3
+
+# Constants of estimate_bytes, measured with tracemalloc on the maps of city_files
+MODEL_BYTES = 64 * 1024
+CELL_BYTES = 120
+CAR_BYTES = 1500
+NX_EDGE_BYTES = 800
+# Snapshots kept by each session; saving another one drops the oldest
+MAX_SNAPSHOTS = 16
+
+
+class SessionNotFound(LookupError):
+    pass
+
+
+class SnapshotNotFound(LookupError):
+    pass
+
+
+def estimate_bytes(model):
+    """
+    Rough memory used by a model: the mesa grid, the graph, the cars and the next-hop tables.
+    The compiled map is not counted because it is shared by the models of the same map.
+    """
+    size = MODEL_BYTES + CELL_BYTES * model.width * model.height
+    size += CAR_BYTES * model.car_count()
+    if model.graph_backend == "csr":
+        size += model.graph.nbytes()
+    else:
+        size += NX_EDGE_BYTES * model.graph.number_of_edges()
+    tables = [table for _, table in model.next_hop_tables.values()]
+    if model.fleet is not None:
+        tables += list(model.fleet.tables.values())
+        size += sum(
+            array.nbytes
+            for array in vars(model.fleet).values()
+            if isinstance(array, np.ndarray)
+        )
+    return size + sum(table.nbytes for table in tables)
+
+
+class Session:
+    """
+    One simulation of the server, with its model in this process. The web layer only uses the
+    methods of Session, so the model can also live in a worker process (see session_workers).
+    Attributes:
+        id: Id that the client sends with every request
+        model: CityModel of the session
+        static: Object with the static layers of the map (static_cells, cell_id, road_directions)
+        light_ids, light_positions: Id and position of each traffic light, in the order of the states
+        lock: Held while the model is stepped or read, by the requests and by the clock
+        clock: SimulationClock of /startClock, or None
+        frames: FrameBuffer of /startBuffer, or None
+        broadcaster: Newest frame for the clients of /stream
+        current_step: Steps made through /update and /step
+        last_used: time.monotonic() of the last request
+        snapshots: snapshots.Snapshot of the model by id, oldest first
+    """
+
+    def __init__(self, session_id, model):
+        self.model = model
+        self.static = model
+        self.light_ids = [str(light.unique_id) for light in model.traffic_lights]
+        self.light_positions = [light.pos for light in model.traffic_lights]
+        self.snapshots = collections.OrderedDict()
+        self._setup(session_id)
+
+    def _setup(self, session_id):
+        self.id = session_id
+        self.lock = threading.RLock()
+        self.clock = None
+        self.frames = None
+        self.broadcaster = FrameBroadcaster()
+        self.current_step = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def map_path(self):
+        return self.model.map_path
+
+    @property
+    def step_counter(self):
+        return self.model.step_counter
+
+    def step(self):
+        self.model.step()
+
+    def advance(self, steps, since=None, run=None, intermediate=False):
+        """
+        Steps the model and returns state_feed.Changes frames: the changes since the step since, or,
+        with intermediate, also one frame with the changes of each step after the first.
+        """
+        frames = []
+        feed = self.model.state_feed
+        for i in range(steps):
+            self.model.step()
+            if intermediate and i < steps - 1:
+                frames.append(feed.changes(since, run))
+                since, run = self.model.step_counter, feed.run
+        frames.append(feed.changes(since, run))
+        return frames
+
+    def changes(self, since=None, run=None):
+        return self.model.state_feed.changes(since, run)
+
+    def car_states(self):
+        return self.model.car_states()
+
+    def light_states(self):
+        return self.model.traffic_light_controller.light_states()
+
+    def metrics(self):
+        return prometheus_text(self.model)
+
+    def snapshot(self):
+        """Saves the state of the model. Returns the id, step and size of the snapshot."""
+        snapshot = self.model.snapshot()
+        self.snapshots[snapshot.id] = snapshot
+        while len(self.snapshots) > MAX_SNAPSHOTS:
+            self.snapshots.popitem(last=False)
+        return _snapshot_info(snapshot)
+
+    def snapshot_list(self):
+        return [_snapshot_info(snapshot) for snapshot in self.snapshots.values()]
+
+    def export_snapshot(self, snapshot_id):
+        """snapshots.Snapshot with an id, to fork the session. Raises SnapshotNotFound."""
+        snapshot = self.snapshots.get(snapshot_id)
+        if snapshot is None:
+            raise SnapshotNotFound(f"Snapshot {snapshot_id} not found")
+        return snapshot
+
+    def restore(self, snapshot_id):
+        """
+        Puts the model back in the state of a snapshot. The streams of the session end, so their
+        clients connect again and get a full snapshot.
+        """
+        self.model.restore(self.export_snapshot(snapshot_id))
+        self._end_streams()
+
+    def checkpoint(self):
+        """snapshots.Snapshot of the model that the session doesn't keep, for the frame buffer."""
+        return self.model.snapshot()
+
+    def rewind(self, snapshot):
+        """Puts the model back in the state of a snapshot of checkpoint."""
+        self.model.restore(snapshot)
+
+    def set_parameters(self, spawn_interval=None, light_periods=None):
+        self.model.set_parameters(spawn_interval, light_periods)
+
+    @contextlib.contextmanager
+    def changing_model(self):
+        """
+        Block that changes the model outside of the frame buffer, with the lock held. If the buffer
+        runs, the model goes back to the frame the client has before the block, and the buffer
+        computes its frames again from the model after it.
+        """
+        frames = self.frames
+        if frames is None:
+            yield
+            return
+        frames.rewind()
+        try:
+            yield
+        finally:
+            frames.resync()
+
+    def _end_streams(self):
+        self.broadcaster.close()
+        self.broadcaster = FrameBroadcaster()
+
+    def estimate_bytes(self):
+        with self.lock:
+            return estimate_bytes(self.model) + sum(
+                snapshot.nbytes for snapshot in self.snapshots.values()
+            )
+
+    def stop_clock(self, wait=True):
+        """
+        Stops the clock. It is taken out of the session with the lock held, so a clock started at the
+        same time is not lost. With wait=True it then waits for the thread of the clock, which needs the
+        lock, so it can only be called with the lock held with wait=False.
+        """
+        with self.lock:
+            clock, self.clock = self.clock, None
+            if clock is not None:
+                clock.stop(wait=False)
+        if clock is not None and wait:
+            clock.stop()
+
+    def stop_buffer(self, wait=True):
+        """Stops the frame buffer, like stop_clock does with the clock."""
+        with self.lock:
+            frames, self.frames = self.frames, None
+            if frames is not None:
+                frames.stop(wait=False)
+        if frames is not None and wait:
+            frames.stop()
+
+    def close(self):
+        """Stops the clock and the frame buffer and ends the streams of the session."""
+        self.stop_clock()
+        self.stop_buffer()
+        self.broadcaster.close()
+
+    @property
+    def busy(self):
+        """Whether the session is used even without requests: its clock runs or someone follows its stream."""
+        return (
+            self.clock is not None and self.clock.running
+        ) or self.broadcaster.subscribers > 0
+
+
+def _snapshot_info(snapshot):
+    return {"id": snapshot.id, "step": snapshot.step, "bytes": snapshot.nbytes}
+
+
+class SessionStore:
+    """
+    Sessions by id. Sessions that are not busy are deleted after ttl seconds without requests, and the
+    least recently used ones are deleted when the estimated memory of all of them goes over max_bytes.
+    Attributes:
+        default_id: Session used by the requests that don't send an id, the last one created without an id
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_bytes=MAX_SESSION_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.default_id = None
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def create(self, make_session, session_id=None):
+        """
+        Adds the session returned by make_session(session_id). An existing session with the same id is
+        replaced. Without an id the session replaces the default one and takes its id, like the model
+        of the old server, so clients that don't send ids don't leave a session behind on every call;
+        when there is no default session a new id is made. Either way the session becomes the default.
+        """
+        if session_id is None:
+            with self._lock:
+                session_id = self.default_id or uuid.uuid4().hex
+            make_default = True
+        else:
+            make_default = False
+        session = make_session(session_id)
+        with self._lock:
+            old = self._sessions.pop(session_id, None)
+            self._sessions[session_id] = session
+            if make_default:
+                self.default_id = session_id
+        if old is not None:
+            old.close()
+        self.evict(keep=session_id)
+        return session
+
+    def get(self, session_id=None):
+        """Session with an id (the default one without an id). Raises SessionNotFound."""
+        self.expire()
+        session_id = session_id or self.default_id
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None:
+            raise SessionNotFound(
+                f"Session {session_id} not found"
+                if session_id
+                else "No session, call /init"
+            )
+        session.last_used = time.monotonic()
+        return session
+
+    def remove(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if self.default_id == session_id:
+                self.default_id = None
+        if session is None:
+            raise SessionNotFound(f"Session {session_id} not found")
+        session.close()
+
+    def sessions(self):
+        with self._lock:
+            return list(self._sessions.values())
+
+    def expire(self, keep=None):
+        """Deletes the sessions that are not busy and were not used in the last ttl seconds."""
+        now = time.monotonic()
+        expired = [
+            session
+            for session in self.sessions()
+            if session.id != keep
+            and now - session.last_used > self.ttl
+            and not session.busy
+        ]
+        for session in expired:
+            logger.info("Session %s expired", session.id)
+            self._discard(session)
+
+    def evict(self, keep=None):
+        """Deletes the expired sessions, and then the least recently used ones while over max_bytes."""
+        self.expire(keep)
+        sessions = sorted(self.sessions(), key=lambda session: session.last_used)
+        sizes = {session.id: session.estimate_bytes() for session in sessions}
+        total = sum(sizes.values())
+        for session in sessions:
+            if total <= self.max_bytes:
+                break
+            if session.id == keep:
+                continue
+            logger.info("Session %s evicted to free memory", session.id)
+            total -= sizes[session.id]
+            self._discard(session)
+
+    def _discard(self, session):
+        with self._lock:
+            if self._sessions.get(session.id) is session:
+                del self._sessions[session.id]
+                if self.default_id == session.id:
+                    self.default_id = None
+        session.close()
@@ -0,0 +1,241 @@
+#Script que guarda el estado de un modelo en un paso y lo restaura, en el mismo modelo o en uno nuevo para bifurcar la simulación
+
+import os
+import pickle
+import uuid
+
+import numpy as np
+
+from agent import Car
+from state_feed import StateFeed
+
+# Attributes of CityModel saved as they are
+COUNTERS = (
+    "step_counter",
+    "agents_arrived",
+    "num_agents",
+    "spawn_interval",
+    "running",
+    "next_hop_routing",
+    "route_refresh",
+    "last_route_refresh",
+    "routes_dirty",
+)
+# Arrays of CarFleet with one value per car
+FLEET_ARRAYS = ("ids", "cells", "destinations", "waiting")
+
+
+class Snapshot:
+    """
+    Dynamic state of a CityModel at one step: the cars with their destinations and routes, the traffic
+    lights, the state of the random number generator and the counters. The map, its static layers and
+    the road graph are not saved. The weights of the graph are rebuilt from the positions of the cars.
+    The next-hop tables are not saved either, since their size grows with the map: the snapshot keeps
+    the cells that were occupied at the last refresh of the routes, and the restored model rebuilds the
+    tables lazily from them, with the same result. The data collector is not saved either, since it
+    only keeps the history of the run.
+    Attributes:
+        id: Random id of the snapshot
+        step: step_counter of the model
+        map_path, engine, graph_backend: Kind of model the snapshot can be restored into
+        cars: Arrays with one value per car, in the order of the schedule. cells are numbered
+            y * width + x and destinations are indices of model.destination_list (-1 for none)
+        routes: Path and route of each car of the "agents" engine that has one, by id
+        nbytes: Size of the snapshot pickled, which is what a fork to another process sends
+    """
+
+    def __init__(self, model):
+        self.id = uuid.uuid4().hex[:12]
+        self.step = model.step_counter
+        self.map_path = os.path.abspath(model.map_path)
+        self.engine = model.engine
+        self.graph_backend = model.graph_backend
+        self.size = (model.width, model.height)
+
+        self.counters = {name: getattr(model, name) for name in COUNTERS}
+        # Cells of route_occupied, numbered x * height + y
+        self.route_cells = np.flatnonzero(model.route_occupied)
+        # Edges of step_changed_edges as pairs of cells numbered y * width + x. changed_edges is not
+        # saved, since the next step replaces it before it is read
+        self.step_changed_edges = _edge_array(model.step_changed_edges, model.width)
+        self.schedule = (model.schedule.steps, model.schedule.time)
+        self.random = model.random.getstate()
+
+        controller = model.traffic_light_controller
+        # The periods only change per light character and the offsets never change, so only the period
+        # of each character and the state of each group (one bit each) are saved
+        self.light_periods = dict(
+            zip(model.light_chars, controller.periods[controller.groups].tolist())
+        )
+        self.light_states = np.packbits(controller.states)
+        self.next_light_change = controller.next_change
+
+        if model.fleet is not None:
+            fleet = model.fleet
+            self.cars = {name: getattr(fleet, name).copy() for name in FLEET_ARRAYS}
+            self.routes = {}
+        else:
+            self.cars, self.routes = _save_cars(model)
+        self.nbytes = len(pickle.dumps(self, pickle.HIGHEST_PROTOCOL))
+
+    def restore(self, model, seed=None):
+        """
+        Puts a model in the state of the snapshot. The model can be the one the snapshot was taken
+        from or a new model of the same map and engine, which makes a fork. The state feed of the model
+        starts a new run, so its clients get a full snapshot.
+        Args:
+            model: CityModel to change
+            seed: Seed for the random number generator instead of its saved state, so forks of the
+                same snapshot don't repeat the same future
+        """
+        kind = (
+            os.path.abspath(model.map_path),
+            model.engine,
+            model.graph_backend,
+            (model.width, model.height),
+        )
+        if kind != (self.map_path, self.engine, self.graph_backend, self.size):
+            raise ValueError(
+                "The snapshot was taken from a model of another map or engine"
+            )
+
+        width = model.width
+        cells = self.cars["cells"]
+        occupancy = np.zeros_like(model.occupancy)
+        np.add.at(occupancy, (cells % width, cells // width), 1)
+        if model.fleet is not None:
+            fleet = model.fleet
+            for name in FLEET_ARRAYS:
+                setattr(fleet, name, self.cars[name].copy())
+        else:
+            _restore_cars(model, self.cars, self.routes)
+        model.set_occupancy(occupancy)
+
+        for name, value in self.counters.items():
+            setattr(model, name, value)
+        # Drops the next-hop tables of the model and bumps weights_version
+        route_occupied = np.zeros(model.width * model.height, dtype=bool)
+        route_occupied[self.route_cells] = True
+        model.refresh_routes(route_occupied.reshape(model.width, model.height))
+        # After set_occupancy, which adds the edges it changed to step_changed_edges
+        model.changed_edges = set()
+        model.step_changed_edges = _edge_set(self.step_changed_edges, width)
+        model.schedule.steps, model.schedule.time = self.schedule
+
+        controller = model.traffic_light_controller
+        controller.set_periods(
+            [self.light_periods[char] for char in model.light_chars], self.step
+        )
+        controller.states = np.unpackbits(
+            self.light_states, count=controller.states.size
+        ).astype(bool)
+        controller.next_change = self.next_light_change
+        controller.update_signal_layer()
+
+        # Last, because creating the cars above draws random numbers
+        model.random.setstate(self.random)
+        if seed is not None:
+            model.reset_randomizer(seed)
+        if model.state_feed is not None:
+            model.state_feed = StateFeed(model, model.state_feed.deltas.maxlen)
+
+
+def _edge_array(edges, width):
+    """Array with the source and target cells of a set of edges, numbered y * width + x."""
+    cells = np.array(list(edges), dtype=np.int64).reshape(-1, 2, 2)
+    return (cells[:, :, 1] * width + cells[:, :, 0]).astype(np.int32)
+
+
+def _edge_set(array, width):
+    """Set of edges of an array of _edge_array."""
+    return {
+        ((source % width, source // width), (target % width, target // width))
+        for source, target in array.tolist()
+    }
+
+
+def _save_cars(model):
+    """Arrays and routes of the mesa cars of a model, in the order of the schedule."""
+    cars = [model.cars[car_id] for car_id in model.schedule.get_agent_keys()]
+    routes = {
+        car.unique_id: (
+            car.path,
+            car.path_calculated,
+            car.route,
+            list(car.route_weights),
+        )
+        for car in cars
+        if car.path is not None or car.route is not None
+    }
+    arrays = {
+        "ids": np.array([car.unique_id for car in cars], dtype=np.int64),
+        "cells": np.array(
+            [car.pos[1] * model.width + car.pos[0] for car in cars], dtype=np.int64
+        ),
+        "destinations": np.array(
+            [
+                (
+                    model.destination_ids[car.destination.pos]
+                    if car.destination is not None
+                    else -1
+                )
+                for car in cars
+            ],
+            dtype=np.int32,
+        ),
+        "waiting": np.array([car.waiting for car in cars], dtype=np.int32),
+        "route_index": np.array([car.route_index for car in cars], dtype=np.int32),
+        "checked_index": np.array([car.checked_index for car in cars], dtype=np.int32),
+        "checked_step": np.array([car.checked_step for car in cars], dtype=np.int32),
+        "moving": np.array([car.moving for car in cars], dtype=bool),
+    }
+    return arrays, routes
+
+
+def _restore_cars(model, arrays, routes):
+    """Replaces the mesa cars of a model by the ones of _save_cars. The occupancy is left to the caller."""
+    for car in list(model.cars.values()):
+        model.schedule.remove(car)
+        model.grid.remove_agent(car)
+    model.cars = {}
+
+    width = model.width
+    destinations = model.destination_list
+    for (
+        car_id,
+        cell,
+        destination,
+        waiting,
+        route_index,
+        checked_index,
+        checked_step,
+        moving,
+    ) in zip(
+        *(
+            arrays[name].tolist()
+            for name in (
+                "ids",
+                "cells",
+                "destinations",
+                "waiting",
+                "route_index",
+                "checked_index",
+                "checked_step",
+                "moving",
+            )
+        )
+    ):
+        car = Car(car_id, model, model.graph, moving=moving)
+        car.destination = destinations[destination] if destination >= 0 else None
+        car.waiting = waiting
+        car.route_index = route_index
+        car.checked_index = checked_index
+        car.checked_step = checked_step
+        if car_id in routes:
+            path, car.path_calculated, route, route_weights = routes[car_id]
+            car.path = None if path is None else list(path)
+            car.route = None if route is None else list(route)
+            car.route_weights = list(route_weights)
+        model.grid.place_agent(car, (cell % width, cell // width))
+        model.schedule.add(car)
+        model.cars[car_id] = car
@@ -0,0 +1,177 @@
+#Script que guarda los cambios de cada paso del modelo para mandar a los clientes solo lo que cambió desde el último paso que vieron
+
+import collections
+import uuid
+
+import numpy as np
+
+_NO_IDS = np.zeros(0, dtype=np.int64)
+
+
+class StepDelta:
+    """
+    Changes made by one step of the model.
+    Attributes:
+        step: Step of the model after the changes
+        spawned: Ids of the cars created in the step
+        changed: Ids of the cars that already existed and moved or changed destination
+        retargeted: Ids of the cars (of changed) whose destination changed
+        removed: Ids of the cars that arrived
+        lights: Indices of the traffic lights that changed state
+    """
+
+    def __init__(self, step, spawned, changed, retargeted, removed, lights):
+        self.step = step
+        self.spawned = spawned
+        self.changed = changed
+        self.retargeted = retargeted
+        self.removed = removed
+        self.lights = lights
+
+
+class Changes:
+    """
+    State of the model that a client is missing, returned by StateFeed.changes.
+    Attributes:
+        run: Id of the feed, that changes with every new model
+        step: Step of the model
+        full: Whether it is a whole snapshot (every car and light) instead of the changes
+        ids, x, y: Cars that are new or changed, and their positions
+        send_destination: Whether the client doesn't know the destination of each car (dest_x and dest_y)
+        dest_x, dest_y: Destination of each car
+        removed: Ids of the cars that arrived
+        lights: Indices of the traffic lights included, in model.traffic_lights
+        light_states: State of each of those lights
+    """
+
+    def __init__(
+        self, run, step, full, cars, send_destination, removed, lights, light_states
+    ):
+        self.run = run
+        self.step = step
+        self.full = full
+        self.ids, self.x, self.y, self.dest_x, self.dest_y = cars
+        self.send_destination = send_destination
+        self.removed = removed
+        self.lights = lights
+        self.light_states = light_states
+
+
+class StateFeed:
+    """
+    Keeps the changes of the last steps of a model, so a client that saw step s only gets the cars
+    that moved, were created or arrived and the lights that changed after s. The work and the size of
+    the answer depend on how much changed, not on the number of cars. A client that is further behind
+    than the history (or that saw another model) gets a full snapshot.
+    Attributes:
+        model: CityModel whose state is followed. record must be called after each step
+        run: Random id of this feed
+        deltas: StepDelta of the last steps, oldest first
+    """
+
+    def __init__(self, model, history=64):
+        self.model = model
+        self.run = uuid.uuid4().hex[:12]
+        self.deltas = collections.deque(maxlen=history)
+        self.step = model.step_counter
+        self._cars = self._car_states()
+        self._lights = self._light_states()
+
+    def _car_states(self):
+        """Car states sorted by id. The arrays are copies, since a CarFleet changes its own in place."""
+        states = self.model.car_states()
+        ids = states[0]
+        if ids.size > 1 and not np.all(ids[1:] > ids[:-1]):
+            order = np.argsort(ids, kind="stable")
+            return tuple(array[order] for array in states)
+        return tuple(array.copy() for array in states)
+
+    def _light_states(self):
+        return self.model.traffic_light_controller.light_states()
+
+    def record(self):
+        """Compares the state of the model with the one of the last call and keeps the difference."""
+        previous_ids, *previous = self._cars
+        cars = self._car_states()
+        ids, *current = cars
+        lights = self._light_states()
+
+        _, old, new = np.intersect1d(
+            previous_ids, ids, assume_unique=True, return_indices=True
+        )
+        moved = np.zeros(new.size, dtype=bool)
+        for before, after in zip(previous[:2], current[:2]):
+            moved |= before[old] != after[new]
+        retargeted = np.zeros(new.size, dtype=bool)
+        for before, after in zip(previous[2:], current[2:]):
+            retargeted |= before[old] != after[new]
+
+        kept = np.zeros(ids.size, dtype=bool)
+        kept[new] = True
+        stayed = np.zeros(previous_ids.size, dtype=bool)
+        stayed[old] = True
+        self.deltas.append(
+            StepDelta(
+                self.model.step_counter,
+                spawned=ids[~kept],
+                changed=ids[new[moved | retargeted]],
+                retargeted=ids[new[retargeted]],
+                removed=previous_ids[~stayed],
+                lights=np.flatnonzero(lights != self._lights),
+            )
+        )
+        self.step = self.model.step_counter
+        self._cars = cars
+        self._lights = lights
+
+    def changes(self, since=None, run=None):
+        """
+        Changes after step since. Returns a full snapshot when since is None, when run is not the run
+        of this feed, or when the changes after since are no longer kept.
+        """
+        ids, x, y, dest_x, dest_y = self._cars
+        oldest = self.deltas[0].step - 1 if self.deltas else self.step
+        if (
+            since is None
+            or (run is not None and run != self.run)
+            or not oldest <= since <= self.step
+        ):
+            lights = np.arange(self._lights.size)
+            return Changes(
+                self.run,
+                self.step,
+                True,
+                self._cars,
+                np.ones(ids.size, dtype=bool),
+                _NO_IDS,
+                lights,
+                self._lights,
+            )
+
+        missed = [delta for delta in self.deltas if delta.step > since]
+        spawned = _union([delta.spawned for delta in missed])
+        changed = _union([delta.changed for delta in missed] + [spawned])
+        retargeted = _union([delta.retargeted for delta in missed] + [spawned])
+        # Cars that were created and arrived after since were never seen by the client
+        removed = np.setdiff1d(
+            _union([delta.removed for delta in missed]), spawned, assume_unique=True
+        )
+        rows = np.searchsorted(ids, changed[np.isin(changed, ids, assume_unique=True)])
+        lights = _union([delta.lights for delta in missed])
+        return Changes(
+            self.run,
+            self.step,
+            False,
+            (ids[rows], x[rows], y[rows], dest_x[rows], dest_y[rows]),
+            np.isin(ids[rows], retargeted, assume_unique=True),
+            removed,
+            lights,
+            self._lights[lights],
+        )
+
+
+def _union(arrays):
+    arrays = [array for array in arrays if array.size]
+    if not arrays:
+        return _NO_IDS
+    return np.unique(np.concatenate(arrays))
@@ -0,0 +1,144 @@
+#Script con un cliente de prueba que sigue la simulación por /stream sin Unity y revisa que el estado recibido sea correcto
+
+import argparse
+import json
+import time
+
+import requests
+
+
+class StateMirror:
+    """
+    Copy of the cars and traffic lights of the server, built from the frames of /stream or
+    /getAgents?since=.
+    Attributes:
+        cars: Last data received for each car, by id
+        lights: State of each traffic light, by id
+        step, run: Step and run of the last frame
+    """
+
+    def __init__(self):
+        self.cars = {}
+        self.lights = {}
+        self.step = None
+        self.run = None
+
+    def apply(self, frame):
+        if frame["full"]:
+            self.cars = {}
+            self.lights = {}
+        for car in frame["data"]:
+            self.cars[car["id"]] = {**self.cars.get(car["id"], {}), **car}
+        for car_id in frame["removed"]:
+            self.cars.pop(car_id, None)
+        for light in frame["lights"]:
+            self.lights[light["id"]] = light["state"]
+        self.step = frame["step"]
+        self.run = frame["run"]
+
+
+def server_sent_events(response):
+    """(event, data) of each Server-Sent Event of a streamed response. Comments are skipped."""
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if line:
+            if line.startswith(":"):
+                continue
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "event":
+                event = value
+            elif field == "data":
+                data.append(value)
+        elif data:
+            yield event, "\n".join(data)
+            event, data = "message", []
+
+
+def run(url, map_path, rate, frames, delay):
+    """
+    Starts a model and its clock, follows /stream for a number of frames (waiting delay seconds
+    after each one, to act as a slow client) and checks the result against the full state.
+    Returns a summary.
+    """
+    response = requests.post(f"{url}/init", data={"MapPath": map_path})
+    response.raise_for_status()
+    session = {"session": response.json()["session"]}
+    requests.post(
+        f"{url}/startClock", data={"rate": rate, **session}
+    ).raise_for_status()
+
+    mirror = StateMirror()
+    received = 0
+    start = time.perf_counter()
+    with requests.get(f"{url}/stream", params=session, stream=True) as response:
+        response.raise_for_status()
+        for event, data in server_sent_events(response):
+            if event != "frame":
+                continue
+            mirror.apply(json.loads(data))
+            received += 1
+            if received >= frames:
+                break
+            time.sleep(delay)
+    seconds = time.perf_counter() - start
+    requests.post(f"{url}/stopClock", data=session).raise_for_status()
+
+    # Catch up with the steps made after the last frame, and compare with the full state
+    mirror.apply(
+        requests.get(
+            f"{url}/getAgents",
+            params={"since": mirror.step, "run": mirror.run, **session},
+        ).json()
+    )
+    cars = {
+        car["id"]: car
+        for car in requests.get(f"{url}/getAgents", params=session).json()["data"]
+    }
+    lights = {
+        light["id"]: light["state"]
+        for light in requests.get(f"{url}/getTrafficLights", params=session).json()[
+            "data"
+        ]
+    }
+    requests.post(f"{url}/closeSession", data=session).raise_for_status()
+    return {
+        "frames": received,
+        "steps": mirror.step,
+        "seconds": seconds,
+        "frames_per_second": received / seconds,
+        "steps_per_frame": mirror.step / max(received, 1),
+        "cars": len(mirror.cars),
+        "consistent": mirror.cars == cars and mirror.lights == lights,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Follows the simulation of flask_server.py through /stream"
+    )
+    parser.add_argument("--url", default="http://localhost:8585")
+    parser.add_argument("--map", default="2023_base.txt")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Steps per second of the clock (0 for as fast as possible)",
+    )
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument(
+        "--delay",
+        type=float,
+        default=0,
+        help="Seconds to wait after each frame, to simulate a slow client",
+    )
+    args = parser.parse_args()
+
+    summary = run(args.url, args.map, args.rate, args.frames, args.delay)
+    for key, value in summary.items():
+        print(f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}")
+    return 0 if summary["consistent"] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
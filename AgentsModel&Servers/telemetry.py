@@ -0,0 +1,206 @@
+#Script que envía los resultados del modelo al servidor de la clase en un hilo aparte, sin detener la simulación
+
+import json
+import logging
+import os
+import queue
+import threading
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Servidor de la clase. La variable de ambiente TELEMETRY_URL lo cambia, y con "off" no se envía nada
+DEFAULT_ENDPOINT = "http://52.1.3.19:8585/api/validate_attempt"
+
+
+def default_endpoint():
+    """Endpoint from the TELEMETRY_URL environment variable, or the class server. None when it is "off"."""
+    endpoint = os.environ.get("TELEMETRY_URL", DEFAULT_ENDPOINT)
+    if endpoint.strip().lower() in ("", "off", "0", "false"):
+        return None
+    return endpoint
+
+
+class TelemetrySender:
+    """
+    Sends reports to an HTTP endpoint from a background thread.
+
+    send() only puts the report in a bounded queue, so the caller never waits for the network. When the
+    queue is full the oldest report is dropped. The thread takes up to batch_size reports at a time and
+    posts them with a timeout, retrying failed requests with exponential backoff.
+    Attributes:
+        endpoint: URL where the reports are posted
+        latest_only: Post only the newest report of each key in a batch, for reports that replace the
+            previous ones of the same source (like a running total). Otherwise a batch of several
+            reports is posted as a JSON list
+        sent, failed, dropped: Number of reports posted, given up after the retries, and dropped
+    """
+
+    def __init__(
+        self,
+        endpoint,
+        max_queue=100,
+        batch_size=10,
+        timeout=2.0,
+        retries=3,
+        backoff=0.5,
+        latest_only=False,
+    ):
+        """
+        Args:
+            endpoint: URL where the reports are posted
+            max_queue: Reports kept while waiting to be sent
+            batch_size: Maximum reports posted in one request
+            timeout: Seconds to wait for each request
+            retries: Extra attempts for a batch after a connection error or a 5xx response
+            backoff: Seconds before the first retry, doubled on each one
+            latest_only: Post only the newest report of each key in a batch
+        """
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.latest_only = latest_only
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._session = requests.Session()
+
+    def send(self, report, key=None):
+        """
+        Queues a report without blocking. Returns False if an older report had to be dropped.
+        key names the source of the report (for example the model), so with latest_only the reports of
+        different sources that share the sender don't replace each other.
+        """
+        self._start()
+        item = (key, report)
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+
+        # Make room by dropping the oldest report
+        with self._lock:
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+        return False
+
+    def close(self, timeout=None):
+        """
+        Stops the thread after it posts the reports in the queue (without more retries), waiting at
+        most timeout seconds.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="telemetry", daemon=True
+                )
+                self._thread.start()
+
+    def _next_batch(self):
+        """Waits for a report and takes the ones behind it, up to batch_size."""
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._post(batch)
+            elif self._stop.is_set():
+                return
+
+    def _post(self, batch):
+        if not self.latest_only:
+            reports = [report for _, report in batch]
+            self._post_body(reports[0] if len(reports) == 1 else reports, len(reports))
+            return
+
+        # Newest report of each key, standing for the older ones of the same key
+        latest = {}
+        counts = {}
+        for key, report in batch:
+            latest[key] = report
+            counts[key] = counts.get(key, 0) + 1
+        for key, report in latest.items():
+            self._post_body(report, counts[key])
+
+    def _post_body(self, body, count):
+        """Posts one request with retries. count is the number of reports it stands for."""
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._session.post(
+                    self.endpoint,
+                    data=json.dumps(body),
+                    headers={"Content-Type": "application/json"},
+                    timeout=self.timeout,
+                )
+                # Only server errors are worth retrying
+                if response.status_code < 500:
+                    if response.status_code < 400:
+                        self.sent += count
+                    else:
+                        self.failed += count
+                        logger.warning(
+                            "Request failed. Status code: %d", response.status_code
+                        )
+                    return
+            except requests.RequestException:
+                pass
+
+            if attempt < self.retries and not self._stop.is_set():
+                self._stop.wait(self.backoff * 2**attempt)
+
+        self.failed += count
+        logger.warning(
+            "Request failed after %d attempts: %s", self.retries + 1, self.endpoint
+        )
+
+
+# One sender per endpoint, shared by all the models of the process
+_senders = {}
+_senders_lock = threading.Lock()
+
+
+def get_sender(endpoint=None, **options):
+    """
+    Shared sender for an endpoint (by default default_endpoint()). Returns None if telemetry is off.
+    The options are only used when the sender is created.
+    """
+    if endpoint is None:
+        endpoint = default_endpoint()
+        if endpoint is None:
+            return None
+    with _senders_lock:
+        if endpoint not in _senders:
+            _senders[endpoint] = TelemetrySender(endpoint, **options)
+        return _senders[endpoint]
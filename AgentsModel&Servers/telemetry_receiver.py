@@ -0,0 +1,37 @@
+#Script con un servidor local que recibe los reportes del modelo en lugar del servidor de la clase, para probar sin red
+
+import argparse
+
+from flask import Flask, jsonify, request
+
+app = Flask("Telemetry Receiver")
+
+# Reports received since the server started
+attempts = []
+
+
+@app.route("/api/validate_attempt", methods=["POST"])
+def validate_attempt():
+    """Receives a report (or a list of reports) like the server of the class."""
+    data = request.get_json(force=True)
+    reports = data if isinstance(data, list) else [data]
+    attempts.extend(reports)
+    for report in reports:
+        print("Attempt:", report)
+    return jsonify({"message": "Attempt received", "count": len(reports)})
+
+
+@app.route("/api/attempts", methods=["GET"])
+def get_attempts():
+    return jsonify({"data": attempts})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the server of the class. Run the model with "
+        "TELEMETRY_URL=http://localhost:8686/api/validate_attempt (flask_server uses 8585)"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8686)
+    args = parser.parse_args()
+    app.run(host=args.host, port=args.port)
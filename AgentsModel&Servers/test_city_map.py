@@ -0,0 +1,148 @@
+# Pruebas de la construcción del grafo de calles con NumPy contra la construcción celda por celda
+
+import json
+import os
+
+import pytest
+
+from city_map import (
+    DESTINATION,
+    DIRECTIONS,
+    ROAD,
+    TRAFFIC_LIGHT,
+    build_edges,
+    classify_cells,
+    load_city_map,
+)
+from model import BASE_DIR, DICTIONARY_PATH
+
+MAPS = ["2022_base.txt", "2023_base.txt"]
+
+# Edges between a traffic light and a road next to it, in the order the rules were checked:
+# (direction of the road, condition on the light (x, y) and the road (nx, ny), edge), where the
+# edge is 1 for light -> road and 2 for road -> light
+LIGHT_RULES = [
+    ("Right", lambda x, y, nx, ny: x > nx, 2),
+    ("Right", lambda x, y, nx, ny: x < nx, 1),
+    ("Down-Left", lambda x, y, nx, ny: x > nx, 1),
+    ("Up-Right", lambda x, y, nx, ny: y > ny, 1),
+    ("Up-Right", lambda x, y, nx, ny: y < ny, 2),
+    ("Left", lambda x, y, nx, ny: x < nx, 2),
+    ("Left", lambda x, y, nx, ny: x > nx, 1),
+    ("Down", lambda x, y, nx, ny: y > ny, 1),
+    ("Down", lambda x, y, nx, ny: y < ny, 2),
+    ("Right", lambda x, y, nx, ny: y > ny, 1),
+    ("Down", lambda x, y, nx, ny: x > nx, 1),
+    ("Up", lambda x, y, nx, ny: y > ny, 2),
+    ("Up", lambda x, y, nx, ny: y < ny, 1),
+    ("Left", lambda x, y, nx, ny: y < ny, 1),
+    ("Up", lambda x, y, nx, ny: x < nx, 1),
+]
+
+
+def _moves(direction, x, y, nx, ny):
+    """Whether a road with the given direction at (x, y) lets a car move to (nx, ny)."""
+    return (
+        (direction == "Up" and y < ny)
+        or (direction == "Down" and y > ny)
+        or (direction == "Left" and x > nx)
+        or (direction == "Right" and x < nx)
+        or (direction == "Up-Right" and (x < nx or y < ny))
+        or (direction == "Up-Left" and (x > nx or y < ny))
+        or (direction == "Down-Right" and (x < nx or y > ny))
+        or (direction == "Down-Left" and (x > nx or y > ny))
+    )
+
+
+def _reference_edges(kinds, directions):
+    """
+    Edges of the road graph added one neighbour at a time, with the loops of the old
+    CityModel.create_graph. Like there, the traffic light rules also run for the cells that are not
+    nodes, with the last node visited and the coordinates of the cell.
+    Returns a dictionary from (source, target) to the direction of the edge (None for no direction).
+    """
+    width, height = kinds.shape
+
+    def is_node(cell):
+        return kinds[cell] in (ROAD, TRAFFIC_LIGHT, DESTINATION)
+
+    def neighborhood(cell, moore):
+        x, y = cell
+        return [
+            (x + dx, y + dy)
+            for dx in (-1, 0, 1)
+            for dy in (-1, 0, 1)
+            if (dx or dy)
+            and (moore or not (dx and dy))
+            and 0 <= x + dx < width
+            and 0 <= y + dy < height
+        ]
+
+    edges = {}
+
+    def add(source, target, direction=None):
+        if direction is not None or (source, target) not in edges:
+            edges[source, target] = direction
+
+    current_node = current_kind = None
+    neighbors = []
+    for x in range(width):
+        for y in range(height):
+            if is_node((x, y)):
+                current_node = (x, y)
+                for neighbor in neighborhood(current_node, moore=True):
+                    if is_node(neighbor):
+                        current_kind = kinds[current_node]
+                        if current_kind == ROAD and kinds[neighbor] == ROAD:
+                            direction = DIRECTIONS[directions[current_node]]
+                            if directions[neighbor] == directions[current_node]:
+                                candidates = [neighbor]
+                            else:
+                                candidates = [
+                                    other
+                                    for other in neighborhood(current_node, moore=False)
+                                    if is_node(other)
+                                ]
+                            for other in candidates:
+                                if _moves(direction, x, y, *other):
+                                    add(current_node, other, direction)
+                    neighbors = neighborhood(current_node, moore=False)
+
+            for neighbor in neighbors:
+                if is_node(neighbor) and current_kind == TRAFFIC_LIGHT:
+                    road = (
+                        DIRECTIONS[directions[neighbor]]
+                        if kinds[neighbor] == ROAD
+                        else None
+                    )
+                    for rule_direction, condition, edge in LIGHT_RULES:
+                        if road == rule_direction and condition(x, y, *neighbor):
+                            if edge == 1:
+                                add(current_node, neighbor)
+                            else:
+                                add(neighbor, current_node)
+                            break
+                for other in neighbors:
+                    if is_node(other) and current_kind == DESTINATION:
+                        add(other, current_node)
+    return edges
+
+
+@pytest.mark.parametrize("map_name", MAPS)
+def test_build_edges_matches_the_cell_by_cell_graph(map_name):
+    with open(os.path.join(BASE_DIR, "city_files", map_name)) as file:
+        city_map = load_city_map(file.readlines())
+    with open(DICTIONARY_PATH) as file:
+        kinds, directions = classify_cells(city_map, json.load(file))
+    height = kinds.shape[1]
+
+    sources, targets, edge_directions = build_edges(kinds, directions)
+    edges = {
+        (divmod(source, height), divmod(target, height)): DIRECTIONS[direction]
+        for source, target, direction in zip(
+            sources.tolist(), targets.tolist(), edge_directions.tolist()
+        )
+    }
+
+    assert len(edges) == len(sources)
+    assert edges == _reference_edges(kinds, directions)
@@ -0,0 +1,246 @@
+# Pruebas de las rutas del servidor con el cliente de prueba de Flask
+
+import gzip
+import json
+import time
+import uuid
+
+import pytest
+
+import flask_server
+import wire_format
+
+MAP_NAME = "2023_base.txt"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("TELEMETRY_URL", "off")
+    return flask_server.app.test_client()
+
+
+@pytest.fixture
+def session(client):
+    """Id of a new session of a bundled map, closed at the end of the test."""
+    session_id = uuid.uuid4().hex
+    response = client.post("/init", data={"MapPath": MAP_NAME, "session": session_id})
+    assert response.status_code == 200
+    yield session_id
+    client.post("/closeSession", data={"session": session_id})
+
+
+def _state(client, session):
+    """Cars and traffic lights of a session, from the answers without since."""
+    query = {"session": session}
+    cars = {
+        car["id"]: car
+        for car in client.get("/getAgents", query_string=query).json["data"]
+    }
+    lights = {
+        light["id"]: light["state"]
+        for light in client.get("/getTrafficLights", query_string=query).json["data"]
+    }
+    return cars, lights
+
+
+def _body(response):
+    """Body of a response, decompressed when the server compressed it."""
+    if response.headers.get("Content-Encoding") == "gzip":
+        return gzip.decompress(response.data)
+    return response.data
+
+
+def _apply(frame, cars, lights):
+    """Applies a frame of /getAgents?since= or /step to the cars and lights the client has."""
+    if frame["full"]:
+        cars.clear()
+        lights.clear()
+    for car in frame["data"]:
+        cars[car["id"]] = {**cars.get(car["id"], {}), **car}
+    for car_id in frame["removed"]:
+        del cars[car_id]
+    for light in frame["lights"]:
+        lights[light["id"]] = light["state"]
+
+
+def test_since_changes_rebuild_the_state(client, session):
+    frame = client.get(
+        "/getAgents", query_string={"session": session, "since": -1}
+    ).json
+    assert frame["full"]
+    cars, lights = {}, {}
+    _apply(frame, cars, lights)
+
+    for _ in range(20):
+        client.get("/update", query_string={"session": session})
+        query = {"session": session, "since": frame["step"], "run": frame["run"]}
+        frame = client.get("/getAgents", query_string=query).json
+        assert not frame["full"]
+        _apply(frame, cars, lights)
+        assert (cars, lights) == _state(client, session)
+
+
+def test_since_falls_back_to_a_full_snapshot(client, session):
+    first = client.get(
+        "/getAgents", query_string={"session": session, "since": -1}
+    ).json
+    client.get("/update", query_string={"session": session})
+    cars, _ = _state(client, session)
+
+    # Another run of the model, a step in the future and a step older than the history kept
+    other_run = {"since": first["step"], "run": "0" * len(first["run"])}
+    future = {"since": first["step"] + 5, "run": first["run"]}
+    for query in (other_run, future):
+        frame = client.get(
+            "/getAgents", query_string={"session": session, **query}
+        ).json
+        assert frame["full"]
+        assert {car["id"] for car in frame["data"]} == set(cars)
+
+    client.post(
+        "/step", data={"session": session, "steps": flask_server.STATE_HISTORY + 1}
+    )
+    query = {"session": session, "since": first["step"], "run": first["run"]}
+    frame = client.get("/getAgents", query_string=query).json
+    assert frame["full"]
+    cars, lights = {}, {}
+    _apply(frame, cars, lights)
+    assert (cars, lights) == _state(client, session)
+
+
+@pytest.mark.parametrize("steps", [0, -1, flask_server.MAX_STEPS + 1])
+def test_step_rejects_steps_out_of_bounds(client, session, steps):
+    response = client.post("/step", data={"session": session, "steps": steps})
+    assert response.status_code == 400
+
+
+def test_step_frames_rebuild_the_state(client, session):
+    cars, lights = {}, {}
+    data = {"session": session}
+    for steps, intermediate in [(1, 0), (3, 1), (5, 0), (2, 1)]:
+        answer = client.post(
+            "/step", data={**data, "steps": steps, "frames": intermediate}
+        ).json
+        assert len(answer["frames"]) == (steps if intermediate else 1)
+        for frame in answer["frames"]:
+            _apply(frame, cars, lights)
+        assert answer["frames"][-1]["step"] == answer["step"]
+        assert (cars, lights) == _state(client, session)
+        data.update(since=answer["step"], run=answer["frames"][-1]["run"])
+
+
+@pytest.mark.parametrize("encoding", ["identity", "gzip"])
+def test_binary_frames_match_the_json(client, session, encoding):
+    client.post("/step", data={"session": session, "steps": 30})
+    first = client.get("/getAgents", query_string={"session": session, "since": -1})
+    client.post("/step", data={"session": session, "steps": 3})
+
+    headers = {"Accept-Encoding": encoding}
+    binary = {**headers, "Accept": wire_format.CONTENT_TYPE}
+    queries = [
+        {"session": session, "since": -1},
+        {"session": session, "since": first.json["step"], "run": first.json["run"]},
+    ]
+    for query in queries:
+        expected = client.get("/getAgents", query_string=query, headers=headers)
+        response = client.get("/getAgents", query_string=query, headers=binary)
+        assert response.mimetype == wire_format.CONTENT_TYPE
+
+        step, (frame,) = wire_format.unpack_frames(_body(response))
+        changes = flask_server.changes_data(frame, flask_server.sessions.get(session))
+        assert step == frame.step
+        assert changes == json.loads(_body(expected))
+
+
+def test_json_is_preferred_without_the_binary_type(client, session):
+    for accept in ("*/*", f"application/json, {wire_format.CONTENT_TYPE};q=0.5"):
+        response = client.get(
+            "/getAgents",
+            query_string={"session": session, "since": -1},
+            headers={"Accept": accept},
+        )
+        assert response.mimetype == "application/json"
+
+
+def test_clock_streams_frames_until_stopped(client, session):
+    response = client.get("/stream", query_string={"session": session}, buffered=False)
+    chunks = iter(response.response)
+    client.post("/startClock", data={"session": session})
+
+    cars, lights = {}, {}
+    steps = []
+    while len(steps) < 10:
+        chunk = next(chunks)
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        data = [line[6:] for line in chunk.splitlines() if line.startswith("data: ")]
+        if data:
+            frame = json.loads(data[0])
+            _apply(frame, cars, lights)
+            steps.append(frame["step"])
+    response.close()
+    assert client.post("/stopClock", data={"session": session}).status_code == 200
+
+    # The steps only go forward, and the changes since the last one bring the client up to date
+    assert steps == sorted(set(steps))
+    query = {"session": session, "since": steps[-1], "run": frame["run"]}
+    _apply(client.get("/getAgents", query_string=query).json, cars, lights)
+    assert (cars, lights) == _state(client, session)
+    step = flask_server.sessions.get(session).step_counter
+    time.sleep(0.05)
+    assert flask_server.sessions.get(session).step_counter == step
+
+
+def test_init_replaces_the_model_of_a_session(client, session):
+    client.post("/step", data={"session": session, "steps": 5})
+    other = client.post("/init", data={"MapPath": MAP_NAME}).json["session"]
+    try:
+        # The default session is another one, and stepping it doesn't move this one
+        client.post("/step", data={"steps": 2})
+        assert flask_server.sessions.get(session).step_counter == 5
+
+        run = client.get("/getAgents", query_string={"since": -1}).json["run"]
+        again = client.post("/init", data={"MapPath": MAP_NAME}).json["session"]
+        assert again == other
+        assert flask_server.sessions.get(other).step_counter == 0
+        assert client.get("/getAgents", query_string={"since": -1}).json["run"] != run
+
+        client.post("/init", data={"MapPath": MAP_NAME, "session": session})
+        assert flask_server.sessions.get(session).step_counter == 0
+        ids = [data["id"] for data in client.get("/getSessions").json["data"]]
+        assert ids.count(session) == ids.count(other) == 1
+    finally:
+        client.post("/closeSession", data={"session": other})
+
+
+def test_buffer_rewinds_to_the_client_after_set_parameters(client, session):
+    query = {"session": session}
+    frame = client.get("/getAgents", query_string={**query, "since": -1}).json
+    cars, lights = {}, {}
+    _apply(frame, cars, lights)
+    step = frame["step"]
+    client.post("/startBuffer", data={**query, "frames": 8})
+
+    def play(updates):
+        nonlocal step
+        for _ in range(updates):
+            answer = client.get("/update", query_string=query).json
+            assert answer["step"] == step + 1
+            _apply(answer, cars, lights)
+            step = answer["step"]
+            assert (cars, lights) == _state(client, session)
+
+    play(10)
+    # Lets the buffer fill, so the new parameters drop frames computed ahead
+    buffer = flask_server.sessions.get(session).frames
+    deadline = time.monotonic() + 10
+    while buffer.ahead < 8 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    data = {**query, "spawn_interval": 3, "light_periods": json.dumps({"S": 4})}
+    assert client.post("/setParameters", data=data).status_code == 200
+    model = flask_server.sessions.get(session).model
+    assert model.spawn_interval == 3
+    play(10)
+
+    client.post("/stopBuffer", data=query)
+    assert flask_server.sessions.get(session).step_counter == step
+    assert (cars, lights) == _state(client, session)
@@ -0,0 +1,51 @@
+# Pruebas de las instantáneas del modelo: tamaño y reproducción exacta de la simulación al restaurarlas
+
+import pytest
+
+from map_generator import generate_grid
+from model import CityModel
+
+CONFIGS = [
+    {"engine": "vectorized"},
+    {"engine": "agents", "graph_backend": "csr"},
+]
+
+
+def _grid_model(directory, blocks, config):
+    """Model of a synthetic grid map after some steps, so its next-hop tables are built."""
+    path = directory / f"grid_{blocks}.txt"
+    path.write_text("".join(generate_grid(blocks)))
+    model = CityModel(str(path), telemetry=False, map_cache=False, seed=0, **config)
+    for _ in range(20):
+        model.step()
+    return model
+
+
+def _trace(model, steps):
+    """Position of every car after each of steps steps."""
+    trace = []
+    for _ in range(steps):
+        model.step()
+        ids, xs, ys, _, _ = model.car_states()
+        trace.append(sorted(zip(ids.tolist(), xs.tolist(), ys.tolist())))
+    return trace
+
+
+@pytest.mark.parametrize("config", CONFIGS)
+def test_snapshot_size_does_not_grow_with_map_area(tmp_path, config):
+    # 25x25 and 301x301 cells, with about the same number of cars
+    small = _grid_model(tmp_path, 4, config)
+    large = _grid_model(tmp_path, 50, config)
+    assert large.next_hop_tables or large.fleet.tables
+
+    assert large.snapshot().nbytes < 1.5 * small.snapshot().nbytes
+
+
+@pytest.mark.parametrize("config", CONFIGS)
+def test_restore_repeats_the_simulation(tmp_path, config):
+    model = _grid_model(tmp_path, 8, config)
+    snapshot = model.snapshot()
+    expected = _trace(model, 30)
+
+    model.restore(snapshot)
+    assert _trace(model, 30) == expected
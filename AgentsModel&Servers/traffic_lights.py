@@ -0,0 +1,140 @@
+#Script que controla todos los semáforos del modelo a la vez usando arreglos
+
+import numpy as np
+
+from agent import GREEN, RED
+
+
+class TrafficLightController:
+    """
+    Changes the state of all the traffic lights of the model in one operation.
+    Attributes:
+        positions: (x, y) position of each light
+        groups: Phase group of each light. The lights of a group always change together
+        periods: Steps between changes of each group
+        offsets: Step of each group where the first change happens (modulo its period)
+        states: Whether each group is green
+        next_change: First step where at least one group changes
+    """
+
+    def __init__(
+        self,
+        positions,
+        periods,
+        states,
+        groups=None,
+        offsets=None,
+        signal_layer=None,
+    ):
+        """
+        Creates the controller.
+        Args:
+            positions: (x, y) position of each light
+            periods: Steps between changes of each light, as in mapDictionary.json
+            states: Initial state of each light
+            groups: Phase group of each light. By default every light is its own group
+            offsets: Phase offset of each light
+            signal_layer: Array of the model where the state of each light is copied
+        """
+        self.positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+        count = len(self.positions)
+        periods = _check_periods(periods)
+        states = np.asarray(states, dtype=bool)
+        if groups is None:
+            groups = np.arange(count)
+        if offsets is None:
+            offsets = np.zeros(count, dtype=np.int64)
+
+        # Each group takes the period, offset and state of its first light
+        _, first, self.groups = np.unique(
+            groups, return_index=True, return_inverse=True
+        )
+        self.periods = periods[first]
+        self.offsets = np.asarray(offsets, dtype=np.int64)[first]
+        self.states = states[first]
+        self.signal_layer = signal_layer
+
+        self.next_change = self._next_change(-1)
+        self.update_signal_layer()
+
+    def _next_change(self, step):
+        """First step after step where some group changes."""
+        if self.periods.size == 0:
+            return np.inf
+        remaining = self.periods - (step - self.offsets) % self.periods
+        return int(step + remaining.min())
+
+    def step(self, step):
+        """
+        Changes the state of the groups that are due at step. Returns whether any light changed.
+        Steps before the next change don't do any work.
+        """
+        if step < self.next_change:
+            return False
+
+        due = (step - self.offsets) % self.periods == 0
+        self.states[due] = ~self.states[due]
+        self.next_change = self._next_change(step)
+        self.update_signal_layer()
+        return bool(due.any())
+
+    def set_periods(self, periods, step):
+        """
+        Changes the steps between changes of each light (one value per light, as in __init__). The
+        lights keep their state, and their next change is counted with the new periods after step.
+        """
+        _, first = np.unique(self.groups, return_index=True)
+        self.periods = _check_periods(periods)[first]
+        self.next_change = self._next_change(step)
+
+    def light_states(self):
+        """State of each light."""
+        return self.states[self.groups]
+
+    def light_state(self, index):
+        """State of one light."""
+        return bool(self.states[self.groups[index]])
+
+    def set_light_state(self, index, state):
+        """Sets the state of a light, which also changes the rest of its group."""
+        self.states[self.groups[index]] = bool(state)
+        self.update_signal_layer()
+
+    def update_signal_layer(self):
+        """Copies the state of the lights to the signal layer of the model."""
+        if self.signal_layer is not None and len(self.positions):
+            xs, ys = self.positions.T
+            self.signal_layer[xs, ys] = np.where(self.light_states(), GREEN, RED)
+
+
+def stop_line_groups(positions, chars):
+    """
+    Groups the lights that are next to each other and use the same character of the map, so all the
+    lights across a road change together.
+    """
+    index = {
+        tuple(position): i for i, position in enumerate(np.asarray(positions).tolist())
+    }
+    parent = list(range(len(index)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for (x, y), i in index.items():
+        for neighbor in ((x + 1, y), (x, y + 1)):
+            j = index.get(neighbor)
+            if j is not None and chars[i] == chars[j]:
+                parent[find(j)] = find(i)
+
+    return np.array([find(i) for i in range(len(parent))], dtype=np.int64)
+
+
+def _check_periods(periods):
+    """Array of the periods of the lights. A period under 1 step would make the lights divide by zero."""
+    periods = np.asarray(periods, dtype=np.int64)
+    if (periods < 1).any():
+        raise ValueError("The periods of the traffic lights must be at least 1")
+    return periods
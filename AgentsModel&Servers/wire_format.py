@@ -0,0 +1,112 @@
+#Script con el formato binario en el que el servidor puede mandar el estado de los autos y semáforos en lugar de JSON
+
+import struct
+
+import numpy as np
+
+from state_feed import Changes
+
+# Content type that a client puts in Accept to get the binary format
+CONTENT_TYPE = "application/x-traffic-state"
+MAGIC = b"TRFS"
+VERSION = 1
+
+# Message: magic, version, number of frames, step of the model
+HEADER = struct.Struct("<4sHHq")
+# Frame: step, run, full, number of cars, of destinations, of removed cars and of lights
+FRAME = struct.Struct("<q12s?3xIIII")
+
+
+def pack_frames(frames, step):
+    """
+    Packs state_feed.Changes for the client. Everything is little-endian. After HEADER, each frame
+    is FRAME followed by the arrays
+        ids int64[cars], removed int64[removed], x int32[cars], y int32[cars],
+        dest_x int32[destinations], dest_y int32[destinations], lights int32[lights],
+        send_destination uint8[cars], light_states uint8[lights]
+    and zeros up to a multiple of 8 bytes. dest_x and dest_y are only for the cars with
+    send_destination, and lights are indices in the order of /getTrafficLights.
+    """
+    parts = [HEADER.pack(MAGIC, VERSION, len(frames), step)]
+    for changes in frames:
+        send = changes.send_destination.astype(bool)
+        dest_x = changes.dest_x[send]
+        parts.append(
+            FRAME.pack(
+                changes.step,
+                changes.run.encode("ascii"),
+                changes.full,
+                changes.ids.size,
+                dest_x.size,
+                changes.removed.size,
+                changes.lights.size,
+            )
+        )
+        arrays = [
+            (changes.ids, "<i8"),
+            (changes.removed, "<i8"),
+            (changes.x, "<i4"),
+            (changes.y, "<i4"),
+            (dest_x, "<i4"),
+            (changes.dest_y[send], "<i4"),
+            (changes.lights, "<i4"),
+            (send, "u1"),
+            (changes.light_states, "u1"),
+        ]
+        size = 0
+        for array, dtype in arrays:
+            data = np.asarray(array, dtype=dtype).tobytes()
+            parts.append(data)
+            size += len(data)
+        parts.append(bytes(-size % 8))
+    return b"".join(parts)
+
+
+def unpack_frames(data):
+    """Reads a message of pack_frames. Returns the step and a list of Changes."""
+    magic, version, count, step = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a traffic state message of this version")
+    offset = HEADER.size
+    frames = []
+    for _ in range(count):
+        frame_step, run, full, cars, destinations, removed, lights = FRAME.unpack_from(
+            data, offset
+        )
+        offset += FRAME.size
+        start = offset
+        arrays = []
+        for dtype, length in [
+            ("<i8", cars),
+            ("<i8", removed),
+            ("<i4", cars),
+            ("<i4", cars),
+            ("<i4", destinations),
+            ("<i4", destinations),
+            ("<i4", lights),
+            ("u1", cars),
+            ("u1", lights),
+        ]:
+            arrays.append(np.frombuffer(data, dtype=dtype, count=length, offset=offset))
+            offset += arrays[-1].nbytes
+        offset += -(offset - start) % 8
+        ids, removed_ids, x, y, dest_x, dest_y, light_ids, send, light_states = arrays
+        send = send.astype(bool)
+        # Destinations of the cars that don't have one are -1
+        full_dest_x = np.full(cars, -1, dtype=np.int32)
+        full_dest_y = np.full(cars, -1, dtype=np.int32)
+        full_dest_x[send] = dest_x
+        full_dest_y[send] = dest_y
+        frames.append(
+            Changes(
+                run.decode("ascii"),
+                frame_step,
+                full,
+                (ids, x, y, full_dest_x, full_dest_y),
+                send,
+                removed_ids,
+                light_ids,
+                light_states.astype(bool),
+            )
+        )
+    return step, frames